@@ -36,6 +36,10 @@ cors.init_app(app, resources={
     }
 })
 
+# Instrumentação por etapa (Server-Timing e /metrics)
+from app.services.metrics import init_app as init_metrics
+init_metrics(app)
+
 # Handler de erros para endpoints JSON (AJAX)
 @app.errorhandler(Exception)
 def handle_error(error):
@@ -49,7 +53,7 @@ def handle_error(error):
         request.path.startswith('/api/') or 
         request.path.startswith('/chat/') or
         request.path.startswith('/user/profile') or
-        (request.path == '/chatbot' and request.method == 'POST')
+        (request.path.startswith('/chatbot') and request.method == 'POST')
     )
     
     if is_json_endpoint:
@@ -65,3 +69,4 @@ def handle_error(error):
 
 from app.models import tables
 from app.controllers import routes
+from app import commands
@@ -0,0 +1,93 @@
+"""
+Comandos de manutenção (Flask CLI)
+
+    flask --app run.py history purge --days 30
+    flask --app run.py history reconcile-stats
+    flask --app run.py history archive --days 90
+"""
+import click
+
+from app import app
+from app.services.chat_history_service import chat_history_service
+from app.services.usage_stats import usage_counters
+from app.services.history_archive import history_archive, ARCHIVE_AFTER_DAYS
+from app.services.history_retention import (
+    history_purger, PurgeInProgress, RETENTION_DAYS, RETENTION_SOFT_DELETE_GRACE_DAYS
+)
+
+
+@app.cli.group()
+def history():
+    """Manutenção do histórico de chat"""
+
+
+@history.command("purge")
+@click.option("--days", type=int, default=RETENTION_DAYS, show_default=True,
+              help="Apaga turnos mais antigos que N dias")
+@click.option("--grace-days", type=int, default=RETENTION_SOFT_DELETE_GRACE_DAYS, show_default=True,
+              help="Apaga de vez turnos com soft delete (deleted_at) há mais de N dias")
+@click.option("--batch-size", type=int, default=None, help="Registros por lote (padrão RETENTION_BATCH_SIZE)")
+@click.option("--pause", type=float, default=None, help="Segundos entre lotes (padrão RETENTION_BATCH_PAUSE)")
+@click.option("--restart", is_flag=True, help="Ignora o checkpoint de uma limpeza interrompida e começa de novo")
+def purge(days, grace_days, batch_size, pause, restart):
+    """Limpeza do histórico em lotes (retoma onde uma execução interrompida parou)"""
+    if batch_size is not None:
+        history_purger.batch_size = max(1, batch_size)
+    if pause is not None:
+        history_purger.pause = pause
+
+    def progress(status):
+        if status["job"] == "archive":
+            click.echo(f"  archive: {status['archived']} arquivados (id {status['next_id']}/{status['end_id']})")
+        else:
+            click.echo(f"  {status['job']}: {status['deleted']} apagados (id {status['next_id']}/{status['end_id']})")
+
+    try:
+        result = chat_history_service.apply_retention(days, grace_days, resume=not restart, progress=progress)
+    except PurgeInProgress as e:
+        raise click.ClickException(str(e))
+    except KeyboardInterrupt:
+        click.echo("Interrompido: a próxima execução continua do último lote gravado")
+        raise SystemExit(130)
+
+    if result["archived"]:
+        click.echo(f"✅ {result['archived']} turnos arquivados")
+    click.echo(f"✅ {result['expired']} turnos expirados e {result['soft_deleted']} com soft delete apagados")
+
+
+@history.command("archive")
+@click.option("--days", type=int, default=ARCHIVE_AFTER_DAYS, show_default=True,
+              help="Arquiva turnos mais antigos que N dias")
+@click.option("--batch-size", type=int, default=None, help="Registros por lote (padrão ARCHIVE_BATCH_SIZE)")
+@click.option("--pause", type=float, default=None, help="Segundos entre lotes (padrão ARCHIVE_BATCH_PAUSE)")
+def archive(days, batch_size, pause):
+    """Move os turnos antigos para o arquivo comprimido (funciona mesmo sem ARCHIVE_ENABLED)"""
+    if batch_size is not None:
+        history_archive.batch_size = max(1, batch_size)
+    if pause is not None:
+        history_archive.pause = pause
+
+    def progress(status):
+        click.echo(f"  {status['archived']} arquivados (id {status['next_id']}/{status['end_id']})")
+
+    try:
+        count = chat_history_service.archive_old_history(days, progress=progress)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    except KeyboardInterrupt:
+        # Cada lote só sai da tabela depois de gravado no arquivo
+        click.echo("Interrompido: os lotes já arquivados ficam no arquivo")
+        raise SystemExit(130)
+
+    stats = history_archive.stats()
+    click.echo(f"✅ {count} turnos arquivados ({stats['rows']} no arquivo, {stats['segments']} segmentos)")
+
+
+@history.command("reconcile-stats")
+@click.option("--user-id", type=int, default=None, help="Só este utilizador (padrão: todos)")
+@click.option("--dry-run", is_flag=True, help="Só conta os utilizadores com contadores divergentes")
+def reconcile_stats(user_id, dry_run):
+    """Recalcula as estatísticas de uso (usage_counters) a partir do histórico"""
+    result = usage_counters.reconcile(user_id, dry_run=dry_run)
+    action = "divergentes" if dry_run else "corrigidos"
+    click.echo(f"✅ {result['users']} utilizadores verificados, {result['fixed']} {action}")
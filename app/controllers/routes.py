@@ -1,13 +1,31 @@
 import os
-from flask import render_template, redirect, url_for, flash, request, jsonify, send_from_directory
+import json
+from flask import render_template, redirect, url_for, flash, request, jsonify, send_from_directory, Response, stream_with_context
 from flask_login import login_user, logout_user, login_required, current_user
 from app import app, db, login_manager
 from werkzeug.security import generate_password_hash, check_password_hash
 from app import csrf
 
-from app.services.unified_chatbot import generate_response, get_available_models
+from app.services.unified_chatbot import generate_response, stream_response, get_available_models, chatbot_registry, reset_backends, get_chatbot, BATCH_MAX_ITEMS
+from app.services.model_catalog import model_catalog
+from app.services.ollama_http import ollama_http
+from app.services.ollama_pool import ollama_pool
+from app.services.ollama_sessions import ollama_sessions
+from app.services.response_cache import response_cache
+from app.services.singleflight import request_coalescer
+from app.services.admission import admission, AdmissionRejected
+from app.services.circuit_breaker import circuit_breakers, CircuitOpen
+from app.services.metrics import metrics, stage, label_request, count_error, count_timeout, is_timeout, request_annotation, METRICS_TOKEN
+from app.services.async_chatbot import generate_response_async
 from app.services.pix2latex_service import process_image, get_service_status
 from app.services.chat_history_service import chat_history_service
+from app.services.history_retention import history_purger
+from app.services.usage_stats import usage_counters
+from app.services.history_archive import history_archive
+from app.services.context_cache import context_cache
+from app.services.context_retrieval import context_retriever, RETRIEVAL_RECENT_TURNS
+from app.services.session_summary import session_summarizer, ConversationHistory
+from app.services.prompt_builder import prompt_builder, render_context
 from app.services.whatsapp_formatter import format_for_whatsapp
 
 from app.models.tables import User
@@ -134,7 +152,8 @@ def update_profile():
         form.name.data = current_user.name
         form.email.data = current_user.email
         form.tel.data = current_user.tel
-    return render_template('edit.html', form=form)
+    stats = chat_history_service.get_user_stats(current_user.id)
+    return render_template('edit.html', form=form, stats=stats)
 
 
 @app.route("/user/delete/<int:id>")
@@ -162,20 +181,104 @@ def delete_profile():
 @app.route("/chat/history", methods=["GET"])
 @login_required
 def get_chat_history():
-    """Retorna histórico de chat do utilizador"""
+    """
+    Retorna histórico de chat do utilizador, do mais recente para o mais antigo
+    
+    Query params:
+        limit: turnos por página (padrão 50)
+        cursor: next_cursor da resposta anterior, para a página seguinte
+        session_id: filtrar por sessão
+        fields: campos separados por vírgula (ex: id,message,created_at para listagens sem as respostas)
+    """
     limit = request.args.get('limit', 50, type=int)
     session_id = request.args.get('session_id', None)
+    fields = [field.strip() for field in request.args.get('fields', '').split(',') if field.strip()]
     
-    history = chat_history_service.get_user_history(
-        user_id=current_user.id,
-        limit=limit,
-        session_id=session_id
-    )
+    try:
+        page = chat_history_service.get_history_page(
+            user_id=current_user.id,
+            limit=limit,
+            cursor=request.args.get('cursor') or None,
+            session_id=session_id,
+            fields=fields
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
     return jsonify({
-        "history": [h.to_dict() for h in history]
+        "history": page["history"],
+        "next_cursor": page["next_cursor"],
+        "has_more": page["next_cursor"] is not None
     })
 
+
+@app.route("/chat/history/export", methods=["GET"])
+@login_required
+def export_chat_history():
+    """
+    Exporta todo o histórico do utilizador (incluindo o arquivado) em NDJSON,
+    um turno por linha, do mais recente para o mais antigo
+    
+    Query params:
+        session_id: filtrar por sessão
+        fields: campos separados por vírgula
+    """
+    session_id = request.args.get('session_id', None)
+    fields = [field.strip() for field in request.args.get('fields', '').split(',') if field.strip()]
+    user_id = current_user.id
+    
+    try:
+        # Valida os campos antes de a resposta começar
+        rows = chat_history_service.export_user_history(user_id, session_id, fields)
+        first = next(rows, None)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    def generate():
+        if first is None:
+            return
+        yield json.dumps(first, ensure_ascii=False) + "\n"
+        for row in rows:
+            yield json.dumps(row, ensure_ascii=False) + "\n"
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype="application/x-ndjson",
+        headers={"Content-Disposition": "attachment; filename=chat_history.ndjson"}
+    )
+
+@app.route("/user/stats", methods=["GET"])
+@login_required
+def get_user_stats():
+    """Estatísticas de uso do utilizador (por modelo, serviço e, com ?days=N, por dia)"""
+    days = request.args.get('days', None, type=int)
+    return jsonify(_named_stats(chat_history_service.get_user_stats(current_user.id, days)))
+
+
+@app.route("/api/admin/usage", methods=["GET"])
+@login_required
+@auth_role("admin")
+def admin_usage():
+    """API: Uso por modelo e serviço de todos os utilizadores, por dia e (com ?user_id=) de um utilizador"""
+    days = request.args.get('days', 30, type=int)
+    user_id = request.args.get('user_id', None, type=int)
+    
+    usage = {
+        "totals": usage_counters.totals(),
+        "daily": usage_counters.daily_totals(days=days)
+    }
+    if user_id is not None:
+        usage["user"] = _named_stats(chat_history_service.get_user_stats(user_id, days))
+    return jsonify(usage)
+
+
+def _named_stats(stats):
+    """Turnos sem modelo/serviço ficam em "outro" (o JSON não aceita chaves None)"""
+    for key in ("models", "services"):
+        stats[key] = {name or "outro": count for name, count in stats[key].items()}
+    return stats
+
+
 @app.route("/chat/history/delete", methods=["POST"])
 @login_required
 def delete_chat_history():
@@ -200,83 +303,398 @@ def chatbot():
             return redirect(url_for('index'))
     
     try:
-        if 'image' in request.files and request.files['image'].filename:
-            image_file = request.files['image']
-            extraction_mode = request.form.get('mode', 'text')
-            
-            crop_box = None
-            if all(k in request.form for k in ['crop_x1', 'crop_y1', 'crop_x2', 'crop_y2']):
-                crop_box = (
-                    int(request.form['crop_x1']),
-                    int(request.form['crop_y1']),
-                    int(request.form['crop_x2']),
-                    int(request.form['crop_y2'])
-                )
-            
-            extraction_result = process_image(image_file, mode=extraction_mode, crop_box=crop_box)
-            
-            if not extraction_result["success"]:
-                return jsonify({"error": extraction_result["error"]}), 400
-            
-            if extraction_result["type"] == "latex":
-                user_message = f"Explique esta fórmula: {extraction_result['content']}"
-            else:
-                user_message = extraction_result["content"]
-            
-            model_type = request.form.get("model", "gemini")
-            session_id = request.form.get("session_id") or chat_history_service.create_session_id()
-        
-        else:
-            if request.is_json:
-                data = request.get_json()
-                user_message = data.get("message", "").strip()
-                model_type = data.get("model", "gemini")
-                session_id = data.get("session_id") or chat_history_service.create_session_id()
-            else:
-                user_message = request.form.get("message", "").strip()
-                model_type = request.form.get("model", "gemini")
-                session_id = request.form.get("session_id") or chat_history_service.create_session_id()
-            
-            if not user_message:
-                return jsonify({"error": "Mensagem vazia"}), 400
+        chat_input, error = _read_chat_request()
+        if error:
+            return error
         
-        recent_history = chat_history_service.get_recent_history(current_user.id, hours=2, limit=5)
-        context = "\n".join([f"User: {h.message}\nBot: {h.response}" for h in reversed(recent_history)])
-        
-        ollama_url = request.form.get("ollama_url", None)
+        user_message = chat_input["message"]
+        session_id = chat_input["session_id"]
+        _label_chat_request(chat_input["model"])
+        context, history = _build_chat_context(current_user.id, user_message, session_id)
         
         result = generate_response(
             message=user_message,
-            model_type=model_type,
-            ollama_url=ollama_url,
-            context=context
+            model_type=chat_input["model"],
+            ollama_url=chat_input["ollama_url"],
+            context=context,
+            history=history,
+            session_id=session_id
         )
         
         if not result["success"]:
-            error_msg = result.get("error", "Erro ao gerar resposta")
-            return jsonify({"error": error_msg}), 500
+            return _generation_error(result)
         
         try:
-            chat_history_service.save_message(
-                user_id=current_user.id,
-                message=user_message,
-                response=result["response"],
-                model_used=result["model"],
-                service_type=result["type"],
-                session_id=session_id
-            )
+            with stage("save"):
+                chat_history_service.save_message(
+                    user_id=current_user.id,
+                    message=user_message,
+                    response=result["response"],
+                    model_used=result["model"],
+                    service_type=result["type"],
+                    session_id=session_id
+                )
         except Exception as e:
-            pass
+            count_error("save")
         
         return jsonify({
             "response": result["response"],
             "model": result["model"],
             "type": result["type"],
+            **_answer_meta(result),
             "session_id": session_id
         })
         
     except Exception as e:
+        count_error("exception")
+        return jsonify({"error": "Erro interno do servidor"}), 500
+
+
+@app.route("/chatbot/stream", methods=["POST"])
+@csrf.exempt
+@login_required
+def chatbot_stream():
+    """
+    Variante em streaming do POST /chatbot (Server-Sent Events)
+    
+    Eventos:
+        token: {"token": "..."} para cada pedaço gerado
+        done: {"model", "type", "backend", "prompt_tokens", "session_id"} ao terminar (histórico já salvo)
+        error: {"error": "..."} se a geração falhar no meio
+    """
+    try:
+        chat_input, error = _read_chat_request()
+        if error:
+            return error
+        
+        user_id = current_user.id
+        user_message = chat_input["message"]
+        session_id = chat_input["session_id"]
+        _label_chat_request(chat_input["model"])
+        context, history = _build_chat_context(user_id, user_message, session_id)
+        
+        result = stream_response(
+            message=user_message,
+            model_type=chat_input["model"],
+            ollama_url=chat_input["ollama_url"],
+            context=context,
+            history=history,
+            session_id=session_id
+        )
+        
+        if not result["success"]:
+            return _generation_error(result)
+    
+    except Exception as e:
+        count_error("exception")
         return jsonify({"error": "Erro interno do servidor"}), 500
+    
+    def events():
+        stream = result["stream"]
+        chunks = []
+        try:
+            for token in stream:
+                chunks.append(token)
+                yield _sse_event("token", {"token": token})
+        except AdmissionRejected as e:
+            count_error("rejected")
+            yield _sse_event("error", {
+                "error": "Servidor ocupado, tente novamente em instantes",
+                "retry_after": e.retry_after
+            })
+            return
+        except CircuitOpen as e:
+            count_error("rejected")
+            yield _sse_event("error", {
+                "error": "Modelo temporariamente indisponível, tente novamente em instantes",
+                "retry_after": e.retry_after
+            })
+            return
+        except Exception as e:
+            if is_timeout(e):
+                count_timeout(result["type"])
+            count_error("stream")
+            app.logger.error(f"Erro no streaming do chatbot: {str(e)}")
+            yield _sse_event("error", {"error": "Falha ao gerar resposta"})
+            return
+        finally:
+            # Se o cliente desconectar, o close() interrompe a geração no backend
+            stream.close()
+        
+        try:
+            with stage("save"):
+                chat_history_service.save_message(
+                    user_id=user_id,
+                    message=user_message,
+                    response="".join(chunks),
+                    model_used=result["model"],
+                    service_type=result["type"],
+                    session_id=session_id
+                )
+        except Exception as e:
+            count_error("save")
+            app.logger.error(f"Erro ao salvar histórico do streaming: {str(e)}")
+        
+        yield _sse_event("done", {
+            "model": result["model"],
+            "type": result["type"],
+            **_answer_meta(result),
+            "session_id": session_id
+        })
+    
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.route("/api/chat/batch", methods=["POST"])
+@csrf.exempt
+@login_required
+def chat_batch():
+    """
+    API: Gera respostas para vários prompts numa só chamada
+    
+    Body JSON:
+        messages: lista de prompts (máx. BATCH_MAX_ITEMS)
+        model, ollama_url, context: como no /chatbot (comuns a todos os itens)
+        stream: se true, responde em NDJSON à medida que os itens terminam
+        save_history: salva os itens bem-sucedidos no histórico (padrão true)
+    
+    Resposta:
+        JSON {"results": [...], "succeeded", "failed", "session_id"} na ordem dos prompts,
+        ou NDJSON com uma linha {"index", ...resultado} por item e uma linha final {"done": true, ...}
+    """
+    data = request.get_json(silent=True) or {}
+    messages = data.get("messages")
+    
+    if not isinstance(messages, list) or not messages:
+        return jsonify({"error": "Informe uma lista não vazia em 'messages'"}), 400
+    if len(messages) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Máximo de {BATCH_MAX_ITEMS} mensagens por lote"}), 400
+    if not all(isinstance(m, str) for m in messages):
+        return jsonify({"error": "Todas as mensagens devem ser texto"}), 400
+    
+    user_id = current_user.id
+    session_id = data.get("session_id") or chat_history_service.create_session_id()
+    save_history = data.get("save_history", True)
+    _label_chat_request(data.get("model") or "gemini", channel="batch")
+    
+    try:
+        bot = get_chatbot(data.get("model"), data.get("ollama_url") or None)
+    except Exception as e:
+        return jsonify({"error": "Erro interno do servidor"}), 500
+    
+    items = bot.iter_batch(messages, data.get("context") or "")
+    
+    def save(results):
+        if not save_history:
+            return
+        entries = [
+            {
+                "user_id": user_id,
+                "message": messages[index],
+                "response": result["response"],
+                "model_used": result["model"],
+                "service_type": result["type"],
+                "session_id": session_id
+            }
+            for index, result in sorted(results.items())
+            if result["success"]
+        ]
+        try:
+            with stage("save"):
+                chat_history_service.save_messages(entries)
+        except Exception as e:
+            count_error("save")
+            app.logger.error(f"Erro ao salvar histórico do lote: {str(e)}")
+    
+    def summary(results):
+        succeeded = sum(1 for r in results.values() if r["success"])
+        return {
+            "succeeded": succeeded,
+            "failed": len(results) - succeeded,
+            "session_id": session_id
+        }
+    
+    if not data.get("stream"):
+        results = dict(items)
+        save(results)
+        return jsonify({
+            "results": [{"index": i, **_batch_item(results[i])} for i in range(len(messages))],
+            **summary(results)
+        })
+    
+    def lines():
+        results = {}
+        try:
+            for index, result in items:
+                results[index] = result
+                yield json.dumps({"index": index, **_batch_item(result)}, ensure_ascii=False) + "\n"
+        finally:
+            items.close()
+        
+        save(results)
+        yield json.dumps({"done": True, **summary(results)}, ensure_ascii=False) + "\n"
+    
+    return Response(
+        stream_with_context(lines()),
+        mimetype="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+def _batch_item(result: dict) -> dict:
+    """Campos de um resultado do lote expostos na API"""
+    item = {
+        "success": result["success"],
+        "response": result.get("response"),
+        "model": result.get("model"),
+        "type": result.get("type"),
+        **_answer_meta(result)
+    }
+    if not result["success"]:
+        item["error"] = result.get("error")
+        if result.get("status"):
+            item["status"] = result["status"]
+    if result.get("cached"):
+        item["cached"] = True
+    return item
+
+
+def _read_chat_request():
+    """
+    Lê a mensagem de um POST do chat (formulário, JSON ou imagem)
+    
+    Returns:
+        Tupla (dados, erro) - dados com message, model, session_id e ollama_url;
+        erro é uma resposta JSON pronta quando a requisição é inválida
+    """
+    if 'image' in request.files and request.files['image'].filename:
+        image_file = request.files['image']
+        extraction_mode = request.form.get('mode', 'text')
+        
+        crop_box = None
+        if all(k in request.form for k in ['crop_x1', 'crop_y1', 'crop_x2', 'crop_y2']):
+            crop_box = (
+                int(request.form['crop_x1']),
+                int(request.form['crop_y1']),
+                int(request.form['crop_x2']),
+                int(request.form['crop_y2'])
+            )
+        
+        with stage("ocr"):
+            extraction_result = process_image(image_file, mode=extraction_mode, crop_box=crop_box)
+        
+        if not extraction_result["success"]:
+            return None, (jsonify({"error": extraction_result["error"]}), 400)
+        
+        if extraction_result["type"] == "latex":
+            user_message = f"Explique esta fórmula: {extraction_result['content']}"
+        else:
+            user_message = extraction_result["content"]
+        
+        model_type = request.form.get("model", "gemini")
+        session_id = request.form.get("session_id") or chat_history_service.create_session_id()
+    
+    else:
+        if request.is_json:
+            data = request.get_json()
+            user_message = data.get("message", "").strip()
+            model_type = data.get("model", "gemini")
+            session_id = data.get("session_id") or chat_history_service.create_session_id()
+        else:
+            user_message = request.form.get("message", "").strip()
+            model_type = request.form.get("model", "gemini")
+            session_id = request.form.get("session_id") or chat_history_service.create_session_id()
+        
+        if not user_message:
+            return None, (jsonify({"error": "Mensagem vazia"}), 400)
+    
+    return {
+        "message": user_message,
+        "model": model_type,
+        "session_id": session_id,
+        "ollama_url": request.form.get("ollama_url", None)
+    }, None
+
+
+def _build_chat_context(user_id: int, message: str = None, session_id: str = None):
+    """
+    Monta o contexto da conversa a partir do histórico recente
+    Com SUMMARY_ENABLED, usa o resumo da sessão e os turnos ainda não resumidos;
+    com RETRIEVAL_ENABLED, só os últimos turnos entram por ordem e os demais
+    são os turnos antigos mais parecidos com a pergunta (embeddings)
+    
+    Returns:
+        Tupla (contexto em texto, ConversationHistory com os turnos (mensagem, resposta)
+        do mais antigo ao mais recente e o resumo da sessão)
+    """
+    summary = None
+    with stage("history"):
+        if session_summarizer.enabled and session_id:
+            summary, recent_history = session_summarizer.context_for(user_id, session_id)
+        else:
+            limit = RETRIEVAL_RECENT_TURNS if context_retriever.enabled else 5
+            recent_history = list(reversed(chat_history_service.get_recent_history(user_id, hours=2, limit=limit)))
+    
+    relevant = []
+    if message and context_retriever.enabled:
+        try:
+            with stage("retrieval"):
+                relevant = context_retriever.select(user_id, message, recent_history)
+        except Exception as e:
+            app.logger.error(f"Erro ao buscar contexto relevante: {str(e)}")
+    
+    history = ConversationHistory([(h.message, h.response) for h in relevant + recent_history], summary)
+    if relevant or summary:
+        return render_context(history, summary), history
+    # Só os turnos recentes: o texto montado fica na cache de contexto junto com eles
+    return chat_history_service.recent_context(user_id, recent_history, lambda: render_context(history)), history
+
+
+def _label_chat_request(model_type: str, channel: str = None):
+    """Labels da requisição nas métricas (modelo e backend online/local)"""
+    label_request(
+        model=model_type,
+        backend="online" if model_type == "gemini" else "local",
+        channel=channel
+    )
+
+
+def _answer_meta(result: dict) -> dict:
+    """
+    Backend que respondeu, tokens do prompt enviado (ausente se a resposta veio
+    do cache ou de outro pedido idêntico) e, se a resposta veio do fallback, o
+    modelo pedido (as métricas da requisição passam a contar o backend que respondeu)
+    """
+    meta = {"backend": result.get("backend")}
+    prompt_tokens = request_annotation("prompt_tokens")
+    if prompt_tokens is not None:
+        meta["prompt_tokens"] = prompt_tokens
+    if result.get("fallback_from"):
+        meta["fallback_from"] = result["fallback_from"]
+        label_request(backend="online" if result.get("type") == "online" else "local")
+    return meta
+
+
+def _generation_error(result: dict):
+    """
+    Resposta JSON de erro da geração
+    Recusas do controlo de admissão saem como 429/503 com Retry-After
+    """
+    count_error("rejected" if result.get("status") in (429, 503) else "generation")
+    response = jsonify({"error": result.get("error", "Erro ao gerar resposta")})
+    response.status_code = result.get("status", 500)
+    if result.get("retry_after"):
+        response.headers["Retry-After"] = str(result["retry_after"])
+    return response
+
+
+def _sse_event(event: str, data: dict) -> str:
+    """Formata um evento Server-Sent Events"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 
 @app.route("/api/extraction-status", methods=["GET"])
@@ -325,12 +743,121 @@ def get_available_models_api():
         }), 200
 
 
+@app.route("/api/models/status", methods=["GET"])
+@login_required
+def models_status():
+    """API: Estado do catálogo de modelos de cada servidor Ollama"""
+    return jsonify({
+        "catalogs": model_catalog.status(),
+        "ttl": model_catalog.ttl,
+        "http_pool": ollama_http.status(),
+        "ollama_pool": ollama_pool.status(),
+        "ollama_sessions": ollama_sessions.stats(),
+        "backends": chatbot_registry.status(),
+        "coalescing": request_coalescer.stats(),
+        "admission": admission.stats(),
+        "circuit_breakers": circuit_breakers.stats(),
+        "retrieval": context_retriever.stats(),
+        "summaries": session_summarizer.stats(),
+        "prompts": prompt_builder.stats(),
+        "history": chat_history_service.stats(),
+        "retention": history_purger.stats(),
+        "usage_counters": usage_counters.stats(),
+        "archive": history_archive.stats(),
+        "context_cache": context_cache.stats()
+    })
+
+
+@app.route("/api/models/reload", methods=["POST"])
+@login_required
+@auth_role("admin")
+def reload_models():
+    """API: Descarta backends e catálogos em cache após mudança de configuração"""
+    data = request.get_json(silent=True) or {}
+    ollama_url = data.get("ollama_url")
+    
+    model_catalog.invalidate(ollama_url)
+    removed = reset_backends(ollama_url)
+    
+    return jsonify({
+        "success": True,
+        "removed": removed
+    })
+
+
+@app.route("/api/cache/stats", methods=["GET"])
+@login_required
+def cache_stats():
+    """API: Contadores do cache de respostas (hits, misses, ocupação)"""
+    return jsonify(response_cache.stats())
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """
+    Métricas no formato de texto Prometheus
+    Com METRICS_TOKEN definido, exige "Authorization: Bearer <token>"
+    """
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return Response("Não autorizado\n", status=401, mimetype="text/plain")
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+
+def _service_metrics():
+    """Contadores e estados mantidos pelos serviços, lidos a cada coleta do /metrics"""
+    cache = response_cache.stats()
+    yield "chatbot_response_cache_hits_total", "counter", "Respostas servidas pelo cache", [({}, cache["hits"])]
+    yield "chatbot_response_cache_misses_total", "counter", "Consultas ao cache sem resposta guardada", [({}, cache["misses"])]
+    yield "chatbot_response_cache_errors_total", "counter", "Erros do backend de cache", [({}, cache["errors"])]
+    
+    coalescing = request_coalescer.stats()
+    yield "chatbot_coalesced_requests_total", "counter", "Pedidos atendidos pela geração de outro pedido idêntico", [
+        ({"mode": "blocking"}, coalescing["coalesced"]),
+        ({"mode": "stream"}, coalescing["stream_coalesced"])
+    ]
+    
+    limiters = admission.stats()["backends"]
+    yield "chatbot_admission_in_flight", "gauge", "Gerações em andamento por backend", [
+        ({"backend": name}, stats["in_flight"]) for name, stats in limiters.items()
+    ]
+    yield "chatbot_admission_queue_depth", "gauge", "Pedidos à espera de vaga por backend", [
+        ({"backend": name}, stats["queue_depth"]) for name, stats in limiters.items()
+    ]
+    yield "chatbot_admission_rejected_total", "counter", "Pedidos recusados pelo controlo de admissão", [
+        sample
+        for name, stats in limiters.items()
+        for sample in (
+            ({"backend": name, "reason": "queue_full"}, stats["rejected_queue_full"]),
+            ({"backend": name, "reason": "timeout"}, stats["rejected_timeout"])
+        )
+    ]
+    
+    breakers = circuit_breakers.stats()["backends"]
+    states = {"closed": 0, "half_open": 1, "open": 2}
+    yield "chatbot_circuit_state", "gauge", "Estado do circuito por backend (0 fechado, 1 meio-aberto, 2 aberto)", [
+        ({"backend": name}, states[stats["state"]]) for name, stats in breakers.items()
+    ]
+    yield "chatbot_circuit_opened_total", "counter", "Vezes que o circuito do backend abriu", [
+        ({"backend": name}, stats["opened"]) for name, stats in breakers.items()
+    ]
+    yield "chatbot_circuit_rejected_total", "counter", "Chamadas recusadas de imediato com o circuito aberto", [
+        ({"backend": name}, stats["rejected"]) for name, stats in breakers.items()
+    ]
+    
+    yield "chatbot_ollama_node_healthy", "gauge", "Nós do pool Ollama em rotação (1) ou fora (0)", [
+        ({"node": url}, 1 if node["healthy"] else 0) for url, node in ollama_pool.status().items()
+    ]
+
+
+metrics.register_collector(_service_metrics)
+
+
 @app.route('/whatsapp', methods=['POST'])
 @csrf.exempt
-def whatsapp_webhook():
+async def whatsapp_webhook():
     """
     Webhook do Twilio para integração com WhatsApp.
-    Usa o Gemini via unified_chatbot com as mesmas regras de negócio do /chatbot.
+    Usa o Gemini via camada assíncrona do chatbot com as mesmas regras de negócio do /chatbot.
     """
     if not TWILIO_AVAILABLE:
         return "Twilio não configurado", 500
@@ -346,27 +873,26 @@ def whatsapp_webhook():
             return str(response)
         
         session_id = from_number.replace('whatsapp:', '').replace('+', '').replace(' ', '')
+        _label_chat_request("gemini")
         
         """
         Busca histórico recente (usando session_id como user_id temporário)
         Nota: Para produção, você pode querer criar um usuário específico para WhatsApp
         """
         try:
-            from app.models.tables import ChatHistory
-            recent_messages = ChatHistory.query.filter_by(
-                session_id=session_id
-            ).order_by(
-                ChatHistory.timestamp.desc()
-            ).limit(5).all()
+            with stage("history"):
+                if session_summarizer.enabled:
+                    # Conversas do WhatsApp não têm fim: resumo + turnos recentes mantém o prompt estável
+                    summary, recent_messages = session_summarizer.context_for(1, session_id)
+                else:
+                    summary = None
+                    recent_messages = chat_history_service.get_session_history(session_id, limit=5)
             
-            context = "\n".join([
-                f"User: {h.message}\nBot: {h.response}" 
-                for h in reversed(recent_messages)
-            ])
+            context = render_context([(h.message, h.response) for h in recent_messages], summary)
         except:
             context = ""
         
-        result = generate_response(
+        result = await generate_response_async(
             message=user_message,
             model_type="gemini",
             ollama_url=None,
@@ -374,6 +900,7 @@ def whatsapp_webhook():
         )
         
         if not result["success"]:
+            count_error("rejected" if result.get("status") in (429, 503) else "generation")
             error_msg = "Desculpe, não consegui processar sua mensagem no momento. Tente novamente."
             response.message(error_msg)
             return str(response)
@@ -382,21 +909,24 @@ def whatsapp_webhook():
         Formata resposta especificamente para WhatsApp
         Converte Markdown para formato WhatsApp, limita tamanho e melhora legibilidade
         """
-        bot_response = format_for_whatsapp(result["response"], max_length=1500)
+        with stage("format"):
+            bot_response = format_for_whatsapp(result["response"], max_length=1500)
         
         try:
             # TODO Cria um registro genérico para WhatsApp
             # TODO Se quiser associar a um utilizador real, você precisará implementar
             # TODO um sistema de autenticação via WhatsApp
-            chat_history_service.save_message(
-                user_id=1,  # User ID genérico para WhatsApp (você pode criar um Utilizador "WhatsApp Bot")
-                message=user_message,
-                response=result["response"],
-                model_used=result["model"],
-                service_type="whatsapp",
-                session_id=session_id  # Usa número do telefone como session_id
-            )
+            with stage("save"):
+                chat_history_service.save_message(
+                    user_id=1,  # User ID genérico para WhatsApp (você pode criar um Utilizador "WhatsApp Bot")
+                    message=user_message,
+                    response=result["response"],
+                    model_used=result["model"],
+                    service_type="whatsapp",
+                    session_id=session_id  # Usa número do telefone como session_id
+                )
         except Exception as e:
+            count_error("save")
             app.logger.error(f"Erro ao salvar histórico WhatsApp: {str(e)}")
         
         response.message(bot_response)
@@ -404,6 +934,7 @@ def whatsapp_webhook():
         return str(response)
         
     except Exception as e:
+        count_error("exception")
         app.logger.error(f"Erro no webhook WhatsApp: {str(e)}")
         response = MessagingResponse()
         response.message("Desculpe, ocorreu um erro. Por favor, tente novamente.")
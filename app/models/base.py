@@ -1,10 +1,16 @@
 from app import db
 from datetime import datetime, timezone
 
+
+def utcnow():
+    """Data/hora atual em UTC sem fuso (o formato guardado nas colunas DateTime)"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
 class TimeStampedModel(db.Model):
     __abstract__ = True
 
-    created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
-    updated_at = db.Column(db.DateTime, onupdate=datetime.now(timezone.utc))
+    # Callable: avaliado em cada INSERT/UPDATE (não uma vez ao importar o módulo)
+    created_at = db.Column(db.DateTime, default=utcnow)
+    updated_at = db.Column(db.DateTime, onupdate=utcnow)
     deleted_at = db.Column(db.DateTime, nullable=True)
-    
\ No newline at end of file
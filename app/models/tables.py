@@ -30,6 +30,8 @@ class User(UserMixin, TimeStampedModel, db.Model):
         return str(self.id)
     
     chat_history = db.relationship('ChatHistory', back_populates='user', cascade='all, delete-orphan', lazy='dynamic')
+    session_summaries = db.relationship('SessionSummary', back_populates='user', cascade='all, delete-orphan', lazy='dynamic')
+    usage_counters = db.relationship('UsageCounter', back_populates='user', cascade='all, delete-orphan', lazy='dynamic')
     roles = db.relationship('Role', secondary='user_roles', back_populates='users')
 
     def __init__(self, name, email, password, tel, profile_image=None):
@@ -74,6 +76,11 @@ class ChatHistory(TimeStampedModel, db.Model):
     Preparado para migração futura para Redis
     """
     __tablename__ = "chat_history"
+    # Histórico por utilizador/sessão ordenado por data: busca no índice, sem ordenação
+    __table_args__ = (
+        db.Index("ix_chat_history_user_created", "user_id", "created_at"),
+        db.Index("ix_chat_history_session_created", "session_id", "created_at"),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
@@ -109,4 +116,76 @@ class ChatHistory(TimeStampedModel, db.Model):
 
     def __repr__(self):
         return f"{self.__class__.__name__}, id: {self.id}, user: {self.user_id}"
-    
\ No newline at end of file
+    
+
+
+class SessionSummary(TimeStampedModel, db.Model):
+    """Resumo acumulado de uma sessão de chat
+    Os turnos até last_chat_id estão comprimidos no resumo; os seguintes entram no prompt por extenso
+    """
+    __tablename__ = "session_summaries"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    session_id = db.Column(db.String(100), unique=True, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    summary = db.Column(db.Text, nullable=False)
+    last_chat_id = db.Column(db.Integer, nullable=False)
+    turns = db.Column(db.Integer, nullable=False, default=0)
+    model_used = db.Column(db.String(50), nullable=True)
+
+    user = db.relationship("User", back_populates="session_summaries")
+
+    def __init__(self, session_id, user_id, summary, last_chat_id, turns=0, model_used=None):
+        self.session_id = session_id
+        self.user_id = user_id
+        self.summary = summary
+        self.last_chat_id = last_chat_id
+        self.turns = turns
+        self.model_used = model_used
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'session_id': self.session_id,
+            'user_id': self.user_id,
+            'summary': self.summary,
+            'last_chat_id': self.last_chat_id,
+            'turns': self.turns,
+            'model_used': self.model_used,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}, session: {self.session_id}, turns: {self.turns}"
+
+
+class UsageCounter(TimeStampedModel, db.Model):
+    """Mensagens por utilizador × modelo × tipo de serviço, no total e por dia
+    Mantido a cada gravação/remoção do histórico; period é "total" ou a data (AAAA-MM-DD)
+    """
+    __tablename__ = "usage_counters"
+    __table_args__ = (
+        db.UniqueConstraint("user_id", "period", "model_used", "service_type", name="uq_usage_counters_key"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    period = db.Column(db.String(10), nullable=False)
+    # '' em vez de NULL: a chave única trata NULL de forma diferente no SQLite e no SQL Server
+    model_used = db.Column(db.String(50), nullable=False, default='')
+    service_type = db.Column(db.String(20), nullable=False, default='')
+    messages = db.Column(db.Integer, nullable=False, default=0)
+
+    user = db.relationship("User", back_populates="usage_counters")
+
+    def to_dict(self):
+        return {
+            'period': self.period,
+            'model_used': self.model_used or None,
+            'service_type': self.service_type or None,
+            'messages': self.messages
+        }
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}, user: {self.user_id}, {self.period}: {self.messages}"
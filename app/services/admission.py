@@ -0,0 +1,197 @@
+"""
+Controlo de admissão (backpressure) para os backends de modelos
+Limita gerações concorrentes por backend com uma fila de espera limitada;
+quando a fila enche ou a espera passa do limite, rejeita logo (429/503 + Retry-After)
+"""
+import os
+import math
+import time
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any
+from dotenv import load_dotenv
+
+from app.services.metrics import stage
+
+load_dotenv()
+
+ADMISSION_ENABLED = os.environ.get("ADMISSION_ENABLED", "True").lower() == "true"
+ADMISSION_GEMINI_CONCURRENCY = int(os.environ.get("ADMISSION_GEMINI_CONCURRENCY", "16"))
+ADMISSION_OLLAMA_CONCURRENCY = int(os.environ.get("ADMISSION_OLLAMA_CONCURRENCY", "4"))
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", "32"))
+ADMISSION_MAX_WAIT = float(os.environ.get("ADMISSION_MAX_WAIT", "15"))
+
+
+class AdmissionRejected(Exception):
+    """Requisição recusada pelo controlo de admissão"""
+
+    def __init__(self, backend: str, status_code: int, retry_after: int, reason: str):
+        super().__init__(f"Backend {backend} sobrecarregado: {reason}")
+        self.backend = backend
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class _BackendLimiter:
+    """Semáforo com fila de espera limitada e métricas de um backend"""
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int, max_wait: float):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.cond = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.avg_hold = 1.0
+
+    def check(self):
+        """Verificação rápida (sem reservar vaga): rejeita se a fila já está cheia"""
+        with self.cond:
+            if self.in_flight >= self.max_concurrency and self.waiting >= self.max_queue:
+                self.rejected_queue_full += 1
+                raise AdmissionRejected(self.name, 429, self.retry_after(), "fila de espera cheia")
+
+    def acquire(self):
+        start = time.monotonic()
+        with self.cond:
+            if self.in_flight < self.max_concurrency and self.waiting == 0:
+                self._admit(0.0)
+                return
+
+            if self.waiting >= self.max_queue:
+                self.rejected_queue_full += 1
+                raise AdmissionRejected(self.name, 429, self.retry_after(), "fila de espera cheia")
+
+            self.waiting += 1
+            deadline = start + self.max_wait
+            try:
+                while self.in_flight >= self.max_concurrency:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected_timeout += 1
+                        raise AdmissionRejected(self.name, 503, self.retry_after(), "tempo máximo de espera na fila excedido")
+                    self.cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+
+            self._admit(time.monotonic() - start)
+
+    def release(self, held: float):
+        with self.cond:
+            self.in_flight -= 1
+            self.avg_hold = 0.8 * self.avg_hold + 0.2 * held
+            self.cond.notify()
+
+    def retry_after(self) -> int:
+        """Estimativa (segundos) de quando a fila atual terá sido atendida"""
+        backlog = self.waiting + 1
+        return max(1, math.ceil(self.avg_hold * backlog / self.max_concurrency))
+
+    def stats(self) -> Dict[str, Any]:
+        with self.cond:
+            return {
+                "max_concurrency": self.max_concurrency,
+                "max_queue": self.max_queue,
+                "max_wait": self.max_wait,
+                "in_flight": self.in_flight,
+                "queue_depth": self.waiting,
+                "admitted": self.admitted,
+                "rejected_queue_full": self.rejected_queue_full,
+                "rejected_timeout": self.rejected_timeout,
+                "wait_avg": round(self.wait_total / self.admitted, 4) if self.admitted else 0.0,
+                "wait_max": round(self.wait_max, 4),
+                "hold_avg": round(self.avg_hold, 4)
+            }
+
+    def _admit(self, waited: float):
+        self.in_flight += 1
+        self.admitted += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+
+class AdmissionController:
+    """Limitadores por backend ("gemini", "ollama:<url>", "ollama:pool")"""
+
+    def __init__(
+        self,
+        enabled: bool = ADMISSION_ENABLED,
+        gemini_concurrency: int = ADMISSION_GEMINI_CONCURRENCY,
+        ollama_concurrency: int = ADMISSION_OLLAMA_CONCURRENCY,
+        max_queue: int = ADMISSION_MAX_QUEUE,
+        max_wait: float = ADMISSION_MAX_WAIT
+    ):
+        self.enabled = enabled
+        self.gemini_concurrency = gemini_concurrency
+        self.ollama_concurrency = ollama_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._limiters: Dict[str, _BackendLimiter] = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, backend: str, nodes: int = 1) -> _BackendLimiter:
+        limiter = self._limiters.get(backend)
+        if limiter is not None:
+            return limiter
+
+        with self._lock:
+            limiter = self._limiters.get(backend)
+            if limiter is None:
+                concurrency = self.gemini_concurrency if backend == "gemini" else self.ollama_concurrency * max(1, nodes)
+                limiter = _BackendLimiter(backend, concurrency, self.max_queue, self.max_wait)
+                self._limiters[backend] = limiter
+            return limiter
+
+    def check(self, backend: str, nodes: int = 1):
+        """Rejeita de imediato (AdmissionRejected) se a fila do backend está cheia"""
+        if self.enabled:
+            self.limiter(backend, nodes).check()
+
+    def acquire(self, backend: str, nodes: int = 1) -> float:
+        """Espera por uma vaga (ou levanta AdmissionRejected); retorna o instante da admissão"""
+        if self.enabled:
+            with stage("queue"):
+                self.limiter(backend, nodes).acquire()
+        return time.monotonic()
+
+    def release(self, backend: str, admitted_at: float):
+        if self.enabled:
+            self.limiter(backend).release(time.monotonic() - admitted_at)
+
+    @contextmanager
+    def slot(self, backend: str, nodes: int = 1):
+        """Mantém uma vaga do backend durante o bloco"""
+        admitted_at = self.acquire(backend, nodes)
+        try:
+            yield
+        finally:
+            self.release(backend, admitted_at)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            limiters = list(self._limiters.values())
+        return {
+            "enabled": self.enabled,
+            "backends": {limiter.name: limiter.stats() for limiter in limiters}
+        }
+
+
+def rejection_result(error: AdmissionRejected) -> Dict[str, Any]:
+    """Resultado de falha (formato do chatbot) para uma requisição recusada"""
+    return {
+        "success": False,
+        "error": "Servidor ocupado, tente novamente em instantes",
+        "response": None,
+        "status": error.status_code,
+        "retry_after": error.retry_after
+    }
+
+
+admission = AdmissionController()
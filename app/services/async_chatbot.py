@@ -0,0 +1,361 @@
+"""
+Camada assíncrona do chatbot (asyncio)
+Ollama via aiohttp e Gemini via cliente assíncrono, ao lado da interface síncrona
+"""
+import json
+import asyncio
+import weakref
+import aiohttp
+from typing import Dict, Any, AsyncIterator, List, Tuple
+
+from app.services.ollama_http import OLLAMA_POOL_SIZE, OLLAMA_CONNECT_TIMEOUT, OLLAMA_TIMEOUT
+from app.services.ollama_pool import ollama_pool, is_node_failure
+from app.services.ollama_sessions import ollama_sessions
+from app.services.response_cache import response_cache
+from app.services.admission import admission, AdmissionRejected, rejection_result
+from app.services.circuit_breaker import circuit_breakers, CircuitOpen, circuit_open_result
+from app.services.metrics import stage, count_timeout, is_timeout
+from app.services.unified_chatbot import UnifiedChatbot, get_chatbot
+
+
+class AsyncOllamaHTTP:
+    """
+    Sessões aiohttp (pool keep-alive) por event loop e URL Ollama
+
+    Uma ClientSession só pode ser usada no loop onde foi criada, por isso
+    o cache é por loop. Em views async do Flask (um loop por requisição)
+    chame close_loop_sessions() ao final; em servidores ASGI chame no shutdown.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = OLLAMA_POOL_SIZE,
+        connect_timeout: float = OLLAMA_CONNECT_TIMEOUT,
+        read_timeout: float = OLLAMA_TIMEOUT
+    ):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, aiohttp.ClientSession]]" = weakref.WeakKeyDictionary()
+
+    def session(self, ollama_url: str) -> aiohttp.ClientSession:
+        """Retorna a sessão da URL no loop atual (deve ser chamado dentro do loop)"""
+        loop = asyncio.get_running_loop()
+        sessions = self._sessions.setdefault(loop, {})
+        url = ollama_url.rstrip('/')
+
+        session = sessions.get(url)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+            )
+            sessions[url] = session
+        return session
+
+    async def close_loop_sessions(self):
+        """Fecha as sessões criadas no loop atual"""
+        sessions = self._sessions.pop(asyncio.get_running_loop(), {})
+        for session in sessions.values():
+            await session.close()
+
+
+async_ollama_http = AsyncOllamaHTTP()
+
+
+class AsyncUnifiedChatbot:
+    """
+    Interface assíncrona sobre um UnifiedChatbot
+
+    Reaproveita do bot síncrono a resolução de modelos (catálogo), a montagem
+    de prompts e o cache; apenas as chamadas de rede passam a ser awaitables.
+    """
+
+    def __init__(self, bot: UnifiedChatbot):
+        self.bot = bot
+
+    async def generate_response(
+        self,
+        message: str,
+        context: str = "",
+        history: List[Tuple[str, str]] = None,
+        session_id: str = None,
+        allow_fallback: bool = True
+    ) -> Dict[str, Any]:
+        """
+        Gera resposta usando o modelo configurado
+
+        Args:
+            message: Mensagem do usuário
+            context: Contexto adicional
+            history: Turnos anteriores (mensagem, resposta), do mais antigo ao mais recente
+            session_id: Sessão da conversa (reaproveitamento do KV cache no Ollama)
+            allow_fallback: Tentar os modelos de MODEL_FALLBACKS se o backend falhar
+
+        Returns:
+            Dict com response e metadata (mesmo formato da versão síncrona)
+        """
+        result = await self._generate_response(message, context, history, session_id)
+        for model_type in self.bot._fallback_models(result) if allow_fallback else []:
+            fallback = await get_async_chatbot(model_type, self.bot.ollama_url).generate_response(
+                message, context, history, session_id, allow_fallback=False
+            )
+            if fallback["success"]:
+                return self.bot._fallback_result(fallback, result)
+        return result
+
+    async def _generate_response(
+        self,
+        message: str,
+        context: str = "",
+        history: List[Tuple[str, str]] = None,
+        session_id: str = None
+    ) -> Dict[str, Any]:
+        # A primeira consulta de uma URL no catálogo faz um probe bloqueante
+        model_config, error = await asyncio.to_thread(self.bot._resolve_model, message)
+        if error:
+            return error
+
+        cache_key = None
+        if response_cache.is_cacheable(self.bot.model_type):
+            cache_key = self.bot._request_key(message, model_config, context)
+            cached = response_cache.get(cache_key)
+            if cached:
+                return {"success": True, **cached, "cached": True}
+
+        backend, nodes = self.bot._admission_backend(model_config)
+        try:
+            circuit_breakers.check(backend)
+            # A espera na fila de admissão é bloqueante, por isso corre numa thread
+            admitted_at = await asyncio.to_thread(admission.acquire, backend, nodes)
+        except CircuitOpen as e:
+            return circuit_open_result(e)
+        except AdmissionRejected as e:
+            return {**rejection_result(e), "backend": backend}
+        
+        try:
+            with stage("llm"), circuit_breakers.call(backend):
+                if self.bot.model_type == "gemini":
+                    response = await self._generate_with_gemini(message, context)
+                elif model_config["type"] == "local":
+                    response = await self._generate_with_ollama(
+                        message, model_config["ollama_name"], context, history, session_id
+                    )
+                else:
+                    raise ValueError(f"Tipo de modelo desconhecido: {model_config.get('type')}")
+        except CircuitOpen as e:
+            return circuit_open_result(e)
+        except Exception:
+            response = None
+        finally:
+            admission.release(backend, admitted_at)
+
+        if not response:
+            return {
+                "success": False,
+                "error": f"Falha ao gerar resposta com modelo {model_config.get('ollama_name') or self.bot.model_type}",
+                "response": None,
+                "backend": backend
+            }
+
+        result = {
+            "success": True,
+            "response": response,
+            "model": model_config["name"],
+            "type": model_config["type"],
+            "backend": backend
+        }
+        if cache_key:
+            response_cache.set(cache_key, result)
+        return result
+
+    async def stream_response(
+        self,
+        message: str,
+        context: str = "",
+        history: List[Tuple[str, str]] = None,
+        session_id: str = None
+    ) -> Dict[str, Any]:
+        """
+        Gera resposta em streaming
+
+        Returns:
+            Dict com metadata e "stream": iterador assíncrono de pedaços de texto
+        """
+        model_config, error = await asyncio.to_thread(self.bot._resolve_model, message)
+        if error:
+            return error
+
+        backend, _ = self.bot._admission_backend(model_config)
+        try:
+            circuit_breakers.check(backend)
+        except CircuitOpen as e:
+            return circuit_open_result(e)
+
+        if self.bot.model_type == "gemini":
+            stream = self._stream_with_gemini(message, context)
+        elif model_config["type"] == "local":
+            stream = self._stream_with_ollama(message, model_config["ollama_name"], context, history, session_id)
+        else:
+            return {
+                "success": False,
+                "error": f"Tipo de modelo desconhecido: {model_config.get('type')}",
+                "response": None
+            }
+
+        return {
+            "success": True,
+            "stream": stream,
+            "model": model_config["name"],
+            "type": model_config["type"],
+            "backend": backend
+        }
+
+    async def _generate_with_gemini(self, message: str, context: str = "") -> str:
+        full_prompt, prompt = self.bot._build_gemini_prompt(message, context)
+        try:
+            response = await self.bot.gemini_model.generate_content_async(full_prompt)
+        except Exception as e:
+            if is_timeout(e):
+                count_timeout("online")
+            print(f"Erro ao gerar resposta com Gemini (async): {e}")
+            raise
+
+        self.bot._observe_gemini_usage(prompt, getattr(response, "usage_metadata", None))
+        try:
+            return response.text if response else None
+        except ValueError:
+            return None
+
+    async def _generate_with_ollama(
+        self,
+        message: str,
+        model_name: str,
+        context: str = "",
+        history: List[Tuple[str, str]] = None,
+        session_id: str = None
+    ) -> str:
+        if not self.bot.ollama_url and not ollama_pool.configured:
+            return None
+
+        try:
+            with self.bot._ollama_lease(model_name, session_id) as lease:
+                session = async_ollama_http.session(lease.url)
+                path, payload, prompt = self.bot._build_ollama_request(message, model_name, context, history, session_id)
+
+                try:
+                    async with session.post(f"{lease.url}{path}", json=payload) as response:
+                        if response.status != 200:
+                            if is_node_failure(status_code=response.status):
+                                lease.fail(f"HTTP {response.status}")
+                            raise RuntimeError(f"Erro na API Ollama: {response.status}")
+                        result = await response.json()
+                        self.bot._observe_ollama_usage(prompt, payload, result)
+                        text = self.bot._ollama_text(result).strip()
+                        if text:
+                            ollama_sessions.remember(session_id, model_name, lease.url, text, result.get("context"))
+                        return text
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    lease.fail(str(e) or e.__class__.__name__)
+                    raise
+
+        except asyncio.TimeoutError:
+            count_timeout("local")
+            print("Timeout na requisição Ollama")
+            raise
+        except Exception as e:
+            print(f"Erro ao gerar resposta com Ollama (async): {e}")
+            raise
+
+    async def _stream_with_gemini(self, message: str, context: str = "") -> AsyncIterator[str]:
+        full_prompt, prompt = self.bot._build_gemini_prompt(message, context)
+        response = await self.bot.gemini_model.generate_content_async(full_prompt, stream=True)
+        usage = None
+        async for chunk in response:
+            usage = getattr(chunk, "usage_metadata", None) or usage
+            try:
+                text = chunk.text
+            except ValueError:
+                continue
+            if text:
+                yield text
+        self.bot._observe_gemini_usage(prompt, usage)
+
+    async def _stream_with_ollama(
+        self,
+        message: str,
+        model_name: str,
+        context: str = "",
+        history: List[Tuple[str, str]] = None,
+        session_id: str = None
+    ) -> AsyncIterator[str]:
+        """Sair do gerador (aclose) fecha a conexão e interrompe a geração no Ollama"""
+        with self.bot._ollama_lease(model_name, session_id) as lease:
+            session = async_ollama_http.session(lease.url)
+            path, payload, prompt = self.bot._build_ollama_request(message, model_name, context, history, session_id, stream=True)
+            chunks = []
+
+            try:
+                async with session.post(f"{lease.url}{path}", json=payload) as response:
+                    if response.status != 200:
+                        if is_node_failure(status_code=response.status):
+                            lease.fail(f"HTTP {response.status}")
+                        raise RuntimeError(f"Erro na API Ollama: {response.status}")
+
+                    async for line in response.content:
+                        if not line.strip():
+                            continue
+                        data = json.loads(line)
+                        if data.get("error"):
+                            raise RuntimeError(data["error"])
+                        token = self.bot._ollama_text(data)
+                        if token:
+                            chunks.append(token)
+                            yield token
+                        if data.get("done"):
+                            self.bot._observe_ollama_usage(prompt, payload, data)
+                            ollama_sessions.remember(session_id, model_name, lease.url, "".join(chunks).strip(), data.get("context"))
+                            break
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                lease.fail(str(e) or e.__class__.__name__)
+                raise
+
+
+def get_async_chatbot(model_type: str = None, ollama_url: str = None) -> AsyncUnifiedChatbot:
+    """Interface assíncrona sobre a instância partilhada do chatbot"""
+    return AsyncUnifiedChatbot(get_chatbot(model_type, ollama_url))
+
+
+async def generate_response_async(
+    message: str,
+    model_type: str = None,
+    ollama_url: str = None,
+    context: str = "",
+    history: List[Tuple[str, str]] = None,
+    session_id: str = None
+) -> Dict[str, Any]:
+    """
+    Versão assíncrona de generate_response (para views async do Flask ou ASGI)
+
+    Args:
+        message: Mensagem do usuário
+        model_type: Tipo do modelo a usar
+        ollama_url: URL do servidor Ollama (para modelos locais)
+        context: Contexto adicional
+        history: Turnos anteriores (mensagem, resposta), do mais antigo ao mais recente
+        session_id: Sessão da conversa
+
+    Returns:
+        Dict com response e metadata
+    """
+    try:
+        bot = get_async_chatbot(model_type, ollama_url)
+        return await bot.generate_response(message, context, history, session_id)
+    except Exception as e:
+        return {
+            "success": False,
+            "error": f"Erro ao processar: {str(e)}",
+            "response": None,
+            "model": model_type or "unknown",
+            "type": "error"
+        }
@@ -0,0 +1,95 @@
+"""
+Registro de backends de chatbot
+Mantém uma instância de longa duração por (provider, modelo, url),
+reutilizada entre requisições e threads
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Any, Optional, Tuple
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BACKEND_REGISTRY_MAX = int(os.environ.get("BACKEND_REGISTRY_MAX", "128"))
+
+
+def backend_provider(model_type: str) -> str:
+    """Provider de um model_type (gemini ou ollama)"""
+    return "gemini" if model_type == "gemini" else "ollama"
+
+
+class BackendRegistry:
+    """
+    Cache thread-safe de instâncias de backend (ex: UnifiedChatbot)
+
+    As instâncias são criadas pela factory uma única vez por chave e
+    descartadas apenas por invalidação explícita ou quando o limite
+    de entradas é atingido (a menos usada recentemente sai primeiro).
+    """
+
+    def __init__(self, factory: Callable[[str, Optional[str]], Any], max_size: int = BACKEND_REGISTRY_MAX):
+        self.factory = factory
+        self.max_size = max_size
+        self._instances: "OrderedDict[Tuple[str, str, Optional[str]], Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    @staticmethod
+    def make_key(model_type: str, ollama_url: str = None) -> Tuple[str, str, Optional[str]]:
+        url = ollama_url.rstrip('/') if ollama_url else None
+        return (backend_provider(model_type), model_type, url)
+
+    def get(self, model_type: str, ollama_url: str = None) -> Any:
+        """Retorna a instância da chave, criando-a na primeira vez"""
+        key = self.make_key(model_type, ollama_url)
+
+        with self._lock:
+            instance = self._instances.get(key)
+            if instance is not None:
+                self._instances.move_to_end(key)
+                self.reused += 1
+                return instance
+
+            instance = self.factory(model_type, ollama_url)
+            self._instances[key] = instance
+            self.created += 1
+            while len(self._instances) > self.max_size:
+                self._instances.popitem(last=False)
+            return instance
+
+    def invalidate(self, provider: str = None, model_type: str = None, ollama_url: str = None) -> int:
+        """
+        Remove instâncias que correspondem aos filtros informados
+        (sem filtros remove todas). Usar quando a configuração muda.
+
+        Returns:
+            Número de instâncias removidas
+        """
+        url = ollama_url.rstrip('/') if ollama_url else None
+
+        with self._lock:
+            keys = [
+                key for key in self._instances
+                if (provider is None or key[0] == provider)
+                and (model_type is None or key[1] == model_type)
+                and (url is None or key[2] == url)
+            ]
+            for key in keys:
+                del self._instances[key]
+            return len(keys)
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            keys = list(self._instances.keys())
+
+        return {
+            "instances": [
+                {"provider": provider, "model": model_type, "url": url}
+                for provider, model_type, url in keys
+            ],
+            "max_size": self.max_size,
+            "created": self.created,
+            "reused": self.reused
+        }
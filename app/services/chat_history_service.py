@@ -1,25 +1,79 @@
 """
 Serviço de Histórico de Chat
-Preparado para migração futura para Redis
+SQL é a fonte de verdade; com USE_REDIS os turnos recentes de cada utilizador
+e sessão ficam também em listas no Redis (write-through) e as leituras do
+caminho quente deixam de ir à base de dados. Com CONTEXT_CACHE_ENABLED os
+últimos turnos ficam ainda na memória do processo (ver context_cache). Com
+HISTORY_WRITE_BEHIND a gravação no SQL sai da requisição (fila + lotes, ver
+history_writer)
 """
 import os
+import json
+import base64
+import binascii
 from typing import List, Optional, Dict, Any
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+from sqlalchemy import and_, or_, select
 from app import db
+from app.models.base import utcnow
 from app.models.tables import ChatHistory
+from app.services.redis_client import get_redis_client, WatchError
+from app.services.history_writer import HistoryWriter, HISTORY_WRITE_BEHIND, CHAT_FIELDS, chat_from_entry
+from app.services.usage_stats import usage_counters
+from app.services.context_cache import context_cache, user_key, session_key
+from app.services.history_archive import history_archive, serialize_row, row_key, ARCHIVE_AFTER_DAYS
+from app.services.history_retention import history_purger, RETENTION_DAYS, RETENTION_SOFT_DELETE_GRACE_DAYS, RETENTION_SCHEDULE
+from app.services.context_retrieval import context_retriever
+from app.services.session_summary import session_summarizer
 import uuid
 
+load_dotenv()
+
+HISTORY_REDIS_MAX_TURNS = int(os.environ.get("HISTORY_REDIS_MAX_TURNS", "50"))
+HISTORY_REDIS_TTL = int(os.environ.get("HISTORY_REDIS_TTL", "86400"))
+HISTORY_REDIS_PREFIX = os.environ.get("HISTORY_REDIS_PREFIX", "chat:history:")
+HISTORY_PAGE_MAX = int(os.environ.get("HISTORY_PAGE_MAX", "200"))
+
+# Campos de ChatHistory.to_dict() que uma página do histórico pode devolver
+HISTORY_FIELDS = ("id", "user_id", "message", "response", "model_used", "service_type",
+                  "session_id", "created_at", "updated_at")
+
 
 class ChatHistoryService:
     """
     Serviço para gerenciar histórico de conversas
-    Atualmente usa SQL, mas preparado para migração para Redis
+    
+    Cada lista no Redis (mais recente primeiro, até HISTORY_REDIS_MAX_TURNS)
+    guarda sempre os turnos mais recentes do utilizador/sessão: é preenchida
+    a partir do SQL numa leitura sem cache e as gravações só acrescentam a
+    listas que já existem (LPUSHX). Um contador de versão por lista impede
+    que um preenchimento com dados lidos antes de uma gravação a esconda.
+    Qualquer erro do Redis faz a leitura cair para o SQL.
+    
+    Com o arquivo (history_archive), leituras que não se completam com a
+    tabela continuam nos segmentos arquivados.
     """
     
-    def __init__(self):
-        # TODO: Adicionar configuração Redis quando implementado
-        self.use_redis = os.getenv('USE_REDIS', 'False').lower() == 'true'
-        self.redis_client = None
+    def __init__(self, redis_client=None, use_redis: bool = None,
+                 max_turns: int = HISTORY_REDIS_MAX_TURNS, ttl: int = HISTORY_REDIS_TTL,
+                 write_behind: bool = HISTORY_WRITE_BEHIND):
+        """
+        Args:
+            redis_client: Cliente Redis (ex: fakeredis); padrão o cliente de REDIS_URL
+            use_redis: Ativa a cache no Redis (padrão USE_REDIS)
+            write_behind: Grava no SQL em background, em lotes (padrão HISTORY_WRITE_BEHIND)
+        """
+        if use_redis is None:
+            use_redis = os.getenv('USE_REDIS', 'False').lower() == 'true'
+        self.use_redis = use_redis
+        self.redis_client = redis_client
+        self.max_turns = max_turns
+        self.ttl = ttl
+        self.writer = HistoryWriter(on_flush=self._after_save) if write_behind else None
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
         
     def create_session_id(self) -> str:
         """Gera um ID único para sessão de chat"""
@@ -46,26 +100,62 @@ class ChatHistoryService:
             session_id: ID da sessão
             
         Returns:
-            ChatHistory object
+            ChatHistory object (sem id enquanto estiver na fila do write-behind)
         """
-        if self.use_redis:
-            # TODO: Implementar salvamento no Redis
-            pass
+        entry = {
+            "user_id": user_id,
+            "message": message,
+            "response": response,
+            "model_used": model_used,
+            "service_type": service_type,
+            "session_id": session_id
+        }
+        if self.writer is not None and self.writer.submit([entry]):
+            return chat_from_entry(entry)
         
-        chat = ChatHistory(
-            user_id=user_id,
-            message=message,
-            response=response,
-            model_used=model_used,
-            service_type=service_type,
-            session_id=session_id
-        )
+        chat = ChatHistory(**entry)
         
         db.session.add(chat)
+        db.session.flush()
+        usage_counters.record([chat])
+        turns = self._snapshot([chat])
         db.session.commit()
+        self._after_save([chat], turns)
         
         return chat
     
+    def save_messages(self, entries: List[Dict[str, Any]]) -> List[ChatHistory]:
+        """
+        Salva várias mensagens numa única transação
+        
+        Args:
+            entries: Dicts com os mesmos campos de save_message
+            
+        Returns:
+            Lista de ChatHistory (vazia se não houver entradas)
+        """
+        if not entries:
+            return []
+        
+        entries = [{field: entry.get(field) for field in CHAT_FIELDS} for entry in entries]
+        if self.writer is not None and self.writer.submit(entries):
+            return [chat_from_entry(entry) for entry in entries]
+        
+        chats = [ChatHistory(**entry) for entry in entries]
+        
+        try:
+            db.session.add_all(chats)
+            db.session.flush()
+            usage_counters.record(chats)
+            turns = self._snapshot(chats)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        
+        self._after_save(chats, turns)
+        return chats
+    
     def get_user_history(
         self,
         user_id: int,
@@ -81,18 +171,111 @@ class ChatHistoryService:
             session_id: Filtrar por sessão específica
             
         Returns:
-            Lista de ChatHistory
+            Lista de ChatHistory (mais recente primeiro)
         """
-        if self.use_redis:
-            # TODO: Buscar do Redis
-            pass
+        if session_id:
+            history = self._cached(
+                self._session_key(session_id),
+                limit,
+                lambda n: self._latest(n, session_id=session_id)
+            )
+            if not all(chat.user_id == user_id for chat in history):
+                # Sessão com turnos de outro utilizador: filtra no SQL
+                history = self._latest(limit, user_id=user_id, session_id=session_id)
+        else:
+            history = self._cached(
+                self._user_key(user_id),
+                limit,
+                lambda n: self._latest(n, user_id=user_id)
+            )
         
-        query = ChatHistory.query.filter_by(user_id=user_id)
+        history = self._with_archive(history, limit, user_id=user_id, session_id=session_id)
+        return self._with_pending(history, limit, user_id=user_id, session_id=session_id)
+    
+    def get_history_page(
+        self,
+        user_id: int,
+        limit: int = 50,
+        cursor: str = None,
+        session_id: str = None,
+        fields: List[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Uma página do histórico do usuário, do mais recente para o mais antigo
         
+        Paginação por chave (created_at, id): cada página é uma busca no índice
+        (user_id, created_at) a partir do último turno da anterior, sem OFFSET.
+        Só as colunas pedidas são lidas, em tuplas (sem objetos ChatHistory).
+        As páginas que passam do início da tabela continuam no arquivo.
+        
+        Args:
+            user_id: ID do usuário
+            limit: Turnos por página (até HISTORY_PAGE_MAX)
+            cursor: next_cursor da página anterior (None = primeira página)
+            session_id: Filtrar por sessão específica
+            fields: Campos de HISTORY_FIELDS a devolver (padrão todos; id e created_at vão sempre)
+            
+        Returns:
+            {"history": [dicts], "next_cursor": str ou None se não há mais turnos}
+            
+        Raises:
+            ValueError: cursor inválido ou campo desconhecido
+        """
+        fields = list(HISTORY_FIELDS if not fields else dict.fromkeys(["id", "created_at", *fields]))
+        unknown = [field for field in fields if field not in HISTORY_FIELDS]
+        if unknown:
+            raise ValueError(f"Campos desconhecidos: {', '.join(unknown)}")
+        limit = max(1, min(limit, HISTORY_PAGE_MAX))
+        
+        table = ChatHistory.__table__
+        query = select(*(table.c[field] for field in fields)).where(table.c.user_id == user_id)
         if session_id:
-            query = query.filter_by(session_id=session_id)
+            query = query.where(table.c.session_id == session_id)
+        if cursor:
+            created_at, last_id = _decode_cursor(cursor)
+            # created_at <= ... delimita a busca no índice; o OR desempata pelo id
+            query = query.where(
+                table.c.created_at <= created_at,
+                or_(table.c.created_at < created_at, and_(table.c.created_at == created_at, table.c.id < last_id))
+            )
+        rows = [serialize_row(row) for row in db.session.execute(
+            query.order_by(table.c.created_at.desc(), table.c.id.desc()).limit(limit + 1)
+        ).mappings()]
+        
+        # A página chega a turnos tão antigos como os arquivados: junta o arquivo (o SQL prevalece)
+        archived_newest = history_archive.newest(user_id, session_id)
+        if archived_newest and (len(rows) <= limit or (rows[-1]["created_at"] or "") <= archived_newest):
+            before = (created_at.isoformat(), last_id) if cursor else None
+            merged = {row["id"]: {field: row.get(field) for field in fields}
+                      for row in history_archive.rows(user_id, session_id, before, limit + 1)}
+            merged.update((row["id"], row) for row in rows)
+            rows = sorted(merged.values(), key=row_key, reverse=True)
         
-        return query.order_by(ChatHistory.created_at.desc()).limit(limit).all()
+        has_more = len(rows) > limit
+        history = rows[:limit]
+        next_cursor = _encode_cursor(history[-1]["created_at"], history[-1]["id"]) if has_more else None
+        if not cursor:
+            history = self._pending_page(user_id, session_id, fields, history) + history
+        
+        return {
+            "history": history,
+            "next_cursor": next_cursor
+        }
+    
+    def export_user_history(self, user_id: int, session_id: str = None, fields: List[str] = None):
+        """
+        Todo o histórico do utilizador (tabela e arquivo), do mais recente para o mais antigo
+        
+        Yields:
+            Dicts no formato de ChatHistory.to_dict(), página a página
+        """
+        cursor = None
+        while True:
+            page = self.get_history_page(user_id, HISTORY_PAGE_MAX, cursor, session_id, fields)
+            yield from page["history"]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return
     
     def get_recent_history(
         self,
@@ -109,28 +292,73 @@ class ChatHistoryService:
             limit: Número máximo de mensagens
             
         Returns:
-            Lista de ChatHistory
+            Lista de ChatHistory (mais recente primeiro)
         """
         since = datetime.utcnow() - timedelta(hours=hours)
         
-        return ChatHistory.query.filter(
+        if context_cache.available() and limit <= context_cache.max_turns:
+            history = self._context_turns(
+                user_key(user_id),
+                limit,
+                lambda n: self._cached(self._user_key(user_id), n, lambda m: self._latest(m, user_id=user_id))
+            )
+            history = [chat for chat in history if chat.created_at is None or chat.created_at >= since]
+            return self._with_pending(history, limit, user_id=user_id, since=since)
+        
+        if self._client() is not None and limit <= self.max_turns:
+            # Os mais recentes do utilizador, filtrados pela janela: o mesmo que a consulta SQL
+            history = self.get_user_history(user_id, limit)
+            return [chat for chat in history if chat.created_at is None or chat.created_at >= since]
+        
+        history = ChatHistory.query.filter(
             ChatHistory.user_id == user_id,
             ChatHistory.created_at >= since
-        ).order_by(ChatHistory.created_at.desc()).limit(limit).all()
+        ).order_by(ChatHistory.created_at.desc(), ChatHistory.id.desc()).limit(limit).all()
+        return self._with_pending(history, limit, user_id=user_id, since=since)
     
-    def get_session_history(self, session_id: str) -> List[ChatHistory]:
+    def get_session_history(self, session_id: str, limit: int = None) -> List[ChatHistory]:
         """
-        Obtém todo histórico de uma sessão
+        Obtém o histórico de uma sessão
         
         Args:
             session_id: ID da sessão
+            limit: Apenas os últimos N turnos (None = sessão inteira)
             
         Returns:
-            Lista de ChatHistory
+            Lista de ChatHistory (mais antigo primeiro)
         """
-        return ChatHistory.query.filter_by(
-            session_id=session_id
-        ).order_by(ChatHistory.created_at.asc()).all()
+        if limit is not None:
+            loader = lambda n: self._cached(
+                self._session_key(session_id),
+                n,
+                lambda m: self._latest(m, session_id=session_id)
+            )
+            if context_cache.available() and limit <= context_cache.max_turns:
+                history = self._context_turns(session_key(session_id), limit, loader)
+            else:
+                history = loader(limit)
+            history = self._with_archive(history, limit, session_id=session_id)
+            return list(reversed(self._with_pending(history, limit, session_id=session_id)))
+        
+        history = None
+        client = self._client()
+        if client is not None:
+            try:
+                raw = client.lrange(self._session_key(session_id), 0, -1)
+            except Exception as e:
+                self._redis_error("ler", e)
+                raw = None
+            # Lista abaixo do limite tem a sessão inteira
+            if raw and len(raw) < self.max_turns:
+                self.hits += 1
+                history = self._decode(raw)
+        
+        if history is None:
+            history = ChatHistory.query.filter_by(
+                session_id=session_id
+            ).order_by(ChatHistory.created_at.desc(), ChatHistory.id.desc()).all()
+        history = self._with_archive(history, session_id=session_id)
+        return list(reversed(self._with_pending(history, session_id=session_id)))
     
     def delete_user_history(self, user_id: int) -> int:
         """
@@ -142,75 +370,417 @@ class ChatHistoryService:
         Returns:
             Número de registros deletados
         """
-        if self.use_redis:
-            # TODO: Deletar do Redis
-            pass
+        if self.writer is not None:
+            # Mensagens ainda na fila não chegam a ser gravadas; um lote já em gravação termina antes
+            self.writer.discard(user_id)
+            self.writer.flush(timeout=5)
         
-        count = ChatHistory.query.filter_by(user_id=user_id).delete()
+        # Em lotes: um utilizador com muito histórico não bloqueia a tabela numa só transação
+        count = history_purger.purge_user(user_id)
+        count += history_archive.drop_user(user_id)
+        usage_counters.forget(user_id)
+        session_summarizer.forget(user_id)
         db.session.commit()
+        context_cache.invalidate(user_id)
+        self._delete_from_redis(user_id)
+        context_retriever.forget(user_id)
         
         return count
     
-    def delete_old_history(self, days: int = 30) -> int:
+    def delete_old_history(self, days: int = RETENTION_DAYS, resume: bool = True, progress=None) -> int:
         """
-        Deleta histórico antigo (limpeza automática)
+        Deleta histórico antigo (limpeza automática), em lotes
         
         Args:
             days: Número de dias para manter
+            resume: Retoma uma limpeza interrompida em vez de começar de novo
+            progress: Chamado depois de cada lote com o progresso
             
         Returns:
             Número de registros deletados
         """
-        cutoff_date = datetime.utcnow() - timedelta(days=days)
+        count = history_purger.purge_expired(days, resume=resume, progress=progress)
+        if count:
+            self._clear_caches()
         
-        count = ChatHistory.query.filter(
-            ChatHistory.created_at < cutoff_date
-        ).delete()
+        return count
+    
+    def archive_old_history(self, days: int = ARCHIVE_AFTER_DAYS, progress=None) -> int:
+        """
+        Move para o arquivo os turnos mais antigos que `days` dias, em lotes
         
-        db.session.commit()
+        Returns:
+            Número de registros arquivados
+        """
+        count = history_archive.archive_before(days, progress=progress)
+        if count:
+            # As listas no Redis podiam ter turnos que já não estão na tabela
+            self._clear_caches()
         
         return count
     
-    def get_user_stats(self, user_id: int) -> Dict[str, Any]:
+    def apply_retention(self, days: int = RETENTION_DAYS, grace_days: int = RETENTION_SOFT_DELETE_GRACE_DAYS,
+                        resume: bool = True, progress=None) -> Dict[str, int]:
         """
-        Obtém estatísticas do usuário
+        Limpeza completa: arquivo dos turnos frios (com ARCHIVE_ENABLED),
+        turnos mais antigos que `days` (tabela e arquivo) e turnos com soft
+        delete (deleted_at) há mais de `grace_days` dias
+        
+        Returns:
+            Registros arquivados e apagados por tipo de limpeza
+        """
+        archived = self.archive_old_history(progress=progress) if history_archive.enabled else 0
+        expired = self.delete_old_history(days, resume=resume, progress=progress)
+        
+        dropped = history_archive.drop_before(utcnow() - timedelta(days=days))
+        for entry in dropped:
+            usage_counters.subtract_usage(entry["user_id"], entry.get("usage", ()))
+        db.session.commit()
+        expired += sum(entry["rows"] for entry in dropped)
+        
+        soft_deleted = history_purger.purge_soft_deleted(grace_days, resume=resume, progress=progress)
+        if soft_deleted:
+            self._clear_caches()
+        return {"archived": archived, "expired": expired, "soft_deleted": soft_deleted}
+    
+    def recent_context(self, user_id: int, turns: List[ChatHistory], build) -> str:
+        """
+        Contexto em texto dos turnos recentes do utilizador, montado por
+        build() só se não estiver na cache de contexto
+        """
+        return context_cache.render(user_key(user_id), (chat.id for chat in turns), build)
+    
+    def get_user_stats(self, user_id: int, days: int = None) -> Dict[str, Any]:
+        """
+        Obtém estatísticas do usuário (dos contadores em usage_counters, sem agregar o histórico)
         
         Args:
             user_id: ID do usuário
+            days: Inclui as mensagens por dia dos últimos N dias
             
         Returns:
             Dict com estatísticas
         """
-        total_messages = ChatHistory.query.filter_by(user_id=user_id).count()
+        return usage_counters.user_stats(user_id, days)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Contadores da cache no Redis e da fila de gravação"""
+        lookups = self.hits + self.misses
+        return {
+            "redis": self._client() is not None,
+            "max_turns": self.max_turns,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "errors": self.errors,
+            "write_behind": self.writer.stats() if self.writer is not None else None
+        }
+    
+    def flush(self, timeout: float = None) -> bool:
+        """Espera a gravação das mensagens na fila do write-behind (True se não há fila)"""
+        return self.writer.flush(timeout) if self.writer is not None else True
+    
+    def _after_save(self, chats: List[ChatHistory], turns: List[Dict[str, Any]] = None):
+        """
+        Depois do commit: cache de contexto, listas no Redis e indexação de embeddings
         
-        from sqlalchemy import func
-        model_stats = db.session.query(
-            ChatHistory.model_used,
-            func.count(ChatHistory.id)
-        ).filter_by(user_id=user_id).group_by(ChatHistory.model_used).all()
+        Args:
+            turns: to_dict() das linhas lido antes do commit (sem recarregar as linhas expiradas)
+        """
+        if context_cache.enabled:
+            context_cache.append(turns if turns is not None else [chat.to_dict() for chat in chats])
+        self._save_to_redis(chats)
+        context_retriever.index_turns(chats)
+    
+    @staticmethod
+    def _snapshot(chats: List[ChatHistory]) -> Optional[List[Dict[str, Any]]]:
+        """to_dict() das linhas já com id (depois do flush) para a cache de contexto"""
+        return [chat.to_dict() for chat in chats] if context_cache.enabled else None
+    
+    def _with_pending(self, history: List[ChatHistory], limit: int = None, user_id: int = None,
+                      session_id: str = None, since: datetime = None) -> List[ChatHistory]:
+        """
+        Junta ao histórico lido (mais recente primeiro) as mensagens ainda na
+        fila do write-behind, para que cada um leia as próprias escritas
+        """
+        if self.writer is None:
+            return history
+        entries = self.writer.pending(user_id, session_id)
+        if since is not None:
+            entries = [entry for entry in entries if entry["created_at"] >= since]
+        if not entries:
+            return history
         
-        service_stats = db.session.query(
-            ChatHistory.service_type,
-            func.count(ChatHistory.id)
-        ).filter_by(user_id=user_id).group_by(ChatHistory.service_type).all()
+        # Lote gravado mas ainda não retirado do buffer: aparece só uma vez
+        persisted = {(chat.user_id, chat.session_id, chat.message, chat.response) for chat in history}
+        merged = [
+            chat_from_entry(entry) for entry in entries
+            if (entry["user_id"], entry.get("session_id"), entry["message"], entry.get("response")) not in persisted
+        ] + history
+        return merged[:limit] if limit is not None else merged
+    
+    @staticmethod
+    def _with_archive(history: List[ChatHistory], limit: int = None, user_id: int = None,
+                      session_id: str = None) -> List[ChatHistory]:
+        """
+        Completa com turnos do arquivo o histórico lido da tabela (mais
+        recente primeiro) que não chega a `limit` (None = todos)
+        """
+        if limit is not None and len(history) >= limit:
+            return history
+        if history_archive.newest(user_id, session_id) is None:
+            return history
         
-        return {
-            'total_messages': total_messages,
-            'models': dict(model_stats),
-            'services': dict(service_stats)
-        }
+        before = None
+        if history:
+            last = history[-1]
+            before = (last.created_at.isoformat() if last.created_at else "", last.id)
+        seen = {chat.id for chat in history}
+        archived = history_archive.rows(user_id, session_id, before, limit - len(history) if limit is not None else None)
+        return history + [_chat_from_dict(row) for row in archived if row["id"] not in seen]
+    
+    def _pending_page(self, user_id: int, session_id: Optional[str], fields: List[str],
+                      history: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Mensagens ainda na fila do write-behind no topo da primeira página (sem id)"""
+        if self.writer is None:
+            return []
+        persisted = {(row.get("session_id"), row.get("message"), row.get("response")) for row in history}
+        return [
+            {field: entry.get(field) for field in fields} | {"id": None, "created_at": entry["created_at"].isoformat()}
+            for entry in self.writer.pending(user_id, session_id)
+            if (entry.get("session_id"), entry["message"], entry.get("response")) not in persisted
+        ]
+    
+    # Cache no Redis
+    def _client(self):
+        if not self.use_redis:
+            return None
+        return self.redis_client or get_redis_client()
+    
+    @staticmethod
+    def _user_key(user_id: int) -> str:
+        return f"{HISTORY_REDIS_PREFIX}user:{int(user_id)}"
+    
+    @staticmethod
+    def _session_key(session_id: str) -> str:
+        return f"{HISTORY_REDIS_PREFIX}session:{session_id}"
+    
+    @staticmethod
+    def _latest(limit: int, user_id: int = None, session_id: str = None) -> List[ChatHistory]:
+        """Os `limit` turnos mais recentes no SQL (mais recente primeiro)"""
+        query = ChatHistory.query
+        if user_id is not None:
+            query = query.filter_by(user_id=user_id)
+        if session_id is not None:
+            query = query.filter_by(session_id=session_id)
+        return query.order_by(ChatHistory.created_at.desc(), ChatHistory.id.desc()).limit(limit).all()
     
-    # Métodos preparados para Redis (futuro)
-    def _save_to_redis(self, chat: ChatHistory):
-        """TODO: Implementar salvamento no Redis"""
-        pass
+    @staticmethod
+    def _context_turns(key: str, limit: int, loader) -> List[ChatHistory]:
+        """
+        Até `limit` turnos da chave a partir da cache de contexto do processo;
+        sem a entrada, loader(n) lê os CONTEXT_CACHE_TURNS mais recentes, que
+        a preenchem para os próximos turnos do chat
+        """
+        turns = context_cache.get(key, limit)
+        if turns is not None:
+            return [_chat_from_dict(turn) for turn in turns]
+        
+        token = context_cache.begin(key)
+        history = loader(context_cache.max_turns)
+        context_cache.put(key, [chat.to_dict() for chat in history], token)
+        return history[:limit]
     
-    def _get_from_redis(self, user_id: int, limit: int) -> List[Dict]:
-        """TODO: Implementar busca no Redis"""
-        pass
+    def _cached(self, key: str, limit: int, loader) -> List[ChatHistory]:
+        """
+        Até `limit` turnos da lista `key` (mais recente primeiro)
+        
+        Sem a lista no Redis, loader(n) lê do SQL os HISTORY_REDIS_MAX_TURNS
+        mais recentes, que preenchem a lista para as próximas leituras.
+        """
+        client = self._client()
+        if client is None or limit > self.max_turns:
+            return loader(limit)
+        
+        try:
+            raw = client.lrange(key, 0, limit - 1)
+            if raw:
+                self.hits += 1
+                return self._decode(raw)
+            version = client.get(f"{key}:v")
+        except Exception as e:
+            self._redis_error("ler", e)
+            return loader(limit)
+        
+        self.misses += 1
+        history = loader(self.max_turns)
+        self._fill(client, key, version, history)
+        return history[:limit]
+    
+    def _fill(self, client, key: str, version: Optional[str], history: List[ChatHistory]):
+        """Preenche a lista, desde que nenhuma gravação tenha mudado a versão depois da leitura"""
+        if not history:
+            return
+        try:
+            with client.pipeline() as pipe:
+                pipe.watch(f"{key}:v")
+                if pipe.get(f"{key}:v") != version:
+                    return
+                pipe.multi()
+                pipe.delete(key)
+                pipe.rpush(key, *[self._encode(chat) for chat in history])
+                pipe.expire(key, self.ttl)
+                pipe.execute()
+        except WatchError:
+            pass
+        except Exception as e:
+            self._redis_error("gravar", e)
+    
+    def _save_to_redis(self, chats: List[ChatHistory]):
+        """Acrescenta os turnos acabados de gravar às listas que já estão no Redis"""
+        client = self._client()
+        if client is None:
+            return
+        
+        keys = set()
+        try:
+            pipe = client.pipeline()
+            for chat in chats:
+                data = self._encode(chat)
+                chat_keys = [self._user_key(chat.user_id)]
+                if chat.session_id:
+                    chat_keys.append(self._session_key(chat.session_id))
+                    pipe.sadd(f"{self._user_key(chat.user_id)}:sessions", chat.session_id)
+                    pipe.expire(f"{self._user_key(chat.user_id)}:sessions", self.ttl)
+                for key in chat_keys:
+                    pipe.lpushx(key, data)
+                    keys.add(key)
+            for key in keys:
+                pipe.ltrim(key, 0, self.max_turns - 1)
+                pipe.incr(f"{key}:v")
+                pipe.expire(f"{key}:v", self.ttl)
+                pipe.expire(key, self.ttl)
+            pipe.execute()
+        except Exception as e:
+            self._redis_error("gravar", e)
+            # Lista sem o turno novo deixaria de ter os mais recentes
+            self._invalidate(client, keys)
     
     def _delete_from_redis(self, user_id: int):
-        """TODO: Implementar deleção no Redis"""
-        pass
+        """Remove as listas do utilizador e das suas sessões"""
+        client = self._client()
+        if client is None:
+            return
+        try:
+            sessions = client.smembers(f"{self._user_key(user_id)}:sessions")
+        except Exception as e:
+            self._redis_error("apagar", e)
+            sessions = ()
+        keys = [self._user_key(user_id)] + [self._session_key(session_id) for session_id in sessions]
+        self._invalidate(client, keys)
+        try:
+            client.delete(f"{self._user_key(user_id)}:sessions")
+        except Exception as e:
+            self._redis_error("apagar", e)
+    
+    def _clear_caches(self):
+        """Descarta a cache de contexto (todos os processos) e as listas no Redis"""
+        context_cache.clear()
+        self._clear_redis()
+    
+    def _clear_redis(self):
+        """Descarta todas as listas (ex: limpeza de histórico antigo no SQL)"""
+        client = self._client()
+        if client is None:
+            return
+        try:
+            keys = [key for key in client.scan_iter(match=f"{HISTORY_REDIS_PREFIX}*")
+                    if not key.endswith(":v") and not key.endswith(":sessions")]
+        except Exception as e:
+            self._redis_error("apagar", e)
+            return
+        self._invalidate(client, keys)
+    
+    def _invalidate(self, client, keys):
+        """Apaga as listas e avança as versões (preenchimentos em andamento são descartados)"""
+        if not keys:
+            return
+        try:
+            pipe = client.pipeline()
+            for key in keys:
+                pipe.delete(key)
+                pipe.incr(f"{key}:v")
+                pipe.expire(f"{key}:v", self.ttl)
+            pipe.execute()
+        except Exception as e:
+            self._redis_error("apagar", e)
+    
+    def _redis_error(self, action: str, error: Exception):
+        self.errors += 1
+        print(f"Erro ao {action} histórico no Redis: {error}")
+    
+    @staticmethod
+    def _encode(chat: ChatHistory) -> str:
+        return json.dumps(chat.to_dict(), ensure_ascii=False)
+    
+    @staticmethod
+    def _decode(raw: List[str]) -> List[ChatHistory]:
+        """
+        Turnos da lista como ChatHistory fora da sessão SQLAlchemy (só leitura);
+        um turno repetido (gravação concorrente com um preenchimento) aparece uma vez
+        """
+        history, seen = [], set()
+        for item in raw:
+            data = json.loads(item)
+            if data["id"] in seen:
+                continue
+            seen.add(data["id"])
+            history.append(_chat_from_dict(data))
+        return history
+
+
+def _chat_from_dict(data: Dict[str, Any]) -> ChatHistory:
+    """ChatHistory fora da sessão SQLAlchemy a partir do formato de to_dict() (Redis, arquivo)"""
+    chat = ChatHistory(
+        user_id=data["user_id"],
+        message=data["message"],
+        response=data.get("response"),
+        model_used=data.get("model_used"),
+        service_type=data.get("service_type"),
+        session_id=data.get("session_id")
+    )
+    chat.id = data["id"]
+    chat.created_at = _parse_datetime(data.get("created_at"))
+    chat.updated_at = _parse_datetime(data.get("updated_at"))
+    return chat
+
+
+def _encode_cursor(created_at: Optional[str], chat_id: int) -> str:
+    raw = f"{created_at or ''}|{chat_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, chat_id = raw.rsplit("|", 1)
+        return _parse_datetime(created_at), int(chat_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError("Cursor inválido")
+
+
+def _parse_datetime(value: Optional[str]) -> Optional[datetime]:
+    """Datas do to_dict, sem fuso (UTC) como nas colunas DateTime"""
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
 
 chat_history_service = ChatHistoryService()
+
+if RETENTION_SCHEDULE:
+    history_purger.schedule(chat_history_service.apply_retention)
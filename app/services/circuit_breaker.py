@@ -0,0 +1,259 @@
+"""
+Circuit breaker por backend de modelos ("gemini", "ollama:<url>", "ollama:pool")
+Com uma taxa alta de erros/timeouts o circuito abre e as requisições falham
+de imediato (ou seguem para o fallback) em vez de esperarem pelo backend;
+depois de CIRCUIT_OPEN_SECONDS algumas chamadas de teste decidem se volta a fechar
+"""
+import os
+import math
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Any
+from dotenv import load_dotenv
+
+from app.services.metrics import is_timeout
+
+load_dotenv()
+
+CIRCUIT_BREAKER_ENABLED = os.environ.get("CIRCUIT_BREAKER_ENABLED", "True").lower() == "true"
+CIRCUIT_WINDOW = int(os.environ.get("CIRCUIT_WINDOW", "20"))
+CIRCUIT_MIN_CALLS = int(os.environ.get("CIRCUIT_MIN_CALLS", "5"))
+CIRCUIT_FAILURE_RATE = float(os.environ.get("CIRCUIT_FAILURE_RATE", "0.5"))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get("CIRCUIT_OPEN_SECONDS", "30"))
+CIRCUIT_HALF_OPEN_CALLS = int(os.environ.get("CIRCUIT_HALF_OPEN_CALLS", "1"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Exception):
+    """Chamada recusada porque o circuito do backend está aberto"""
+
+    def __init__(self, backend: str, retry_after: int):
+        super().__init__(f"Backend {backend} indisponível (circuito aberto)")
+        self.backend = backend
+        self.status_code = 503
+        self.retry_after = retry_after
+
+
+class _Breaker:
+    """Estado do circuito de um backend e resultados das últimas chamadas"""
+
+    def __init__(self, name: str, window: int, min_calls: int, failure_rate: float,
+                 open_seconds: float, half_open_calls: int):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.outcomes = deque(maxlen=window)
+        self.opened_at = 0.0
+        self.probes = 0
+        self.successes = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.opened = 0
+        self.last_error = None
+
+    def check(self):
+        """Verificação rápida (sem reservar chamada de teste): levanta CircuitOpen se aberto"""
+        with self.lock:
+            self._advance()
+            if self.state == OPEN or (self.state == HALF_OPEN and self.probes >= self.half_open_calls):
+                self.rejected += 1
+                raise CircuitOpen(self.name, self.retry_after())
+
+    def before_call(self):
+        """Reserva a chamada; em meio-aberto só passam CIRCUIT_HALF_OPEN_CALLS de cada vez"""
+        with self.lock:
+            self._advance()
+            if self.state == OPEN:
+                self.rejected += 1
+                raise CircuitOpen(self.name, self.retry_after())
+            if self.state == HALF_OPEN:
+                if self.probes >= self.half_open_calls:
+                    self.rejected += 1
+                    raise CircuitOpen(self.name, self.retry_after())
+                self.probes += 1
+
+    def record_success(self):
+        with self.lock:
+            self.successes += 1
+            if self.state == HALF_OPEN:
+                # Chamada de teste bem-sucedida: volta ao normal com a janela limpa
+                self.state = CLOSED
+                self.probes = 0
+                self.outcomes.clear()
+            self.outcomes.append("ok")
+
+    def record_failure(self, error: str = None, timeout: bool = False):
+        with self.lock:
+            if timeout:
+                self.timeouts += 1
+            else:
+                self.errors += 1
+            self.last_error = error
+            self.outcomes.append("timeout" if timeout else "error")
+
+            if self.state == HALF_OPEN:
+                self._open()
+            elif self.state == CLOSED and len(self.outcomes) >= self.min_calls:
+                failures = sum(1 for outcome in self.outcomes if outcome != "ok")
+                if failures / len(self.outcomes) >= self.failure_rate:
+                    self._open()
+
+    def release(self):
+        """Chamada interrompida sem resultado (ex: cliente desconectou do stream)"""
+        with self.lock:
+            if self.state == HALF_OPEN and self.probes > 0:
+                self.probes -= 1
+
+    def retry_after(self) -> int:
+        remaining = self.opened_at + self.open_seconds - time.monotonic()
+        return max(1, math.ceil(remaining))
+
+    def reset(self):
+        with self.lock:
+            self.state = CLOSED
+            self.probes = 0
+            self.outcomes.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            self._advance()
+            calls = len(self.outcomes)
+            errors = sum(1 for outcome in self.outcomes if outcome == "error")
+            timeouts = sum(1 for outcome in self.outcomes if outcome == "timeout")
+            return {
+                "state": self.state,
+                "window_calls": calls,
+                "error_rate": round(errors / calls, 4) if calls else 0.0,
+                "timeout_rate": round(timeouts / calls, 4) if calls else 0.0,
+                "successes": self.successes,
+                "errors": self.errors,
+                "timeouts": self.timeouts,
+                "rejected": self.rejected,
+                "opened": self.opened,
+                "retry_after": self.retry_after() if self.state == OPEN else 0,
+                "last_error": self.last_error
+            }
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.probes = 0
+        self.opened += 1
+        print(f"⚠️ Circuito aberto para {self.name} ({self.last_error}); nova tentativa em {self.open_seconds:.0f}s")
+
+    def _advance(self):
+        if self.state == OPEN and time.monotonic() >= self.opened_at + self.open_seconds:
+            self.state = HALF_OPEN
+            self.probes = 0
+
+
+class CircuitBreakers:
+    """Circuitos por backend (mesmas chaves do controlo de admissão)"""
+
+    def __init__(
+        self,
+        enabled: bool = CIRCUIT_BREAKER_ENABLED,
+        window: int = CIRCUIT_WINDOW,
+        min_calls: int = CIRCUIT_MIN_CALLS,
+        failure_rate: float = CIRCUIT_FAILURE_RATE,
+        open_seconds: float = CIRCUIT_OPEN_SECONDS,
+        half_open_calls: int = CIRCUIT_HALF_OPEN_CALLS
+    ):
+        self.enabled = enabled
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self._breakers: Dict[str, _Breaker] = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, backend: str) -> _Breaker:
+        breaker = self._breakers.get(backend)
+        if breaker is not None:
+            return breaker
+
+        with self._lock:
+            breaker = self._breakers.get(backend)
+            if breaker is None:
+                breaker = _Breaker(backend, self.window, self.min_calls, self.failure_rate,
+                                   self.open_seconds, self.half_open_calls)
+                self._breakers[backend] = breaker
+            return breaker
+
+    def check(self, backend: str):
+        """Falha rápida (CircuitOpen) se o circuito do backend está aberto"""
+        if self.enabled:
+            self.breaker(backend).check()
+
+    def record_failure(self, backend: str, error: str = None, timeout: bool = False):
+        """Falha observada fora de uma chamada (ex: probe do catálogo sem resposta)"""
+        if self.enabled:
+            self.breaker(backend).record_failure(error, timeout)
+
+    @contextmanager
+    def call(self, backend: str):
+        """
+        Bloco de uma chamada ao backend: uma exceção no bloco conta como
+        erro (ou timeout) e sai normalmente como sucesso
+        """
+        if not self.enabled:
+            yield
+            return
+
+        breaker = self.breaker(backend)
+        breaker.before_call()
+        try:
+            yield
+        except Exception as e:
+            breaker.record_failure(str(e) or e.__class__.__name__, timeout=is_timeout(e))
+            raise
+        except BaseException:
+            breaker.release()
+            raise
+        breaker.record_success()
+
+    def reset(self, backend: str = None):
+        """Fecha o circuito (de um backend ou todos), ex: após mudança de configuração"""
+        with self._lock:
+            if backend is None:
+                breakers = list(self._breakers.values())
+            else:
+                breakers = [self._breakers[backend]] if backend in self._breakers else []
+        for breaker in breakers:
+            breaker.reset()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return {
+            "enabled": self.enabled,
+            "failure_rate": self.failure_rate,
+            "open_seconds": self.open_seconds,
+            "backends": {breaker.name: breaker.stats() for breaker in breakers}
+        }
+
+
+def circuit_open_result(error: CircuitOpen) -> Dict[str, Any]:
+    """Resultado de falha (formato do chatbot) para uma chamada recusada pelo circuito"""
+    return {
+        "success": False,
+        "error": "Modelo temporariamente indisponível, tente novamente em instantes",
+        "response": None,
+        "status": error.status_code,
+        "retry_after": error.retry_after,
+        "backend": error.backend
+    }
+
+
+circuit_breakers = CircuitBreakers()
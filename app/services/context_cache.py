@@ -0,0 +1,346 @@
+"""
+Cache em memória do contexto recente da conversa
+Guarda, por utilizador e por sessão, os últimos CONTEXT_CACHE_TURNS turnos e
+o contexto já montado a partir deles: o turno seguinte do chat lê daqui em vez
+de ir à base de dados. As gravações do próprio processo atualizam as entradas;
+com REDIS_URL, as dos outros processos (workers) invalidam-nas por pub/sub
+"""
+import os
+import json
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Callable, Iterable, List, Optional
+from dotenv import load_dotenv
+
+from app.services.redis_client import get_redis_client
+
+load_dotenv()
+
+CONTEXT_CACHE_ENABLED = os.environ.get("CONTEXT_CACHE_ENABLED", "False").lower() == "true"
+CONTEXT_CACHE_TURNS = int(os.environ.get("CONTEXT_CACHE_TURNS", "10"))
+CONTEXT_CACHE_TTL = int(os.environ.get("CONTEXT_CACHE_TTL", "300"))
+CONTEXT_CACHE_MAX_ENTRIES = int(os.environ.get("CONTEXT_CACHE_MAX_ENTRIES", "10000"))
+CONTEXT_CACHE_MAX_BYTES = int(os.environ.get("CONTEXT_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+CONTEXT_CACHE_CHANNEL = os.environ.get("CONTEXT_CACHE_CHANNEL", "chat:context:invalidate")
+
+# Contextos montados guardados por entrada (um por combinação de turnos)
+CONTEXTS_PER_ENTRY = 4
+# Custo fixo estimado de um turno em memória além do texto
+TURN_OVERHEAD_BYTES = 200
+
+
+def user_key(user_id: int) -> str:
+    return f"user:{int(user_id)}"
+
+
+def session_key(session_id: str) -> str:
+    return f"session:{session_id}"
+
+
+class _Entry:
+    __slots__ = ("turns", "users", "contexts", "expires_at", "size")
+
+    def __init__(self, turns: List[Dict[str, Any]], expires_at: float):
+        self.turns = turns
+        self.users = {turn["user_id"] for turn in turns}
+        self.contexts: "OrderedDict[tuple, str]" = OrderedDict()
+        self.expires_at = expires_at
+        self.size = sum(_turn_size(turn) for turn in turns)
+
+
+class ContextCache:
+    """
+    LRU de turnos recentes (dicts de ChatHistory.to_dict(), mais recente
+    primeiro) com TTL e limite de entradas e de bytes
+
+    Uma entrada tem sempre os turnos mais recentes da chave: é criada a partir
+    de uma leitura completa (begin + put) e as gravações só acrescentam a
+    entradas que já existem. Uma gravação ou invalidação durante a leitura
+    anula o put, como a versão das listas no Redis. Com Redis configurado, a
+    cache só responde enquanto o processo está inscrito no canal de
+    invalidação; sem Redis, o TTL limita o que outro processo pode ter mudado.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = CONTEXT_CACHE_ENABLED,
+        max_turns: int = CONTEXT_CACHE_TURNS,
+        ttl: int = CONTEXT_CACHE_TTL,
+        max_entries: int = CONTEXT_CACHE_MAX_ENTRIES,
+        max_bytes: int = CONTEXT_CACHE_MAX_BYTES,
+        channel: str = CONTEXT_CACHE_CHANNEL,
+        redis_client=None
+    ):
+        """
+        Args:
+            redis_client: Cliente para a invalidação entre processos; padrão o cliente de REDIS_URL
+        """
+        self.enabled = enabled
+        self.max_turns = max(1, max_turns)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.channel = channel
+        self.redis_client = redis_client
+        self._data: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._filling: Dict[str, str] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._origin = uuid.uuid4().hex
+        self._listener = None
+        self._subscribed = False
+        self.hits = 0
+        self.misses = 0
+        self.context_hits = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.remote_invalidations = 0
+        self.errors = 0
+
+    def available(self) -> bool:
+        """Ativa e, com Redis, inscrita no canal de invalidação (senão podia servir turnos de outro processo)"""
+        if not self.enabled:
+            return False
+        if self._client() is None:
+            return True
+        self._ensure_listener()
+        return self._subscribed
+
+    def get(self, key: str, limit: int) -> Optional[List[Dict[str, Any]]]:
+        """Os `limit` turnos mais recentes da chave, ou None se não estão em cache"""
+        if limit > self.max_turns or not self.available():
+            return None
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry.expires_at <= time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry.turns[:limit]
+
+    def begin(self, key: str) -> str:
+        """Marca o início de uma leitura que vai preencher a chave (token para put)"""
+        token = uuid.uuid4().hex
+        with self._lock:
+            self._filling[key] = token
+        return token
+
+    def put(self, key: str, turns: List[Dict[str, Any]], token: str):
+        """Guarda os turnos lidos (os max_turns mais recentes), se nada mudou desde begin"""
+        available = self.available()
+        with self._lock:
+            if self._filling.pop(key, None) != token or not available:
+                return
+            if key in self._data:
+                self._remove(key)
+            entry = _Entry(turns[:self.max_turns], time.time() + self.ttl)
+            if entry.size > self.max_bytes:
+                return
+            self._data[key] = entry
+            self._bytes += entry.size
+            self._evict()
+
+    def render(self, key: str, ids: Iterable[Optional[int]], build: Callable[[], str]) -> str:
+        """
+        Contexto montado a partir dos turnos `ids`, guardado na entrada da chave
+
+        Os turnos são imutáveis: os mesmos ids dão sempre o mesmo texto.
+        Turnos sem id (ainda na fila do write-behind) não são guardados.
+        """
+        ids = tuple(ids)
+        if None in ids or not self.available():
+            return build()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and ids in entry.contexts:
+                entry.contexts.move_to_end(ids)
+                self.context_hits += 1
+                return entry.contexts[ids]
+
+        text = build()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or ids in entry.contexts:
+                return text
+            entry.contexts[ids] = text
+            entry.size += len(text)
+            self._bytes += len(text)
+            while len(entry.contexts) > CONTEXTS_PER_ENTRY:
+                _, dropped = entry.contexts.popitem(last=False)
+                entry.size -= len(dropped)
+                self._bytes -= len(dropped)
+            self._evict()
+        return text
+
+    def append(self, turns: Iterable[Dict[str, Any]]):
+        """
+        Turnos acabados de gravar (em ordem): entram no topo das entradas
+        que já existem e invalidam as dos outros processos
+        """
+        turns = list(turns)
+        if not self.enabled or not turns:
+            return
+        users = {turn["user_id"] for turn in turns}
+        sessions = {turn["session_id"] for turn in turns if turn.get("session_id")}
+        with self._lock:
+            for turn in turns:
+                keys = [user_key(turn["user_id"])]
+                if turn.get("session_id"):
+                    keys.append(session_key(turn["session_id"]))
+                for key in keys:
+                    self._filling.pop(key, None)
+                    entry = self._data.get(key)
+                    if entry is None:
+                        continue
+                    entry.turns.insert(0, turn)
+                    entry.users.add(turn["user_id"])
+                    entry.size += _turn_size(turn)
+                    self._bytes += _turn_size(turn)
+                    while len(entry.turns) > self.max_turns:
+                        dropped = entry.turns.pop()
+                        entry.size -= _turn_size(dropped)
+                        self._bytes -= _turn_size(dropped)
+            self._evict()
+        self._publish({"users": sorted(users), "sessions": sorted(sessions)})
+
+    def invalidate(self, user_id: int, broadcast: bool = True):
+        """Descarta as entradas do utilizador e das sessões com turnos dele (ex: histórico apagado)"""
+        with self._lock:
+            # Leituras em andamento podem ter visto turnos do utilizador
+            self._filling.clear()
+            self._drop_users({user_id})
+        if broadcast:
+            self._publish({"users": [user_id], "deleted": True})
+
+    def clear(self, broadcast: bool = True):
+        """Descarta todas as entradas (ex: limpeza do histórico antigo)"""
+        with self._lock:
+            self._data.clear()
+            self._filling.clear()
+            self._bytes = 0
+            self.invalidations += 1
+        if broadcast:
+            self._publish({"all": True})
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "shared_invalidation": self._client() is not None,
+            "subscribed": self._subscribed,
+            "max_turns": self.max_turns,
+            "ttl": self.ttl,
+            "entries": len(self._data),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "context_hits": self.context_hits,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "remote_invalidations": self.remote_invalidations,
+            "errors": self.errors
+        }
+
+    def _drop_users(self, users):
+        for key in [key for key, entry in self._data.items() if entry.users & users]:
+            self._remove(key)
+        self._drop_keys(user_key(user_id) for user_id in users)
+        self.invalidations += 1
+
+    def _drop_keys(self, keys):
+        for key in keys:
+            self._filling.pop(key, None)
+            if key in self._data:
+                self._remove(key)
+
+    def _evict(self):
+        while self._data and (len(self._data) > self.max_entries or self._bytes > self.max_bytes):
+            self._remove(next(iter(self._data)))
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        entry = self._data.pop(key)
+        self._bytes -= entry.size
+
+    # Invalidação entre processos
+    def _client(self):
+        return self.redis_client or get_redis_client()
+
+    def _publish(self, message: Dict[str, Any]):
+        client = self._client()
+        if client is None:
+            return
+        try:
+            client.publish(self.channel, json.dumps({"origin": self._origin, **message}))
+        except Exception as e:
+            self.errors += 1
+            print(f"Erro ao publicar invalidação da cache de contexto: {e}")
+
+    def _ensure_listener(self):
+        if self._listener is not None and self._listener.is_alive():
+            return
+        with self._lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(target=self._listen, name="context-cache-invalidation", daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        while True:
+            pubsub = None
+            try:
+                pubsub = self._client().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # Invalidações perdidas enquanto não estava inscrito
+                self.clear(broadcast=False)
+                self._subscribed = True
+                for message in pubsub.listen():
+                    self._on_message(message.get("data"))
+            except Exception as e:
+                self.errors += 1
+                print(f"Erro no canal de invalidação da cache de contexto: {e}")
+            finally:
+                self._subscribed = False
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+            time.sleep(5)
+
+    def _on_message(self, data):
+        try:
+            message = json.loads(data)
+        except (TypeError, ValueError):
+            return
+        if message.get("origin") == self._origin:
+            return
+        self.remote_invalidations += 1
+        with self._lock:
+            if message.get("all"):
+                self._data.clear()
+                self._filling.clear()
+                self._bytes = 0
+                return
+            if message.get("deleted"):
+                self._filling.clear()
+                self._drop_users(set(message.get("users", ())))
+                return
+            # Turnos gravados noutro processo: só as listas do utilizador e das sessões mudaram
+            self._drop_keys([user_key(user_id) for user_id in message.get("users", ())]
+                            + [session_key(session_id) for session_id in message.get("sessions", ())])
+
+
+def _turn_size(turn: Dict[str, Any]) -> int:
+    return len(turn.get("message") or "") + len(turn.get("response") or "") + TURN_OVERHEAD_BYTES
+
+
+context_cache = ContextCache()
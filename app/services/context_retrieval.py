@@ -0,0 +1,241 @@
+"""
+Contexto da conversa por relevância em vez dos N turnos mais recentes
+Cada turno salvo no histórico é indexado em background (embeddings); na
+requisição, a pergunta é comparada com o índice do utilizador e os turnos
+mais parecidos entram no contexto até ao orçamento de tokens
+"""
+import os
+import queue
+import threading
+from typing import Dict, Any, Iterable, List
+from dotenv import load_dotenv
+
+from app.models.tables import ChatHistory
+from app.services.embeddings import get_embedder, vector_indexes
+from app.services.circuit_breaker import circuit_breakers
+from app.services.prompt_builder import count_tokens
+
+load_dotenv()
+
+RETRIEVAL_ENABLED = os.environ.get("RETRIEVAL_ENABLED", "False").lower() == "true"
+RETRIEVAL_TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", "4"))
+RETRIEVAL_MIN_SCORE = float(os.environ.get("RETRIEVAL_MIN_SCORE", "0.35"))
+RETRIEVAL_TOKEN_BUDGET = int(os.environ.get("RETRIEVAL_TOKEN_BUDGET", "1200"))
+RETRIEVAL_RECENT_TURNS = int(os.environ.get("RETRIEVAL_RECENT_TURNS", "2"))
+RETRIEVAL_BACKFILL = int(os.environ.get("RETRIEVAL_BACKFILL", "200"))
+RETRIEVAL_QUEUE_SIZE = int(os.environ.get("RETRIEVAL_QUEUE_SIZE", "1000"))
+RETRIEVAL_BATCH_SIZE = int(os.environ.get("RETRIEVAL_BATCH_SIZE", "16"))
+
+
+def turn_text(message: str, response: str = None) -> str:
+    """Texto de um turno usado no embedding"""
+    return f"{message}\n{response}" if response else message
+
+
+class ContextRetriever:
+    """
+    Indexação (fila + thread) e seleção dos turnos relevantes por utilizador
+
+    Qualquer falha (embedder indisponível, circuito aberto, índice ainda
+    vazio) resulta em lista vazia: o contexto volta aos turnos recentes.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = RETRIEVAL_ENABLED,
+        top_k: int = RETRIEVAL_TOP_K,
+        min_score: float = RETRIEVAL_MIN_SCORE,
+        token_budget: int = RETRIEVAL_TOKEN_BUDGET,
+        backfill: int = RETRIEVAL_BACKFILL,
+        queue_size: int = RETRIEVAL_QUEUE_SIZE,
+        batch_size: int = RETRIEVAL_BATCH_SIZE
+    ):
+        self.enabled = enabled
+        self.top_k = top_k
+        self.min_score = min_score
+        self.token_budget = token_budget
+        self.backfill = backfill
+        self.batch_size = batch_size
+        self._queue: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self._worker = None
+        self._lock = threading.Lock()
+        self._synced = set()
+        self._epochs: Dict[int, int] = {}
+        self.indexed = 0
+        self.dropped = 0
+        self.index_failures = 0
+        self.queries = 0
+        self.query_failures = 0
+        self.selected = 0
+
+    def index_turns(self, chats: Iterable[ChatHistory]):
+        """Agenda a indexação de turnos acabados de salvar (não bloqueia)"""
+        if not self.enabled or get_embedder() is None:
+            return
+        for chat in chats:
+            self._enqueue(chat.user_id, chat.id, turn_text(chat.message, chat.response))
+
+    def forget(self, user_id: int):
+        """Descarta o índice do utilizador (ex: histórico apagado)"""
+        with self._lock:
+            # Itens ainda na fila deixam de valer (não recriam o índice apagado)
+            self._epochs[user_id] = self._epochs.get(user_id, 0) + 1
+            self._synced.discard(user_id)
+            vector_indexes.drop(user_id)
+
+    def select(self, user_id: int, message: str, recent: List[ChatHistory] = ()) -> List[ChatHistory]:
+        """
+        Turnos antigos mais relevantes para a pergunta, dentro do orçamento de tokens
+
+        Args:
+            user_id: ID do usuário
+            message: Pergunta atual
+            recent: Turnos recentes que já vão no contexto (não são repetidos)
+
+        Returns:
+            Lista de ChatHistory do mais antigo ao mais recente (vazia se indisponível)
+        """
+        embedder = get_embedder()
+        if not self.enabled or embedder is None or not message.strip():
+            return []
+
+        self._sync(user_id)
+        index = vector_indexes.get(user_id)
+        if index is None or not index.size:
+            return []
+
+        self.queries += 1
+        try:
+            with circuit_breakers.call(embedder.backend):
+                query = embedder.embed([message])[0]
+        except Exception as e:
+            self.query_failures += 1
+            print(f"Erro ao gerar embedding da pergunta: {e}")
+            return []
+
+        exclude = [chat.id for chat in recent]
+        hits = [(chat_id, score) for chat_id, score in index.search(query, self.top_k, exclude) if score >= self.min_score]
+        if not hits:
+            return []
+
+        rows = {
+            chat.id: chat
+            for chat in ChatHistory.query.filter(
+                ChatHistory.user_id == user_id,
+                ChatHistory.id.in_([chat_id for chat_id, _ in hits])
+            ).all()
+        }
+
+        chosen, used = [], 0
+        for chat_id, _ in hits:
+            chat = rows.get(chat_id)
+            if chat is None:
+                # Linha apagada depois de indexada
+                index.remove([chat_id])
+                continue
+            tokens = count_tokens(turn_text(chat.message, chat.response))
+            if used + tokens > self.token_budget:
+                continue
+            chosen.append(chat)
+            used += tokens
+
+        self.selected += len(chosen)
+        return sorted(chosen, key=lambda chat: chat.id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "embedder": getattr(get_embedder(), "name", None),
+            "top_k": self.top_k,
+            "min_score": self.min_score,
+            "token_budget": self.token_budget,
+            "queue_depth": self._queue.qsize(),
+            "indexed": self.indexed,
+            "dropped": self.dropped,
+            "index_failures": self.index_failures,
+            "queries": self.queries,
+            "query_failures": self.query_failures,
+            "selected_turns": self.selected,
+            "indexes": vector_indexes.stats()
+        }
+
+    def _sync(self, user_id: int):
+        """
+        Na primeira consulta do utilizador no processo, agenda os turnos que
+        ainda não estão no índice (salvos antes de ativar, com a fila cheia
+        ou cuja indexação falhou)
+        """
+        index = vector_indexes.get(user_id)
+        with self._lock:
+            # Índice só em memória e despejado do LRU: volta a ser reconstruído
+            if user_id in self._synced and (index is not None or self._queue.qsize()):
+                return
+            self._synced.add(user_id)
+
+        after_id = index.max_id if index is not None else 0
+        missing = ChatHistory.query.filter(
+            ChatHistory.user_id == user_id,
+            ChatHistory.id > after_id
+        ).order_by(ChatHistory.id.desc()).limit(self.backfill).all()
+
+        for chat in reversed(missing):
+            self._enqueue(chat.user_id, chat.id, turn_text(chat.message, chat.response))
+
+    def _enqueue(self, user_id: int, chat_id: int, text: str):
+        try:
+            self._queue.put_nowait((user_id, chat_id, text, self._epochs.get(user_id, 0)))
+        except queue.Full:
+            self.dropped += 1
+            return
+        self._ensure_worker()
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._work, name="embedding-indexer", daemon=True)
+                self._worker.start()
+
+    def _work(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self._index_batch(batch)
+            except Exception as e:
+                self.index_failures += len(batch)
+                print(f"Erro ao indexar histórico (embeddings): {e}")
+                # A próxima consulta de cada utilizador volta a agendar o que faltou
+                with self._lock:
+                    self._synced.difference_update(item[0] for item in batch)
+
+    def _index_batch(self, batch):
+        embedder = get_embedder()
+        if embedder is None:
+            return
+
+        with circuit_breakers.call(embedder.backend):
+            vectors = embedder.embed([text for _, _, text, _ in batch])
+
+        by_user: Dict[int, List[int]] = {}
+        for position, (user_id, _, _, epoch) in enumerate(batch):
+            if epoch == self._epochs.get(user_id, 0):
+                by_user.setdefault(user_id, []).append(position)
+
+        for user_id, positions in by_user.items():
+            with self._lock:
+                if batch[positions[0]][3] != self._epochs.get(user_id, 0):
+                    continue
+                index = vector_indexes.get(user_id, create=True)
+                index.add([batch[p][1] for p in positions], vectors[positions])
+                vector_indexes.save(user_id)
+            self.indexed += len(positions)
+
+
+context_retriever = ContextRetriever()
@@ -0,0 +1,320 @@
+"""
+Embeddings do histórico de conversas
+Embedder (Ollama /api/embed ou um substituto com a mesma interface) e índice
+vetorial compacto por utilizador: matriz NumPy float32 normalizada, persistida
+em .npy e reaberta com mmap
+"""
+import os
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+import numpy as np
+from dotenv import load_dotenv
+
+from app.services.ollama_http import ollama_http
+from app.services.ollama_pool import ollama_pool, OllamaLease, is_node_failure
+from app.services.ollama_sessions import OLLAMA_KEEP_ALIVE
+
+load_dotenv()
+
+EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "nomic-embed-text:latest")
+EMBEDDING_OLLAMA_URL = os.environ.get("EMBEDDING_OLLAMA_URL")
+EMBEDDING_TIMEOUT = float(os.environ.get("EMBEDDING_TIMEOUT", "5"))
+EMBEDDING_MAX_CHARS = int(os.environ.get("EMBEDDING_MAX_CHARS", "2000"))
+EMBEDDING_INDEX_DIR = os.environ.get("EMBEDDING_INDEX_DIR")
+EMBEDDING_MAX_USERS = int(os.environ.get("EMBEDDING_MAX_USERS", "256"))
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """Normaliza as linhas (norma 1) para que o produto interno seja a similaridade de cosseno"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class OllamaEmbedder:
+    """Embeddings via POST /api/embed (vários textos por chamada)"""
+
+    def __init__(self, model: str = EMBEDDING_MODEL, ollama_url: str = EMBEDDING_OLLAMA_URL,
+                 timeout: float = EMBEDDING_TIMEOUT):
+        self.model = model
+        self.ollama_url = ollama_url.rstrip('/') if ollama_url else None
+        self.timeout = timeout
+
+    @property
+    def name(self) -> str:
+        """Identifica o espaço vetorial (vetores de modelos diferentes não se comparam)"""
+        return f"ollama-{self.model}"
+
+    @property
+    def backend(self) -> str:
+        """Chave do circuit breaker"""
+        return f"embed:{self.ollama_url or 'pool'}"
+
+    @contextmanager
+    def _lease(self):
+        if self.ollama_url:
+            yield OllamaLease(self.ollama_url)
+        else:
+            with ollama_pool.acquire(self.model) as lease:
+                yield lease
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """
+        Args:
+            texts: Textos a converter (cortados em EMBEDDING_MAX_CHARS)
+
+        Returns:
+            Matriz (len(texts), dimensões) com linhas normalizadas
+        """
+        payload = {
+            "model": self.model,
+            "input": [text[:EMBEDDING_MAX_CHARS] for text in texts]
+        }
+        if OLLAMA_KEEP_ALIVE:
+            payload["keep_alive"] = OLLAMA_KEEP_ALIVE
+
+        with self._lease() as lease:
+            response = ollama_http.post(lease.url, "/api/embed", read_timeout=self.timeout, json=payload)
+            if response.status_code != 200:
+                if is_node_failure(status_code=response.status_code):
+                    lease.fail(f"HTTP {response.status_code}")
+                raise RuntimeError(f"Erro na API Ollama (embed): {response.status_code}")
+            vectors = response.json().get("embeddings") or []
+
+        if len(vectors) != len(texts):
+            raise RuntimeError("Resposta de embeddings incompleta")
+        return normalize(vectors)
+
+
+class UserVectorIndex:
+    """
+    Vetores de um utilizador e ids das linhas do ChatHistory correspondentes
+
+    Os arrays crescem por duplicação; um índice aberto do disco (mmap, só
+    leitura) é copiado para memória apenas na primeira escrita.
+    """
+
+    def __init__(self, ids: np.ndarray = None, vectors: np.ndarray = None):
+        self._ids = ids if ids is not None else np.zeros(0, dtype=np.int64)
+        self._vectors = vectors
+        self.size = len(self._ids)
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    @property
+    def dimensions(self) -> Optional[int]:
+        return self._vectors.shape[1] if self._vectors is not None else None
+
+    @property
+    def max_id(self) -> int:
+        with self.lock:
+            return int(self._ids[:self.size].max()) if self.size else 0
+
+    def add(self, ids: List[int], vectors: np.ndarray):
+        with self.lock:
+            if self._vectors is not None and vectors.shape[1] != self._vectors.shape[1]:
+                raise ValueError("Dimensão dos embeddings diferente da do índice")
+
+            # Linha já indexada (ex: reindexação) é substituída
+            self._delete(ids)
+            self._reserve(self.size + len(ids), vectors.shape[1])
+            self._ids[self.size:self.size + len(ids)] = ids
+            self._vectors[self.size:self.size + len(ids)] = vectors
+            self.size += len(ids)
+            self.dirty = True
+
+    def remove(self, ids: Iterable[int]) -> int:
+        with self.lock:
+            return self._delete(list(ids))
+
+    def search(self, query: np.ndarray, k: int, exclude: Iterable[int] = ()) -> List[Tuple[int, float]]:
+        """
+        Returns:
+            Até k tuplas (id, similaridade) da mais para a menos parecida
+        """
+        with self.lock:
+            if not self.size or k <= 0:
+                return []
+            scores = np.asarray(self._vectors[:self.size] @ query, dtype=np.float32)
+            ids = np.array(self._ids[:self.size])
+
+        excluded = np.isin(ids, list(exclude))
+        scores[excluded] = -np.inf
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(ids[i]), float(scores[i])) for i in top if np.isfinite(scores[i])]
+
+    def arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Cópia das linhas ocupadas (para persistir)"""
+        with self.lock:
+            self.dirty = False
+            return np.array(self._ids[:self.size]), np.array(self._vectors[:self.size])
+
+    def _reserve(self, size: int, dimensions: int):
+        capacity = len(self._ids)
+        writable = self._vectors is not None and self._vectors.flags.writeable
+        if size <= capacity and writable:
+            return
+        if size > capacity:
+            capacity = max(16, size, capacity * 2)
+        ids = np.zeros(capacity, dtype=np.int64)
+        vectors = np.zeros((capacity, dimensions), dtype=np.float32)
+        ids[:self.size] = self._ids[:self.size]
+        if self._vectors is not None:
+            vectors[:self.size] = self._vectors[:self.size]
+        self._ids, self._vectors = ids, vectors
+
+    def _delete(self, ids: List[int]) -> int:
+        if not self.size or not ids:
+            return 0
+        keep = ~np.isin(self._ids[:self.size], ids)
+        removed = self.size - int(keep.sum())
+        if removed:
+            self._ids = np.array(self._ids[:self.size][keep])
+            self._vectors = np.array(self._vectors[:self.size][keep])
+            self.size = len(self._ids)
+            self.dirty = True
+        return removed
+
+
+class VectorIndexStore:
+    """
+    Índices por utilizador carregados em memória (LRU de EMBEDDING_MAX_USERS)
+
+    Com EMBEDDING_INDEX_DIR, cada índice é gravado em
+    <dir>/<embedder>/<user_id>.ids.npy e .vectors.npy; sem diretório fica só
+    em memória e é reconstruído pelo backfill depois de um restart.
+    """
+
+    def __init__(self, directory: str = EMBEDDING_INDEX_DIR, max_users: int = EMBEDDING_MAX_USERS):
+        self.directory = directory
+        self.max_users = max_users
+        self.namespace = "default"
+        self._indexes: "OrderedDict[int, UserVectorIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def use_namespace(self, namespace: str):
+        """Troca o espaço vetorial (outro embedder); os índices em memória são descartados"""
+        namespace = re.sub(r"[^A-Za-z0-9_.-]", "_", namespace)
+        with self._lock:
+            if namespace != self.namespace:
+                self.namespace = namespace
+                self._indexes.clear()
+
+    def get(self, user_id: int, create: bool = False) -> Optional[UserVectorIndex]:
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is not None:
+                self._indexes.move_to_end(user_id)
+                return index
+
+        index = self._load(user_id)
+        if index is None and not create:
+            return None
+
+        evicted = []
+        with self._lock:
+            # Outra thread pode ter carregado o mesmo utilizador entretanto
+            index = self._indexes.setdefault(user_id, index or UserVectorIndex())
+            self._indexes.move_to_end(user_id)
+            while len(self._indexes) > self.max_users:
+                evicted.append(self._indexes.popitem(last=False))
+
+        for evicted_id, evicted_index in evicted:
+            self._write(evicted_id, evicted_index)
+        return index
+
+    def drop(self, user_id: int):
+        """Apaga o índice do utilizador (memória e disco)"""
+        with self._lock:
+            self._indexes.pop(user_id, None)
+        for path in self._paths(user_id):
+            if path and os.path.exists(path):
+                os.remove(path)
+
+    def save(self, user_id: int):
+        with self._lock:
+            index = self._indexes.get(user_id)
+        if index is not None:
+            self._write(user_id, index)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            indexes = list(self._indexes.values())
+        return {
+            "namespace": self.namespace,
+            "directory": self.directory,
+            "loaded_users": len(indexes),
+            "max_users": self.max_users,
+            "vectors": sum(index.size for index in indexes)
+        }
+
+    def _write(self, user_id: int, index: UserVectorIndex):
+        if not self.directory or not index.dirty or index.dimensions is None:
+            return
+
+        ids, vectors = index.arrays()
+        ids_path, vectors_path = self._paths(user_id)
+        os.makedirs(os.path.dirname(ids_path), exist_ok=True)
+        # Vetores primeiro: um .ids.npy novo nunca aponta para vetores antigos
+        for path, array in ((vectors_path, vectors), (ids_path, ids)):
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp_path, path)
+
+    def _paths(self, user_id: int) -> Tuple[Optional[str], Optional[str]]:
+        if not self.directory:
+            return None, None
+        base = os.path.join(self.directory, self.namespace, str(int(user_id)))
+        return f"{base}.ids.npy", f"{base}.vectors.npy"
+
+    def _load(self, user_id: int) -> Optional[UserVectorIndex]:
+        ids_path, vectors_path = self._paths(user_id)
+        if not ids_path or not os.path.exists(ids_path) or not os.path.exists(vectors_path):
+            return None
+        try:
+            ids = np.load(ids_path)
+            vectors = np.load(vectors_path, mmap_mode="r")
+            if len(ids) != len(vectors):
+                raise ValueError("ids e vetores com tamanhos diferentes")
+            return UserVectorIndex(ids, vectors)
+        except Exception as e:
+            print(f"⚠️ Índice de embeddings inválido para o utilizador {user_id}: {e}")
+            return None
+
+
+_embedder = None
+_embedder_lock = threading.Lock()
+
+vector_indexes = VectorIndexStore()
+
+
+def get_embedder():
+    """
+    Embedder partilhado pelo processo: OllamaEmbedder se houver EMBEDDING_OLLAMA_URL
+    ou pool de servidores configurado (senão None)
+    """
+    global _embedder
+    with _embedder_lock:
+        if _embedder is None and (EMBEDDING_OLLAMA_URL or ollama_pool.configured):
+            _embedder = OllamaEmbedder()
+            vector_indexes.use_namespace(_embedder.name)
+        return _embedder
+
+
+def set_embedder(embedder):
+    """
+    Substitui o embedder por qualquer objeto com embed(texts) -> matriz normalizada,
+    name (espaço vetorial) e backend (chave do circuit breaker); None restaura o padrão
+    """
+    global _embedder
+    with _embedder_lock:
+        _embedder = embedder
+        if embedder is not None:
+            vector_indexes.use_namespace(embedder.name)
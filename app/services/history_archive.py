@@ -0,0 +1,330 @@
+"""
+Arquivo do histórico de chat antigo
+Turnos mais antigos que ARCHIVE_AFTER_DAYS saem de chat_history para
+segmentos JSONL comprimidos (gzip), só de escrita, por utilizador e mês:
+<dir>/<user_id>/<AAAA-MM>/<primeiro_id>-<último_id>.jsonl.gz. O ficheiro
+<dir>/index.jsonl tem uma linha por segmento (ids, datas, sessões e uso por
+modelo) e é o único lido para decidir que segmentos abrir
+"""
+import os
+import json
+import gzip
+import time
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+from dotenv import load_dotenv
+from sqlalchemy import delete, func, select
+
+from app import app, db
+from app.models.base import utcnow
+from app.models.tables import ChatHistory
+
+load_dotenv()
+
+ARCHIVE_ENABLED = os.environ.get("ARCHIVE_ENABLED", "False").lower() == "true"
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR") or os.path.join(app.instance_path, "history_archive")
+ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", "1000"))
+ARCHIVE_BATCH_PAUSE = float(os.environ.get("ARCHIVE_BATCH_PAUSE", "0.2"))
+
+ARCHIVE_FIELDS = ("id", "user_id", "message", "response", "model_used", "service_type",
+                  "session_id", "created_at", "updated_at")
+
+
+def row_key(row: Dict[str, Any]) -> Tuple[str, int]:
+    """Ordem do histórico: (created_at, id)"""
+    return row.get("created_at") or "", row["id"]
+
+
+class HistoryArchive:
+    """
+    Segmentos de histórico arquivado e o índice deles
+
+    Um lote é arquivado assim: segmentos gravados (ficheiro temporário +
+    rename), linhas acrescentadas ao índice, e só depois as linhas saem do
+    SQL. Uma falha entre estes passos deixa no máximo turnos repetidos no
+    arquivo e na tabela, que as leituras juntam pelo id.
+    """
+
+    def __init__(self, directory: str = ARCHIVE_DIR, enabled: bool = ARCHIVE_ENABLED,
+                 batch_size: int = ARCHIVE_BATCH_SIZE, pause: float = ARCHIVE_BATCH_PAUSE):
+        self.directory = directory
+        self.enabled = enabled
+        self.batch_size = max(1, batch_size)
+        self.pause = pause
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()
+        self._index: Dict[int, List[Dict[str, Any]]] = {}
+        self._index_mtime = None
+        self.archived = 0
+        self.segments_written = 0
+        self.segment_reads = 0
+        self.last_run = None
+        self.last_error = None
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.directory, "index.jsonl")
+
+    # Escrita
+    def archive_before(self, days: int = ARCHIVE_AFTER_DAYS, progress=None) -> int:
+        """
+        Move para o arquivo os turnos com created_at anterior a `days` dias, em lotes
+
+        Returns:
+            Número de turnos arquivados
+        """
+        if not self._run_lock.acquire(blocking=False):
+            raise RuntimeError("Arquivo do histórico já em andamento")
+        try:
+            cutoff = utcnow() - timedelta(days=days)
+            end_id = db.session.execute(select(func.max(ChatHistory.id))).scalar() or 0
+            table = ChatHistory.__table__
+            archived, next_id = 0, 0
+
+            while next_id <= end_id:
+                rows = db.session.execute(
+                    select(*(table.c[field] for field in ARCHIVE_FIELDS))
+                    .where(table.c.id >= next_id, table.c.id <= end_id, table.c.created_at < cutoff)
+                    .order_by(table.c.id)
+                    .limit(self.batch_size)
+                ).mappings().all()
+                if not rows:
+                    break
+
+                self._write_batch([serialize_row(row) for row in rows])
+                ids = [row["id"] for row in rows]
+                try:
+                    db.session.execute(delete(table).where(table.c.id.in_(ids)))
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    self.last_error = str(e)
+                    raise
+
+                archived += len(ids)
+                self.archived += len(ids)
+                next_id = ids[-1] + 1
+                if progress is not None:
+                    progress({"job": "archive", "archived": archived, "next_id": next_id, "end_id": end_id})
+                if self.pause:
+                    time.sleep(self.pause)
+
+            self.last_run = utcnow().isoformat()
+            return archived
+        finally:
+            self._run_lock.release()
+
+    def drop_user(self, user_id: int) -> int:
+        """Apaga os segmentos do utilizador (ex: histórico apagado); devolve os turnos removidos"""
+        with self._lock:
+            entries = self._load_index().get(user_id, [])
+            if not entries:
+                return 0
+            self._rewrite_index(lambda entry: entry["user_id"] != user_id)
+        for entry in entries:
+            self._remove_segment(entry)
+        return sum(entry["rows"] for entry in entries)
+
+    def drop_before(self, cutoff: datetime) -> List[Dict[str, Any]]:
+        """
+        Apaga os segmentos em que todos os turnos são anteriores a `cutoff` (retenção)
+
+        Returns:
+            Entradas do índice removidas (com o uso por modelo, para os contadores)
+        """
+        cutoff = cutoff.isoformat()
+        with self._lock:
+            expired = [
+                entry for entries in self._load_index().values() for entry in entries
+                if entry["max_created_at"] and entry["max_created_at"] < cutoff
+            ]
+            if not expired:
+                return []
+            paths = {entry["path"] for entry in expired}
+            self._rewrite_index(lambda entry: entry["path"] not in paths)
+        for entry in expired:
+            self._remove_segment(entry)
+        return expired
+
+    # Leitura
+    def has_rows(self, user_id: int = None) -> bool:
+        if user_id is None:
+            return any(self._entries())
+        return bool(self._entries(user_id))
+
+    def newest(self, user_id: int, session_id: str = None) -> Optional[str]:
+        """created_at (ISO) do turno arquivado mais recente do utilizador/sessão"""
+        dates = [entry["max_created_at"] for entry in self._entries(user_id, session_id) if entry["max_created_at"]]
+        return max(dates) if dates else None
+
+    def rows(self, user_id: int = None, session_id: str = None, before: Tuple[str, int] = None,
+             limit: int = None) -> List[Dict[str, Any]]:
+        """
+        Turnos arquivados do mais recente para o mais antigo (formato de ChatHistory.to_dict())
+
+        Args:
+            user_id: Utilizador (None = procura a sessão em todos)
+            session_id: Só os turnos da sessão
+            before: (created_at ISO, id) do último turno já lido (paginação)
+            limit: Máximo de turnos; os segmentos mais antigos só são abertos se faltarem turnos
+        """
+        entries = sorted(
+            (entry for entry in self._entries(user_id, session_id)
+             if before is None or (entry["min_created_at"] or "") <= before[0]),
+            key=lambda entry: entry["max_created_at"] or "",
+            reverse=True
+        )
+
+        found: Dict[int, Dict[str, Any]] = {}
+        for position, entry in enumerate(entries):
+            for row in self._read_segment(entry):
+                if session_id is not None and row.get("session_id") != session_id:
+                    continue
+                if before is not None and row_key(row) >= before:
+                    continue
+                found[row["id"]] = row
+
+            if limit is not None and len(found) >= limit:
+                ordered = sorted(found.values(), key=row_key, reverse=True)
+                following = entries[position + 1] if position + 1 < len(entries) else None
+                # Os segmentos seguintes só têm turnos mais antigos que o último que entra
+                if following is None or (following["max_created_at"] or "") < row_key(ordered[limit - 1])[0]:
+                    return ordered[:limit]
+
+        ordered = sorted(found.values(), key=row_key, reverse=True)
+        return ordered[:limit] if limit is not None else ordered
+
+    def usage(self, user_id: int) -> List[Tuple[str, str, str, int]]:
+        """Uso arquivado do utilizador: (modelo, serviço, dia, mensagens)"""
+        return [tuple(item) for entry in self._entries(user_id) for item in entry.get("usage", ())]
+
+    def stats(self) -> Dict[str, Any]:
+        entries = self._entries()
+        return {
+            "enabled": self.enabled,
+            "directory": self.directory,
+            "segments": len(entries),
+            "rows": sum(entry["rows"] for entry in entries),
+            "bytes": sum(entry.get("bytes", 0) for entry in entries),
+            "archived": self.archived,
+            "segments_written": self.segments_written,
+            "segment_reads": self.segment_reads,
+            "last_run": self.last_run,
+            "last_error": self.last_error
+        }
+
+    # Segmentos e índice
+    def _write_batch(self, rows: List[Dict[str, Any]]):
+        groups: Dict[Tuple[int, str], List[Dict[str, Any]]] = {}
+        for row in rows:
+            month = (row.get("created_at") or "0000-00")[:7]
+            groups.setdefault((row["user_id"], month), []).append(row)
+
+        entries = []
+        for (user_id, month), group in groups.items():
+            path = os.path.join(str(int(user_id)), month, f"{group[0]['id']}-{group[-1]['id']}.jsonl.gz")
+            full_path = os.path.join(self.directory, path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            tmp_path = f"{full_path}.tmp"
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+                for row in group:
+                    f.write(json.dumps(row, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, full_path)
+
+            dates = [row["created_at"] for row in group if row.get("created_at")]
+            usage = Counter(
+                (row.get("model_used") or "", row.get("service_type") or "", (row.get("created_at") or "")[:10])
+                for row in group
+            )
+            entries.append({
+                "path": path,
+                "user_id": user_id,
+                "month": month,
+                "first_id": group[0]["id"],
+                "last_id": group[-1]["id"],
+                "rows": len(group),
+                "bytes": os.path.getsize(full_path),
+                "min_created_at": min(dates) if dates else None,
+                "max_created_at": max(dates) if dates else None,
+                "sessions": sorted({row["session_id"] for row in group if row.get("session_id")}),
+                "usage": [[model, service, day, count] for (model, service, day), count in usage.items()]
+            })
+
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.index_path, "a", encoding="utf-8") as f:
+                for entry in entries:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        self.segments_written += len(entries)
+
+    def _read_segment(self, entry: Dict[str, Any]) -> Iterable[Dict[str, Any]]:
+        self.segment_reads += 1
+        try:
+            with gzip.open(os.path.join(self.directory, entry["path"]), "rt", encoding="utf-8") as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Segmento do arquivo ilegível ({entry['path']}): {e}")
+            return []
+
+    def _remove_segment(self, entry: Dict[str, Any]):
+        path = os.path.join(self.directory, entry["path"])
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _entries(self, user_id: int = None, session_id: str = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            index = self._load_index()
+        entries = index.get(user_id, []) if user_id is not None else [entry for items in index.values() for entry in items]
+        if session_id is not None:
+            entries = [entry for entry in entries if session_id in entry["sessions"]]
+        return entries
+
+    def _load_index(self) -> Dict[int, List[Dict[str, Any]]]:
+        """Índice por utilizador, relido só quando o ficheiro muda (outro processo arquivou)"""
+        try:
+            stat = os.stat(self.index_path)
+        except OSError:
+            self._index, self._index_mtime = {}, None
+            return self._index
+
+        mtime = (stat.st_mtime_ns, stat.st_size)
+        if mtime != self._index_mtime:
+            index: Dict[int, List[Dict[str, Any]]] = {}
+            with open(self.index_path, encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Linha cortada por uma falha a meio da escrita
+                        continue
+                    index.setdefault(entry["user_id"], []).append(entry)
+            self._index, self._index_mtime = index, mtime
+        return self._index
+
+    def _rewrite_index(self, keep):
+        entries = [entry for items in self._load_index().values() for entry in items if keep(entry)]
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.index_path)
+        self._index_mtime = None
+
+
+def serialize_row(row) -> Dict[str, Any]:
+    """Linha lida do SQL (mapping) no formato de ChatHistory.to_dict()"""
+    data = dict(row)
+    for field in ("created_at", "updated_at"):
+        if data.get(field) is not None:
+            data[field] = data[field].isoformat()
+    return data
+
+
+history_archive = HistoryArchive()
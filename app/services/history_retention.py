@@ -0,0 +1,249 @@
+"""
+Retenção do histórico de chat
+Apaga em lotes pequenos por intervalo de chave primária, com uma pausa entre
+lotes: cada DELETE é uma transação curta (bloqueios e log de transações
+limitados) e as gravações do chat continuam entre lotes. O progresso fica num
+checkpoint em disco para que uma limpeza interrompida continue de onde parou
+"""
+import os
+import json
+import time
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Any, Callable, Optional
+from dotenv import load_dotenv
+from sqlalchemy import delete, func, select
+
+from app import app, db
+from app.models.base import utcnow
+from app.models.tables import ChatHistory
+from app.services.usage_stats import usage_counters
+
+load_dotenv()
+
+RETENTION_DAYS = int(os.environ.get("RETENTION_DAYS", "30"))
+RETENTION_SOFT_DELETE_GRACE_DAYS = int(os.environ.get("RETENTION_SOFT_DELETE_GRACE_DAYS", "7"))
+RETENTION_BATCH_SIZE = int(os.environ.get("RETENTION_BATCH_SIZE", "1000"))
+RETENTION_BATCH_PAUSE = float(os.environ.get("RETENTION_BATCH_PAUSE", "0.2"))
+RETENTION_SCHEDULE = os.environ.get("RETENTION_SCHEDULE", "False").lower() == "true"
+RETENTION_INTERVAL_HOURS = float(os.environ.get("RETENTION_INTERVAL_HOURS", "24"))
+RETENTION_INITIAL_DELAY = float(os.environ.get("RETENTION_INITIAL_DELAY", "300"))
+RETENTION_STATE_FILE = os.environ.get("RETENTION_STATE_FILE") or os.path.join(app.instance_path, "retention_state.json")
+
+
+class PurgeInProgress(Exception):
+    """Já há uma limpeza do mesmo tipo a correr neste processo"""
+
+
+class HistoryPurger:
+    """
+    Limpezas em lotes: turnos expirados (created_at), turnos com soft delete
+    (deleted_at) depois do prazo de recuperação e o histórico de um utilizador
+
+    Cada lote lê os próximos `batch_size` ids que cumprem a condição e apaga
+    esse intervalo de ids. As limpezas de retenção gravam o checkpoint (data
+    de corte e próximo id) depois de cada lote; ao retomar usam a mesma data
+    de corte, senão turnos abaixo do checkpoint ficariam por apagar.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = RETENTION_BATCH_SIZE,
+        pause: float = RETENTION_BATCH_PAUSE,
+        state_file: str = RETENTION_STATE_FILE
+    ):
+        self.batch_size = max(1, batch_size)
+        self.pause = pause
+        self.state_file = state_file
+        self._locks: Dict[str, threading.Lock] = {"expired": threading.Lock(), "soft_deleted": threading.Lock()}
+        self._state_lock = threading.Lock()
+        self._scheduler = None
+        self.runs = 0
+        self.deleted = 0
+        self.batches = 0
+        self.resumed = 0
+        self.failures = 0
+        self.last_run = None
+        self.last_error = None
+
+    def purge_expired(self, days: int = RETENTION_DAYS, resume: bool = True,
+                      progress: Callable[[Dict[str, Any]], None] = None) -> int:
+        """
+        Apaga os turnos com created_at anterior a `days` dias
+
+        Args:
+            resume: Continua uma limpeza interrompida (com a data de corte dela)
+            progress: Chamado depois de cada lote com o progresso
+
+        Returns:
+            Número de registros apagados
+        """
+        return self._run_job("expired", ChatHistory.created_at, utcnow() - timedelta(days=days), resume, progress)
+
+    def purge_soft_deleted(self, grace_days: int = RETENTION_SOFT_DELETE_GRACE_DAYS, resume: bool = True,
+                           progress: Callable[[Dict[str, Any]], None] = None) -> int:
+        """Apaga de vez os turnos com deleted_at há mais de `grace_days` dias"""
+        return self._run_job("soft_deleted", ChatHistory.deleted_at, utcnow() - timedelta(days=grace_days), resume, progress)
+
+    def purge_user(self, user_id: int, pause: float = 0,
+                   progress: Callable[[Dict[str, Any]], None] = None) -> int:
+        """Apaga o histórico do utilizador em lotes (sem checkpoint: repetir apaga o que faltar)"""
+        condition = ChatHistory.user_id == user_id
+        return self._purge("user", condition, 0, self._max_id(), pause, progress)
+
+    def pending_checkpoints(self) -> Dict[str, Any]:
+        """Limpezas interrompidas que serão retomadas"""
+        with self._state_lock:
+            return self._load_state()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "batch_size": self.batch_size,
+            "pause": self.pause,
+            "scheduled": self._scheduler is not None,
+            "running": [job for job, lock in self._locks.items() if lock.locked()],
+            "runs": self.runs,
+            "deleted": self.deleted,
+            "batches": self.batches,
+            "resumed": self.resumed,
+            "failures": self.failures,
+            "last_run": self.last_run,
+            "last_error": self.last_error,
+            "checkpoints": self.pending_checkpoints()
+        }
+
+    def schedule(self, job: Callable[[], Any], interval_hours: float = RETENTION_INTERVAL_HOURS,
+                 initial_delay: float = RETENTION_INITIAL_DELAY):
+        """
+        Corre `job` numa thread a cada `interval_hours`, a primeira vez depois
+        de `initial_delay` segundos (não concorre com o arranque da aplicação)
+        """
+        if self._scheduler is not None:
+            return
+        self._scheduler = threading.Thread(
+            target=self._schedule_loop,
+            args=(job, interval_hours * 3600, initial_delay),
+            name="history-retention",
+            daemon=True
+        )
+        self._scheduler.start()
+
+    def _schedule_loop(self, job: Callable[[], Any], interval: float, delay: float):
+        time.sleep(delay)
+        while True:
+            try:
+                with app.app_context():
+                    job()
+            except PurgeInProgress:
+                pass
+            except Exception as e:
+                print(f"Erro na limpeza agendada do histórico: {e}")
+            time.sleep(interval)
+
+    def _run_job(self, job: str, column, cutoff, resume: bool, progress) -> int:
+        lock = self._locks[job]
+        if not lock.acquire(blocking=False):
+            raise PurgeInProgress(f"Limpeza '{job}' já em andamento")
+        try:
+            start_id = 0
+            checkpoint = self.pending_checkpoints().get(job) if resume else None
+            if checkpoint:
+                cutoff = datetime.fromisoformat(checkpoint["cutoff"])
+                start_id = checkpoint["next_id"]
+                self.resumed += 1
+                print(f"⚠️ A retomar limpeza '{job}' interrompida (corte {checkpoint['cutoff']}, id {start_id})")
+
+            # Até ao maior id: turnos importados ou gravados fora de ordem também têm ids altos
+            condition = column < cutoff
+            end_id = self._max_id()
+
+            def save(next_id: int):
+                self._save_checkpoint(job, {"cutoff": cutoff.isoformat(), "next_id": next_id})
+
+            self.runs += 1
+            deleted = self._purge(job, condition, start_id, end_id, self.pause, progress, save)
+            self._save_checkpoint(job, None)
+            self.last_run = utcnow().isoformat()
+            return deleted
+        finally:
+            lock.release()
+
+    def _purge(self, job: str, condition, start_id: int, end_id: int, pause: float,
+               progress=None, checkpoint: Callable[[int], None] = None) -> int:
+        deleted = 0
+        next_id = start_id
+        while next_id <= end_id:
+            try:
+                rows = db.session.execute(
+                    select(ChatHistory.id, ChatHistory.user_id, ChatHistory.model_used,
+                           ChatHistory.service_type, ChatHistory.created_at)
+                    .where(ChatHistory.id >= next_id, ChatHistory.id <= end_id, condition)
+                    .order_by(ChatHistory.id)
+                    .limit(self.batch_size)
+                ).all()
+                if not rows:
+                    break
+                ids = [row[0] for row in rows]
+
+                # Os ids lidos são todos os que cumprem a condição no intervalo: o DELETE fica limitado ao lote
+                result = db.session.execute(
+                    delete(ChatHistory.__table__).where(
+                        ChatHistory.id >= ids[0],
+                        ChatHistory.id <= ids[-1],
+                        condition
+                    )
+                )
+                usage_counters.subtract(row[1:] for row in rows)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                self.failures += 1
+                self.last_error = str(e)
+                raise
+
+            deleted += result.rowcount
+            self.deleted += result.rowcount
+            self.batches += 1
+            next_id = ids[-1] + 1
+            if checkpoint is not None:
+                checkpoint(next_id)
+            if progress is not None:
+                progress({"job": job, "deleted": deleted, "next_id": next_id, "end_id": end_id})
+            if pause:
+                time.sleep(pause)
+        return deleted
+
+    @staticmethod
+    def _max_id() -> int:
+        return db.session.execute(select(func.max(ChatHistory.id))).scalar() or 0
+
+    def _load_state(self) -> Dict[str, Any]:
+        if not self.state_file or not os.path.exists(self.state_file):
+            return {}
+        try:
+            with open(self.state_file, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Checkpoint da retenção inválido ({self.state_file}): {e}")
+            return {}
+
+    def _save_checkpoint(self, job: str, checkpoint: Optional[Dict[str, Any]]):
+        if not self.state_file:
+            return
+        with self._state_lock:
+            state = self._load_state()
+            if checkpoint is None:
+                if job not in state:
+                    return
+                state.pop(job)
+            else:
+                state[job] = checkpoint
+
+            os.makedirs(os.path.dirname(os.path.abspath(self.state_file)), exist_ok=True)
+            tmp_path = f"{self.state_file}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.state_file)
+
+
+history_purger = HistoryPurger()
@@ -0,0 +1,233 @@
+"""
+Gravação do histórico de chat em segundo plano (write-behind)
+As mensagens entram numa fila limitada e uma thread grava-as em lote (um
+commit por lote, INSERT de várias linhas) quando junta HISTORY_FLUSH_BATCH
+mensagens ou passam HISTORY_FLUSH_INTERVAL segundos
+"""
+import os
+import time
+import queue
+import atexit
+import threading
+from typing import Dict, Any, Callable, List
+from dotenv import load_dotenv
+
+from app import app, db
+from app.models.base import utcnow
+from app.models.tables import ChatHistory
+from app.services.usage_stats import usage_counters
+
+load_dotenv()
+
+HISTORY_WRITE_BEHIND = os.environ.get("HISTORY_WRITE_BEHIND", "False").lower() == "true"
+HISTORY_QUEUE_SIZE = int(os.environ.get("HISTORY_QUEUE_SIZE", "10000"))
+HISTORY_FLUSH_BATCH = int(os.environ.get("HISTORY_FLUSH_BATCH", "100"))
+HISTORY_FLUSH_INTERVAL = float(os.environ.get("HISTORY_FLUSH_INTERVAL", "0.5"))
+HISTORY_FLUSH_RETRIES = int(os.environ.get("HISTORY_FLUSH_RETRIES", "3"))
+
+CHAT_FIELDS = ("user_id", "message", "response", "model_used", "service_type", "session_id")
+
+
+def chat_from_entry(entry: Dict[str, Any]) -> ChatHistory:
+    """ChatHistory (ainda sem id) com os campos e a data de uma entrada da fila"""
+    chat = ChatHistory(**{field: entry.get(field) for field in CHAT_FIELDS})
+    chat.created_at = entry["created_at"]
+    return chat
+
+
+class HistoryWriter:
+    """
+    Fila de mensagens por gravar e buffer das que ainda não chegaram ao SQL
+
+    O buffer (por utilizador) permite ler as próprias escritas antes do
+    flush. Com a fila cheia, a mensagem é gravada de forma síncrona em vez
+    de se perder; um lote só é descartado depois de HISTORY_FLUSH_RETRIES
+    tentativas falhadas.
+    """
+
+    def __init__(
+        self,
+        on_flush: Callable[[List[ChatHistory]], None] = None,
+        queue_size: int = HISTORY_QUEUE_SIZE,
+        batch_size: int = HISTORY_FLUSH_BATCH,
+        interval: float = HISTORY_FLUSH_INTERVAL,
+        retries: int = HISTORY_FLUSH_RETRIES
+    ):
+        """
+        Args:
+            on_flush: Chamado com as linhas acabadas de gravar (ex: cache Redis, embeddings)
+        """
+        self.on_flush = on_flush
+        self.batch_size = max(1, batch_size)
+        self.interval = interval
+        self.retries = retries
+        self._queue: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self._pending: Dict[int, List[Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._in_flight = 0
+        self._worker = None
+        self._closed = False
+        self.enqueued = 0
+        self.flushed = 0
+        self.batches = 0
+        self.retried = 0
+        self.dropped = 0
+        self.sync_writes = 0
+        self.last_error = None
+        atexit.register(self.close)
+
+    def submit(self, entries: List[Dict[str, Any]]) -> bool:
+        """
+        Agenda a gravação das entradas (campos de ChatHistory e created_at)
+
+        Returns:
+            False se a fila está cheia ou fechada (o chamador grava de forma síncrona)
+        """
+        if self._closed:
+            return False
+        for entry in entries:
+            entry.setdefault("created_at", utcnow())
+        with self._lock:
+            if self._queue.qsize() + len(entries) > self._queue.maxsize:
+                self.sync_writes += len(entries)
+                return False
+            for entry in entries:
+                self._pending.setdefault(entry["user_id"], []).append(entry)
+                self._queue.put_nowait(entry)
+                self._in_flight += 1
+            self.enqueued += len(entries)
+        self._ensure_worker()
+        return True
+
+    def pending(self, user_id: int = None, session_id: str = None) -> List[Dict[str, Any]]:
+        """Entradas do utilizador e/ou da sessão ainda não gravadas, da mais recente para a mais antiga"""
+        with self._lock:
+            if user_id is not None:
+                entries = list(self._pending.get(user_id, ()))
+            else:
+                entries = sorted(
+                    (entry for user_entries in self._pending.values() for entry in user_entries),
+                    key=lambda entry: entry["created_at"]
+                )
+        if session_id is not None:
+            entries = [entry for entry in entries if entry.get("session_id") == session_id]
+        return entries[::-1]
+
+    def discard(self, user_id: int):
+        """Esquece as entradas ainda na fila do utilizador (ex: histórico apagado)"""
+        with self._lock:
+            for entry in self._pending.pop(user_id, ()):
+                entry["discarded"] = True
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Espera até a fila esvaziar
+
+        Returns:
+            False se o timeout terminou antes
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        self._ensure_worker()
+        with self._idle:
+            while self._in_flight:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def close(self, timeout: float = 10.0):
+        """Grava o que falta antes de o processo terminar"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._in_flight and not self.flush(timeout):
+            print(f"⚠️ Histórico por gravar ao terminar: {self._in_flight} mensagens")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            backlog = self._in_flight
+        return {
+            "batch_size": self.batch_size,
+            "interval": self.interval,
+            "backlog": backlog,
+            "enqueued": self.enqueued,
+            "flushed": self.flushed,
+            "batches": self.batches,
+            "retried": self.retried,
+            "dropped": self.dropped,
+            "sync_writes": self.sync_writes,
+            "last_error": self.last_error
+        }
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._work, name="history-writer", daemon=True)
+                self._worker.start()
+
+    def _work(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                self._write(batch)
+            finally:
+                with self._idle:
+                    self._in_flight -= len(batch)
+                    for entry in batch:
+                        entries = self._pending.get(entry["user_id"], [])
+                        for position, pending in enumerate(entries):
+                            if pending is entry:
+                                del entries[position]
+                                break
+                        if not entries:
+                            self._pending.pop(entry["user_id"], None)
+                    self._idle.notify_all()
+
+    def _write(self, batch: List[Dict[str, Any]]):
+        for attempt in range(self.retries + 1):
+            entries = [entry for entry in batch if not entry.get("discarded")]
+            if not entries or self._commit(entries):
+                return
+            if attempt < self.retries:
+                self.retried += 1
+                time.sleep(min(2.0, 0.1 * 2 ** attempt))
+
+        # Lote que continua a falhar: uma a uma, só as linhas com problema se perdem
+        failed = len(entries) if len(entries) == 1 else sum(1 for entry in entries if not self._commit([entry]))
+        self.dropped += failed
+        print(f"Erro ao gravar histórico em lote ({failed} mensagens descartadas): {self.last_error}")
+
+    def _commit(self, entries: List[Dict[str, Any]]) -> bool:
+        with app.app_context():
+            chats = [chat_from_entry(entry) for entry in entries]
+            try:
+                db.session.add_all(chats)
+                usage_counters.record(chats)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                self.last_error = str(e)
+                return False
+
+            self.batches += 1
+            self.flushed += len(chats)
+            if self.on_flush is not None:
+                try:
+                    self.on_flush(chats)
+                except Exception as e:
+                    print(f"Erro após gravar histórico em lote: {e}")
+            return True
@@ -0,0 +1,304 @@
+"""
+Instrumentação das requisições do chatbot
+Tempo por etapa (histórico, catálogo, prompt, fila, LLM, gravação, OCR, formatação)
+enviado no cabeçalho Server-Timing e agregado em histogramas no formato Prometheus (/metrics)
+"""
+import os
+import time
+import functools
+import threading
+from contextlib import contextmanager
+from typing import Dict, Callable, Iterable, List, Tuple
+from flask import g, has_app_context, request
+from dotenv import load_dotenv
+
+load_dotenv()
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "True").lower() == "true"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+METRICS_MAX_SERIES = int(os.environ.get("METRICS_MAX_SERIES", "1000"))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+REQUEST_LABELS = ("model", "backend", "channel")
+_INF_BUCKET = 'le="+Inf"'
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _series_key(labelnames: Tuple[str, ...], labels: Dict[str, str], existing: Dict) -> Tuple[str, ...]:
+    """
+    Valores das labels de uma série; acima de METRICS_MAX_SERIES as séries novas
+    são agrupadas em "other" (labels como o modelo vêm do pedido do utilizador)
+    """
+    key = tuple(str(labels.get(name, "")) for name in labelnames)
+    if key not in existing and len(existing) >= METRICS_MAX_SERIES:
+        key = tuple("other" for _ in labelnames)
+    return key
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        with self._lock:
+            key = _series_key(self.labelnames, labels, self._values)
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        with self._lock:
+            key = _series_key(self.labelnames, labels, self._series)
+            series = self._series.get(key)
+            if series is None:
+                series = [[0] * len(self.buckets), 0.0, 0]
+                self._series[key] = series
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((key, (list(s[0]), s[1], s[2])) for key, s in self._series.items())
+        for key, (counts, total, count) in items:
+            for bound, bucket_count in zip(self.buckets, counts):
+                labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, _INF_BUCKET)} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Métricas do processo em formato de texto Prometheus
+
+    Além dos contadores/histogramas próprios, coletores registados exportam
+    no momento da leitura os contadores que os serviços já mantêm
+    (cache de respostas, coalescência, controlo de admissão).
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors: List[Callable[[], Iterable[Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]]]] = []
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        """
+        collector() -> iterável de (nome, tipo, descrição, [(labels, valor), ...])
+        """
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            try:
+                families = list(collector())
+            except Exception as e:
+                print(f"Erro ao coletar métricas: {e}")
+                continue
+            for name, kind, documentation, samples in families:
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    names = tuple(labels.keys())
+                    lines.append(f"{name}{_format_labels(names, tuple(labels[n] for n in names))} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+STAGE_SECONDS = metrics.histogram(
+    "chatbot_stage_duration_seconds",
+    "Duração de cada etapa das requisições do chatbot",
+    ("stage",) + REQUEST_LABELS
+)
+REQUEST_SECONDS = metrics.histogram(
+    "chatbot_request_duration_seconds",
+    "Duração total das requisições do chatbot",
+    REQUEST_LABELS
+)
+ERRORS = metrics.counter(
+    "chatbot_errors_total",
+    "Falhas nas requisições do chatbot por motivo",
+    ("reason",) + REQUEST_LABELS
+)
+TIMEOUTS = metrics.counter(
+    "chatbot_backend_timeouts_total",
+    "Timeouts nas chamadas aos backends de modelos",
+    ("backend",)
+)
+
+
+def _request_state():
+    """Estado de instrumentação da requisição atual (None fora de requisições)"""
+    if not METRICS_ENABLED or not has_app_context():
+        return None
+    return g.get("_metrics")
+
+
+@contextmanager
+def stage(name: str):
+    """Mede uma etapa da requisição atual (sem efeito fora de uma requisição)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+def timed(name: str):
+    """Decorador: mede cada chamada da função como a etapa `name`"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_stage(name: str, seconds: float):
+    state = _request_state()
+    if state is not None:
+        state["stages"].append((name, seconds))
+
+
+def label_request(**labels):
+    """Define model/backend/channel da requisição atual (usados nos histogramas)"""
+    state = _request_state()
+    if state is not None:
+        state["labels"].update({k: v for k, v in labels.items() if v})
+        state["observed"] = True
+
+
+def annotate_request(**values):
+    """Guarda valores da requisição atual para a resposta (ex: prompt_tokens)"""
+    state = _request_state()
+    if state is not None:
+        state["notes"].update(values)
+
+
+def request_annotation(name: str, default=None):
+    state = _request_state()
+    return state["notes"].get(name, default) if state is not None else default
+
+
+def count_error(reason: str):
+    state = _request_state()
+    if state is not None:
+        ERRORS.inc(reason=reason, **state["labels"])
+        state["observed"] = True
+    elif METRICS_ENABLED:
+        ERRORS.inc(reason=reason)
+
+
+def count_timeout(backend: str):
+    if METRICS_ENABLED:
+        TIMEOUTS.inc(backend=backend)
+
+
+def is_timeout(error: Exception) -> bool:
+    """Timeouts de requests, asyncio e do cliente Google (DeadlineExceeded)"""
+    return isinstance(error, TimeoutError) or type(error).__name__ in ("Timeout", "ReadTimeout", "ConnectTimeout", "DeadlineExceeded")
+
+
+def server_timing(stages: List[Tuple[str, float]], total: float = None) -> str:
+    """Cabeçalho Server-Timing; etapas repetidas são somadas"""
+    merged: Dict[str, float] = {}
+    for name, seconds in stages:
+        merged[name] = merged.get(name, 0.0) + seconds
+    parts = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in merged.items()]
+    if total is not None:
+        parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+
+def init_app(app):
+    """Liga a instrumentação ao ciclo de vida das requisições"""
+    if not METRICS_ENABLED:
+        return
+
+    @app.before_request
+    def _start_request_metrics():
+        g._metrics = {
+            "start": time.perf_counter(),
+            "stages": [],
+            "labels": {"channel": "whatsapp" if request.path.startswith("/whatsapp") else "web"},
+            "notes": {},
+            "observed": False
+        }
+
+    @app.after_request
+    def _add_server_timing(response):
+        state = g.get("_metrics")
+        if state is not None and state["stages"]:
+            # Em respostas de streaming, as etapas seguintes só entram nos histogramas
+            response.headers["Server-Timing"] = server_timing(
+                state["stages"], time.perf_counter() - state["start"]
+            )
+        return response
+
+    @app.teardown_request
+    def _observe_request_metrics(error=None):
+        # Com stream_with_context, corre só depois de o stream terminar
+        state = g.pop("_metrics", None)
+        if state is None or not (state["observed"] or state["stages"]):
+            return
+        labels = {name: state["labels"].get(name, "") for name in REQUEST_LABELS}
+        for name, seconds in state["stages"]:
+            STAGE_SECONDS.observe(seconds, stage=name, **labels)
+        REQUEST_SECONDS.observe(time.perf_counter() - state["start"], **labels)
+        if error is not None:
+            ERRORS.inc(reason="exception", **labels)
@@ -0,0 +1,168 @@
+"""
+Catálogo de modelos Ollama por URL
+Mantém a última lista conhecida de cada servidor e atualiza em background,
+para que o caminho da requisição faça apenas uma consulta em memória
+"""
+import os
+import threading
+import time
+from typing import Dict, Any, List, Optional
+from dotenv import load_dotenv
+
+from app.services.ollama_http import ollama_http
+
+load_dotenv()
+
+OLLAMA_CATALOG_TTL = float(os.environ.get("OLLAMA_CATALOG_TTL", "30"))
+OLLAMA_PROBE_TIMEOUT = float(os.environ.get("OLLAMA_PROBE_TIMEOUT", "5"))
+OLLAMA_CATALOG_MAX_URLS = int(os.environ.get("OLLAMA_CATALOG_MAX_URLS", "64"))
+
+
+class _CatalogEntry:
+    """Estado do catálogo de um servidor Ollama"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.models: List[Dict[str, Any]] = []
+        self.healthy = False
+        self.last_refresh: Optional[float] = None
+        self.last_success: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.last_access = time.time()
+        self.refreshing = False
+        self.loaded = threading.Event()
+
+
+class ModelCatalog:
+    """
+    Catálogo de modelos por URL Ollama com refresh em background (TTL)
+    Se um refresh falhar, continua servindo a última lista conhecida
+    """
+
+    def __init__(self, ttl: float = OLLAMA_CATALOG_TTL, probe_timeout: float = OLLAMA_PROBE_TIMEOUT,
+                 max_urls: int = OLLAMA_CATALOG_MAX_URLS):
+        self.ttl = ttl
+        self.probe_timeout = probe_timeout
+        self.max_urls = max_urls
+        self._entries: Dict[str, _CatalogEntry] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize_url(ollama_url: str) -> str:
+        return ollama_url.rstrip('/')
+
+    def get_models(self, ollama_url: str) -> List[Dict[str, Any]]:
+        """
+        Retorna a lista de modelos (formato /api/tags) conhecida para a URL
+
+        Na primeira consulta de uma URL faz um probe síncrono; depois disso
+        apenas agenda um refresh em background quando o TTL expira.
+        """
+        if not ollama_url:
+            return []
+
+        url = self._normalize_url(ollama_url)
+        with self._lock:
+            entry = self._entries.get(url)
+            is_new = entry is None
+            if is_new:
+                entry = self._add_entry(url)
+                entry.refreshing = True
+            entry.last_access = time.time()
+            stale = entry.last_refresh is not None and time.time() - entry.last_refresh >= self.ttl
+
+        if is_new:
+            self.refresh(url)
+        elif not entry.loaded.is_set():
+            entry.loaded.wait(self.probe_timeout)
+        elif stale:
+            self._schedule_refresh(entry)
+
+        return list(entry.models)
+
+    def is_healthy(self, ollama_url: str) -> bool:
+        """Indica se o último refresh da URL teve sucesso"""
+        if not ollama_url:
+            return False
+        self.get_models(ollama_url)
+        entry = self._entries.get(self._normalize_url(ollama_url))
+        return bool(entry and entry.healthy)
+
+    def refresh(self, ollama_url: str) -> bool:
+        """Atualiza o catálogo da URL de forma síncrona"""
+        url = self._normalize_url(ollama_url)
+        with self._lock:
+            entry = self._entries.get(url) or self._add_entry(url)
+
+        try:
+            models = self._fetch_models(url)
+        except Exception as e:
+            entry.healthy = False
+            entry.last_error = str(e)
+        else:
+            entry.models = models
+            entry.healthy = True
+            entry.last_error = None
+            entry.last_success = time.time()
+        finally:
+            entry.last_refresh = time.time()
+            entry.refreshing = False
+            entry.loaded.set()
+
+        return entry.healthy
+
+    def invalidate(self, ollama_url: str = None):
+        """Remove o catálogo de uma URL (ou de todas)"""
+        with self._lock:
+            if ollama_url:
+                self._entries.pop(self._normalize_url(ollama_url), None)
+            else:
+                self._entries.clear()
+
+    def status(self) -> Dict[str, Any]:
+        """Retorna quando cada catálogo foi atualizado e se está saudável"""
+        with self._lock:
+            entries = list(self._entries.values())
+
+        return {
+            entry.url: {
+                "healthy": entry.healthy,
+                "models": len(entry.models),
+                "last_refresh": entry.last_refresh,
+                "last_success": entry.last_success,
+                "last_error": entry.last_error,
+                "refreshing": entry.refreshing
+            }
+            for entry in entries
+        }
+
+    def _add_entry(self, url: str) -> _CatalogEntry:
+        """Cria a entrada da URL, descartando a menos usada se exceder o limite"""
+        if len(self._entries) >= self.max_urls:
+            oldest = min(self._entries.values(), key=lambda e: e.last_access)
+            del self._entries[oldest.url]
+        entry = _CatalogEntry(url)
+        self._entries[url] = entry
+        return entry
+
+    def _schedule_refresh(self, entry: _CatalogEntry):
+        with self._lock:
+            if entry.refreshing:
+                return
+            entry.refreshing = True
+
+        thread = threading.Thread(
+            target=self.refresh,
+            args=(entry.url,),
+            name=f"ollama-catalog-{entry.url}",
+            daemon=True
+        )
+        thread.start()
+
+    def _fetch_models(self, url: str) -> List[Dict[str, Any]]:
+        response = ollama_http.get(url, "/api/tags", read_timeout=self.probe_timeout)
+        response.raise_for_status()
+        return response.json().get('models', [])
+
+
+model_catalog = ModelCatalog()
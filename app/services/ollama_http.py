@@ -0,0 +1,118 @@
+"""
+Pool de conexões HTTP para servidores Ollama
+Uma requests.Session com keep-alive por URL, partilhada entre requisições e threads
+"""
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Dict, Any
+from dotenv import load_dotenv
+
+load_dotenv()
+
+OLLAMA_POOL_SIZE = int(os.environ.get("OLLAMA_POOL_SIZE", "10"))
+OLLAMA_CONNECT_TIMEOUT = float(os.environ.get("OLLAMA_CONNECT_TIMEOUT", "3"))
+OLLAMA_TIMEOUT = int(os.environ.get("OLLAMA_TIMEOUT", "60"))
+OLLAMA_CONNECT_RETRIES = int(os.environ.get("OLLAMA_CONNECT_RETRIES", "2"))
+
+
+class OllamaHTTPPool:
+    """
+    Gerencia uma sessão HTTP (pool de conexões keep-alive) por URL Ollama
+
+    Apenas erros de conexão são repetidos: a requisição ainda não chegou
+    ao servidor, então é seguro repetir inclusive POST /api/generate.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = OLLAMA_POOL_SIZE,
+        connect_timeout: float = OLLAMA_CONNECT_TIMEOUT,
+        read_timeout: float = OLLAMA_TIMEOUT,
+        connect_retries: int = OLLAMA_CONNECT_RETRIES
+    ):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.connect_retries = connect_retries
+        self._sessions: Dict[str, requests.Session] = {}
+        self._lock = threading.Lock()
+
+    def get_session(self, ollama_url: str) -> requests.Session:
+        """Retorna (criando se necessário) a sessão da URL"""
+        url = ollama_url.rstrip('/')
+        session = self._sessions.get(url)
+        if session is not None:
+            return session
+
+        with self._lock:
+            session = self._sessions.get(url)
+            if session is None:
+                session = self._create_session()
+                self._sessions[url] = session
+            return session
+
+    def timeout(self, read_timeout: float = None) -> tuple:
+        """Tupla (connect, read) usada pelo requests"""
+        return (self.connect_timeout, read_timeout if read_timeout is not None else self.read_timeout)
+
+    def get(self, ollama_url: str, path: str, read_timeout: float = None, **kwargs) -> requests.Response:
+        """GET {ollama_url}{path} usando a sessão da URL"""
+        return self.request("GET", ollama_url, path, read_timeout=read_timeout, **kwargs)
+
+    def post(self, ollama_url: str, path: str, read_timeout: float = None, **kwargs) -> requests.Response:
+        """POST {ollama_url}{path} usando a sessão da URL"""
+        return self.request("POST", ollama_url, path, read_timeout=read_timeout, **kwargs)
+
+    def request(self, method: str, ollama_url: str, path: str, read_timeout: float = None, **kwargs) -> requests.Response:
+        session = self.get_session(ollama_url)
+        kwargs.setdefault("timeout", self.timeout(read_timeout))
+        return session.request(method, f"{ollama_url.rstrip('/')}{path}", **kwargs)
+
+    def close(self, ollama_url: str = None):
+        """Fecha a sessão de uma URL (ou todas)"""
+        with self._lock:
+            if ollama_url:
+                sessions = [self._sessions.pop(ollama_url.rstrip('/'), None)]
+            else:
+                sessions = list(self._sessions.values())
+                self._sessions.clear()
+
+        for session in sessions:
+            if session is not None:
+                session.close()
+
+    def status(self) -> Dict[str, Any]:
+        """Configuração do pool e URLs com sessão aberta"""
+        return {
+            "urls": list(self._sessions.keys()),
+            "pool_size": self.pool_size,
+            "connect_timeout": self.connect_timeout,
+            "read_timeout": self.read_timeout,
+            "connect_retries": self.connect_retries
+        }
+
+    def _create_session(self) -> requests.Session:
+        retry = Retry(
+            total=self.connect_retries,
+            connect=self.connect_retries,
+            read=0,
+            status=0,
+            other=0,
+            backoff_factor=0.2,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_size,
+            max_retries=retry
+        )
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+
+ollama_http = OllamaHTTPPool()
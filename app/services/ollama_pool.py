@@ -0,0 +1,222 @@
+"""
+Pool de servidores Ollama do lado do servidor (OLLAMA_POOL_URLS)
+Cada modelo é encaminhado para os nós que o têm carregado, escolhendo o nó
+com menos requisições em andamento; nós com falhas saem de rotação e voltam
+depois de passarem nos health probes
+"""
+import os
+import time
+import threading
+import requests
+from contextlib import contextmanager
+from typing import Dict, Any, List, Optional
+from dotenv import load_dotenv
+
+from app.services.model_catalog import model_catalog
+
+load_dotenv()
+
+OLLAMA_POOL_URLS = [u.strip().rstrip('/') for u in os.environ.get("OLLAMA_POOL_URLS", "").split(",") if u.strip()]
+OLLAMA_POOL_FAILURE_THRESHOLD = int(os.environ.get("OLLAMA_POOL_FAILURE_THRESHOLD", "3"))
+OLLAMA_POOL_RECOVERY_PROBES = int(os.environ.get("OLLAMA_POOL_RECOVERY_PROBES", "2"))
+OLLAMA_POOL_PROBE_INTERVAL = float(os.environ.get("OLLAMA_POOL_PROBE_INTERVAL", "10"))
+
+
+class NoAvailableNode(RuntimeError):
+    """Nenhum nó saudável do pool tem o modelo pedido"""
+
+
+class _Node:
+    """Estado de roteamento de um servidor Ollama do pool"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.recovery_successes = 0
+        self.requests = 0
+        self.failures = 0
+        self.last_error: Optional[str] = None
+        self.unhealthy_since: Optional[float] = None
+
+
+class OllamaLease:
+    """Servidor escolhido para uma requisição; fail() regista falha do nó"""
+
+    def __init__(self, url: str, pool: "OllamaNodePool" = None, node: _Node = None):
+        self.url = url.rstrip('/')
+        self.pool = pool
+        self.node = node
+        self.failed = False
+
+    def fail(self, error: str):
+        if self.node is not None and not self.failed:
+            self.failed = True
+            self.pool.record_failure(self.node, error)
+
+
+def is_node_failure(error: Exception = None, status_code: int = None) -> bool:
+    """Erros que indicam problema no servidor (e não na requisição)"""
+    if status_code is not None:
+        return status_code >= 500
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+class OllamaNodePool:
+    """Roteamento least-outstanding-requests entre vários servidores Ollama"""
+
+    def __init__(
+        self,
+        urls: List[str] = None,
+        failure_threshold: int = OLLAMA_POOL_FAILURE_THRESHOLD,
+        recovery_probes: int = OLLAMA_POOL_RECOVERY_PROBES,
+        probe_interval: float = OLLAMA_POOL_PROBE_INTERVAL
+    ):
+        self.failure_threshold = failure_threshold
+        self.recovery_probes = recovery_probes
+        self.probe_interval = probe_interval
+        self._nodes: Dict[str, _Node] = {url: _Node(url) for url in (urls if urls is not None else OLLAMA_POOL_URLS)}
+        self._lock = threading.Lock()
+        self._prober = None
+
+    @property
+    def configured(self) -> bool:
+        return bool(self._nodes)
+
+    @property
+    def size(self) -> int:
+        return len(self._nodes)
+
+    def models(self) -> List[Dict[str, Any]]:
+        """União dos modelos (formato /api/tags) dos nós saudáveis"""
+        self._ensure_prober()
+        seen = {}
+        for node in self._healthy_nodes():
+            for model in model_catalog.get_models(node.url):
+                seen.setdefault(model.get("name"), model)
+        return list(seen.values())
+
+    def nodes_for(self, model_name: str) -> List[_Node]:
+        """Nós saudáveis que têm o modelo carregado"""
+        return [
+            node for node in self._healthy_nodes()
+            if any(m.get("name") == model_name for m in model_catalog.get_models(node.url))
+        ]
+
+    @contextmanager
+    def acquire(self, model_name: str, prefer_url: str = None):
+        """
+        Reserva o nó com menos requisições em andamento para o modelo
+
+        prefer_url (nó do turno anterior da sessão) é escolhido enquanto não
+        estiver mais de uma requisição acima do menos ocupado, para que o
+        KV cache da conversa nesse nó seja reaproveitado.
+
+        Exceções dentro do bloco contam como falha do nó quando indicam
+        problema de rede/servidor; sair normalmente conta como sucesso.
+        """
+        self._ensure_prober()
+        candidates = self.nodes_for(model_name)
+        if not candidates:
+            raise NoAvailableNode(f"Nenhum servidor Ollama disponível com o modelo {model_name}")
+
+        with self._lock:
+            node = min(candidates, key=lambda n: (n.outstanding, n.requests))
+            preferred = self._nodes.get(prefer_url.rstrip('/')) if prefer_url else None
+            if preferred in candidates and preferred.outstanding <= node.outstanding + 1:
+                node = preferred
+            node.outstanding += 1
+            node.requests += 1
+
+        lease = OllamaLease(node.url, self, node)
+        try:
+            yield lease
+        except Exception as e:
+            if is_node_failure(e):
+                lease.fail(str(e))
+            raise
+        else:
+            if not lease.failed:
+                self.record_success(node)
+        finally:
+            with self._lock:
+                node.outstanding -= 1
+
+    def record_success(self, node: _Node):
+        with self._lock:
+            node.consecutive_failures = 0
+
+    def record_failure(self, node: _Node, error: str):
+        with self._lock:
+            node.failures += 1
+            node.consecutive_failures += 1
+            node.last_error = error
+            if node.healthy and node.consecutive_failures >= self.failure_threshold:
+                node.healthy = False
+                node.recovery_successes = 0
+                node.unhealthy_since = time.time()
+                print(f"⚠️ Servidor Ollama fora de rotação: {node.url} ({error})")
+
+    def probe(self):
+        """Executa um ciclo de health probes (/api/tags) em todos os nós"""
+        for node in list(self._nodes.values()):
+            ok = model_catalog.refresh(node.url)
+            with self._lock:
+                if node.healthy:
+                    if not ok:
+                        node.consecutive_failures += 1
+                        node.last_error = model_catalog.status().get(node.url, {}).get("last_error")
+                        if node.consecutive_failures >= self.failure_threshold:
+                            node.healthy = False
+                            node.recovery_successes = 0
+                            node.unhealthy_since = time.time()
+                elif ok:
+                    node.recovery_successes += 1
+                    if node.recovery_successes >= self.recovery_probes:
+                        node.healthy = True
+                        node.consecutive_failures = 0
+                        node.unhealthy_since = None
+                        print(f"✅ Servidor Ollama de volta à rotação: {node.url}")
+                else:
+                    node.recovery_successes = 0
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            nodes = list(self._nodes.values())
+
+        return {
+            node.url: {
+                "healthy": node.healthy,
+                "outstanding": node.outstanding,
+                "requests": node.requests,
+                "failures": node.failures,
+                "consecutive_failures": node.consecutive_failures,
+                "last_error": node.last_error,
+                "unhealthy_since": node.unhealthy_since
+            }
+            for node in nodes
+        }
+
+    def _healthy_nodes(self) -> List[_Node]:
+        return [node for node in self._nodes.values() if node.healthy]
+
+    def _ensure_prober(self):
+        """Inicia (uma vez) a thread de health probes em background"""
+        if self._prober is not None or not self._nodes:
+            return
+        with self._lock:
+            if self._prober is None:
+                self._prober = threading.Thread(target=self._probe_loop, name="ollama-pool-prober", daemon=True)
+                self._prober.start()
+
+    def _probe_loop(self):
+        while True:
+            time.sleep(self.probe_interval)
+            try:
+                self.probe()
+            except Exception as e:
+                print(f"Erro no health probe do pool Ollama: {e}")
+
+
+ollama_pool = OllamaNodePool()
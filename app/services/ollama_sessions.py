@@ -0,0 +1,143 @@
+"""
+Reaproveitamento do KV cache do Ollama entre turnos de uma sessão
+Modo "chat": /api/chat com mensagens estruturadas (prefixo estável: sistema + turnos anteriores)
+Modo "context": /api/generate com o array `context` devolvido no turno anterior da sessão
+"""
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
+from dotenv import load_dotenv
+
+load_dotenv()
+
+OLLAMA_SESSION_MODE = os.environ.get("OLLAMA_SESSION_MODE", "chat").lower()
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_SESSION_TTL = int(os.environ.get("OLLAMA_SESSION_TTL", "1800"))
+OLLAMA_SESSION_MAX_ENTRIES = int(os.environ.get("OLLAMA_SESSION_MAX_ENTRIES", "1000"))
+
+SESSION_MODES = ("chat", "context", "off")
+
+
+def _fingerprint(text: str) -> str:
+    return hashlib.sha256((text or "").strip().encode("utf-8")).hexdigest()
+
+
+class _SessionState:
+    """Último turno de uma sessão num modelo Ollama"""
+
+    def __init__(self, url: str, context: Optional[List[int]], last_response: str):
+        self.url = url
+        self.context = context
+        self.last_response = _fingerprint(last_response)
+        self.updated_at = time.time()
+
+
+class OllamaSessionStore:
+    """
+    Estado por (session_id, modelo): nó que atendeu o último turno e,
+    no modo "context", os tokens da conversa devolvidos pelo Ollama
+
+    O estado só é usado se o último turno do histórico recebido for o mesmo
+    que ele gerou; caso contrário (despejo, TTL, histórico apagado, turno
+    atendido por outro worker) a geração volta ao contexto em texto.
+    """
+
+    def __init__(self, mode: str = OLLAMA_SESSION_MODE, ttl: int = OLLAMA_SESSION_TTL,
+                 max_entries: int = OLLAMA_SESSION_MAX_ENTRIES):
+        if mode not in SESSION_MODES:
+            print(f"⚠️ OLLAMA_SESSION_MODE inválido ({mode}); usando 'off'")
+            mode = "off"
+        self.mode = mode
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data: "OrderedDict[Tuple[str, str], _SessionState]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def node_for(self, session_id: str, model_name: str) -> Optional[str]:
+        """URL do nó que atendeu o último turno (afinidade no pool)"""
+        if not session_id:
+            return None
+        with self._lock:
+            state = self._data.get((session_id, model_name))
+            return state.url if state is not None else None
+
+    def get_context(self, session_id: str, model_name: str, history: List[Tuple[str, str]] = None) -> Optional[List[int]]:
+        """
+        Tokens da conversa guardados para a sessão, se ainda correspondem ao histórico
+
+        Args:
+            history: Turnos (mensagem, resposta) do mais antigo ao mais recente
+        """
+        if not session_id:
+            return None
+
+        key = (session_id, model_name)
+        with self._lock:
+            state = self._data.get(key)
+            if state is None or state.context is None:
+                self.misses += 1
+                return None
+            if state.updated_at + self.ttl <= time.time():
+                del self._data[key]
+                self.misses += 1
+                return None
+            if not history or _fingerprint(history[-1][1]) != state.last_response:
+                self.stale += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return state.context
+
+    def remember(self, session_id: str, model_name: str, url: str, response: str, context: List[int] = None):
+        """Regista o turno acabado de gerar"""
+        if not session_id or self.mode == "off":
+            return
+
+        key = (session_id, model_name)
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = _SessionState(
+                url.rstrip('/'),
+                context if self.mode == "context" else None,
+                response
+            )
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, ollama_url: str = None) -> int:
+        """Descarta o estado das sessões (de uma URL ou todas)"""
+        with self._lock:
+            if ollama_url is None:
+                count = len(self._data)
+                self._data.clear()
+                return count
+            url = ollama_url.rstrip('/')
+            keys = [key for key, state in self._data.items() if state.url == url]
+            for key in keys:
+                del self._data[key]
+            return len(keys)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "keep_alive": OLLAMA_KEEP_ALIVE,
+                "ttl": self.ttl,
+                "entries": len(self._data),
+                "max_entries": self.max_entries,
+                "context_hits": self.hits,
+                "context_misses": self.misses,
+                "context_stale": self.stale,
+                "evictions": self.evictions
+            }
+
+
+ollama_sessions = OllamaSessionStore()
@@ -0,0 +1,336 @@
+"""
+Montagem dos prompts enviados aos modelos dentro da janela de contexto
+Conta os tokens por modelo (estimativa calibrada com as contagens devolvidas
+pelos backends) e corta o que não cabe no orçamento, a começar pelos turnos
+mais antigos, em vez de deixar o Ollama truncar o prompt em silêncio
+"""
+import os
+import math
+import fnmatch
+import threading
+from typing import Dict, Any, List, Optional, Tuple
+from dotenv import load_dotenv
+
+from app.services.metrics import metrics, annotate_request
+
+load_dotenv()
+
+PROMPT_CONTEXT_WINDOW = int(os.environ.get("PROMPT_CONTEXT_WINDOW", "4096"))
+# Ex: "gemini=1000000;ollama_llama3*=8192" (o modelo aceita curingas)
+PROMPT_CONTEXT_WINDOWS = os.environ.get("PROMPT_CONTEXT_WINDOWS", "gemini=1000000")
+PROMPT_RESPONSE_TOKENS = int(os.environ.get("PROMPT_RESPONSE_TOKENS", "1024"))
+PROMPT_CHARS_PER_TOKEN = float(os.environ.get("PROMPT_CHARS_PER_TOKEN", "3.5"))
+PROMPT_CALIBRATION_ALPHA = float(os.environ.get("PROMPT_CALIBRATION_ALPHA", "0.1"))
+PROMPT_SET_NUM_CTX = os.environ.get("PROMPT_SET_NUM_CTX", "True").lower() == "true"
+
+# Tokens do template de chat por mensagem (papel, delimitadores)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SYSTEM_PROMPT = """Você é StudentHub, um assistente educacional inteligente.
+Suas características:
+- Responde sempre em português
+- É claro, preciso e educativo
+- Usa exemplos práticos
+- Formata respostas matemáticas em LaTeX quando apropriado
+
+REGRAS DE FORMATAÇÃO LATEX (IMPORTANTE):
+- Para expressões matemáticas INLINE use: \\(expressão\\) ou $expressão$
+- Para equações EM BLOCO use: \\[equação\\] ou $$equação$$
+- Exemplo inline: A solução é \\(x = 1\\)
+- Exemplo bloco:
+  \\[
+  2x - 2 = 0
+  \\]
+
+Você pode usar qualquer um desses formatos, ambos funcionam perfeitamente!
+"""
+
+PROMPT_TOKENS = metrics.histogram(
+    "chatbot_prompt_tokens",
+    "Tokens (estimados) dos prompts enviados aos modelos",
+    ("model",),
+    buckets=(128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 131072)
+)
+PROMPT_TRIMMED = metrics.counter(
+    "chatbot_prompt_trimmed_total",
+    "Prompts reduzidos para caber na janela de contexto, por parte cortada",
+    ("model", "part")
+)
+
+
+def render_context(history: List[Tuple[str, str]], summary: str = None) -> str:
+    """Contexto em texto (Gemini e /api/generate): resumo seguido dos turnos"""
+    turns = "\n".join([f"User: {message}\nBot: {response}" for message, response in history])
+    if not summary:
+        return turns
+    return f"Resumo da conversa até aqui:\n{summary}\n\n{turns}".rstrip()
+
+
+def system_with_summary(summary: str = None) -> str:
+    """Mensagem de sistema do modo chat (o resumo da sessão vai no fim, depois do prefixo fixo)"""
+    if not summary:
+        return SYSTEM_PROMPT
+    return f"{SYSTEM_PROMPT}\nResumo da conversa até aqui:\n{summary}\n"
+
+
+def _parse_windows(spec: str) -> List[Tuple[str, int]]:
+    """Regras "modelo=tokens" separadas por ";" """
+    rules = []
+    for rule in spec.split(";"):
+        if "=" not in rule:
+            continue
+        pattern, tokens = rule.split("=", 1)
+        try:
+            rules.append((pattern.strip(), int(tokens)))
+        except ValueError:
+            print(f"⚠️ Janela de contexto inválida em PROMPT_CONTEXT_WINDOWS: {rule}")
+    return rules
+
+
+class TokenEstimator:
+    """
+    Tokens a partir do número de caracteres, com uma razão caracteres/token
+    por modelo ajustada (média móvel exponencial) pelas contagens reais
+
+    Com KV cache o Ollama só conta os tokens que avaliou, não o prompt todo,
+    logo uma contagem real nunca passa do tamanho do prompt: amostras com mais
+    tokens que o estimado entram sempre, as com bem menos são descartadas.
+    """
+
+    def __init__(self, chars_per_token: float = PROMPT_CHARS_PER_TOKEN, alpha: float = PROMPT_CALIBRATION_ALPHA):
+        self.chars_per_token = chars_per_token
+        self.alpha = alpha
+        self._ratios: Dict[str, float] = {}
+        self._samples: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.discarded = 0
+
+    def ratio(self, model: str = None) -> float:
+        return self._ratios.get(model, self.chars_per_token)
+
+    def count(self, text: str, model: str = None) -> int:
+        if not text:
+            return 0
+        return max(1, math.ceil(len(text) / self.ratio(model)))
+
+    def observe(self, model: str, chars: int, tokens: int) -> bool:
+        """
+        Regista a contagem real de um prompt de `chars` caracteres
+
+        Returns:
+            True se a amostra entrou na calibração
+        """
+        if not model or chars <= 0 or not tokens or tokens <= 0:
+            return False
+        sample = chars / tokens
+        with self._lock:
+            current = self._ratios.get(model, self.chars_per_token)
+            if not 0.5 <= sample / current <= 1.2:
+                self.discarded += 1
+                return False
+            # Primeira amostra substitui o valor inicial por inteiro
+            if model not in self._samples:
+                self._ratios[model] = sample
+            else:
+                self._ratios[model] = current + self.alpha * (sample - current)
+            self._samples[model] = self._samples.get(model, 0) + 1
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "default_chars_per_token": self.chars_per_token,
+                "discarded_samples": self.discarded,
+                "models": {
+                    model: {"chars_per_token": round(ratio, 3), "samples": self._samples.get(model, 0)}
+                    for model, ratio in self._ratios.items()
+                }
+            }
+
+
+class Prompt:
+    """Partes do prompt que couberam no orçamento e a sua contagem de tokens"""
+
+    def __init__(self, model: str, system: str, message: str, turns: List[Tuple[str, str]],
+                 summary: Optional[str], context: str, tokens: int, window: int, trimmed: List[str]):
+        self.model = model
+        self.system = system
+        self.message = message
+        self.turns = turns
+        self.summary = summary
+        self.context = context
+        self.tokens = tokens
+        self.window = window
+        self.trimmed = trimmed
+
+    @property
+    def chars(self) -> int:
+        """Caracteres do prompt (para calibrar com a contagem real do backend)"""
+        return len(self.system) + len(self.message) + len(self.context)
+
+    @property
+    def overhead(self) -> int:
+        """Tokens estimados do template de chat (não dependem do texto)"""
+        return MESSAGE_OVERHEAD_TOKENS * (2 + 2 * len(self.turns))
+
+
+class PromptBuilder:
+    """
+    Orçamento por modelo: janela de contexto menos PROMPT_RESPONSE_TOKENS
+    reservados para a resposta
+
+    O que entra, por prioridade: prompt de sistema e pergunta, resumo da
+    sessão e depois os turnos, do mais recente para o mais antigo.
+    """
+
+    def __init__(
+        self,
+        default_window: int = PROMPT_CONTEXT_WINDOW,
+        windows: str = PROMPT_CONTEXT_WINDOWS,
+        response_tokens: int = PROMPT_RESPONSE_TOKENS,
+        set_num_ctx: bool = PROMPT_SET_NUM_CTX
+    ):
+        self.default_window = default_window
+        self.response_tokens = response_tokens
+        self.set_num_ctx = set_num_ctx
+        self.estimator = TokenEstimator()
+        self._windows = _parse_windows(windows)
+        self._system_tokens: Dict[str, Tuple[float, int]] = {}
+        self.built = 0
+        self.trimmed = 0
+
+    def window(self, model: str) -> int:
+        """Janela de contexto (tokens) do model_type"""
+        for pattern, tokens in self._windows:
+            if fnmatch.fnmatchcase(model, pattern):
+                return tokens
+        return self.default_window
+
+    def budget(self, model: str) -> int:
+        window = self.window(model)
+        return max(window // 2, window - self.response_tokens)
+
+    def count(self, text: str, model: str = None) -> int:
+        return self.estimator.count(text, model)
+
+    def system_tokens(self, model: str) -> int:
+        """Tokens do prompt de sistema fixo (em cache até a calibração do modelo mudar)"""
+        ratio = self.estimator.ratio(model)
+        cached = self._system_tokens.get(model)
+        if cached is None or cached[0] != ratio:
+            cached = (ratio, self.count(SYSTEM_PROMPT, model) + MESSAGE_OVERHEAD_TOKENS)
+            self._system_tokens[model] = cached
+        return cached[1]
+
+    def build(self, model: str, message: str, context: str = "",
+              history: List[Tuple[str, str]] = None, prefix_tokens: int = 0) -> Prompt:
+        """
+        Args:
+            model: model_type (orçamento e calibração)
+            message: Pergunta atual (cortada no meio só se sozinha passar do orçamento)
+            context: Contexto em texto, usado quando não há histórico estruturado
+                (os turnos mais antigos ficam no início e são cortados primeiro)
+            history: Turnos (mensagem, resposta) do mais antigo ao mais recente;
+                com um atributo `summary`, o resumo da sessão entra no prompt
+            prefix_tokens: Tokens da sessão já guardados no Ollama (modo context)
+
+        Returns:
+            Prompt com os turnos e o contexto que couberam
+        """
+        budget = self.budget(model)
+        trimmed = []
+        used = self.system_tokens(model) + prefix_tokens
+
+        message_tokens = self.count(message, model) + MESSAGE_OVERHEAD_TOKENS
+        if used + message_tokens > budget:
+            message = self._cut_middle(message, budget - used - MESSAGE_OVERHEAD_TOKENS, model)
+            message_tokens = self.count(message, model) + MESSAGE_OVERHEAD_TOKENS
+            trimmed.append("message")
+        used += message_tokens
+
+        turns = []
+        summary = getattr(history, "summary", None)
+        if history is not None:
+            if summary:
+                summary_tokens = self.count(summary, model)
+                if used + summary_tokens > budget:
+                    summary = self._keep_tail(summary, budget - used, model) or None
+                    summary_tokens = self.count(summary, model)
+                    trimmed.append("summary")
+                used += summary_tokens
+            # Do mais recente para o mais antigo: os turnos antigos são os primeiros a sair
+            for user_message, bot_response in reversed(history):
+                turn_tokens = self.count(user_message, model) + self.count(bot_response, model) + 2 * MESSAGE_OVERHEAD_TOKENS
+                if used + turn_tokens > budget:
+                    trimmed.append("history")
+                    break
+                turns.append((user_message, bot_response))
+                used += turn_tokens
+            turns.reverse()
+            context = render_context(turns, summary)
+        elif context:
+            context_tokens = self.count(context, model)
+            if used + context_tokens > budget:
+                context = self._keep_tail(context, budget - used, model)
+                context_tokens = self.count(context, model)
+                trimmed.append("context")
+            used += context_tokens
+
+        prompt = Prompt(model, SYSTEM_PROMPT, message, turns, summary, context, used, self.window(model), trimmed)
+        self._record(prompt)
+        return prompt
+
+    def observe(self, prompt: Prompt, prompt_tokens: int, cached_prefix: bool = False) -> bool:
+        """Contagem real devolvida pelo backend (ignorada se parte do prompt veio do KV cache)"""
+        if cached_prefix or not prompt_tokens:
+            return False
+        return self.estimator.observe(prompt.model, prompt.chars, prompt_tokens - prompt.overhead)
+
+    def ollama_options(self, model: str) -> Dict[str, Any]:
+        """num_ctx do modelo (fixo por modelo: mudar o valor faz o Ollama recarregar o modelo)"""
+        return {"num_ctx": self.window(model)} if self.set_num_ctx else {}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "default_window": self.default_window,
+            "windows": dict(self._windows),
+            "response_tokens": self.response_tokens,
+            "set_num_ctx": self.set_num_ctx,
+            "built": self.built,
+            "trimmed": self.trimmed,
+            "estimator": self.estimator.stats()
+        }
+
+    def _keep_tail(self, text: str, tokens: int, model: str) -> str:
+        """Fim do texto que cabe em `tokens`, começando numa linha inteira"""
+        if tokens <= 0:
+            return ""
+        chars = int(tokens * self.estimator.ratio(model))
+        tail = text[-chars:]
+        if len(tail) < len(text) and "\n" in tail:
+            tail = tail.split("\n", 1)[1]
+        return tail
+
+    def _cut_middle(self, text: str, tokens: int, model: str) -> str:
+        """Mantém o início e o fim de uma mensagem grande demais (o pedido costuma estar nas pontas)"""
+        chars = max(0, int(tokens * self.estimator.ratio(model)) - 7)
+        half = chars // 2
+        return f"{text[:half]}\n[...]\n{text[len(text) - half:]}" if half else text[:chars]
+
+    def _record(self, prompt: Prompt):
+        self.built += 1
+        PROMPT_TOKENS.observe(prompt.tokens, model=prompt.model)
+        for part in dict.fromkeys(prompt.trimmed):
+            PROMPT_TRIMMED.inc(model=prompt.model, part=part)
+        if prompt.trimmed:
+            self.trimmed += 1
+            print(f"⚠️ Prompt de {prompt.model} reduzido ({', '.join(dict.fromkeys(prompt.trimmed))}) para caber em {prompt.window} tokens")
+        annotate_request(prompt_tokens=prompt.tokens)
+
+
+prompt_builder = PromptBuilder()
+
+
+def count_tokens(text: str, model: str = None) -> int:
+    """Tokens estimados de um texto (razão calibrada do modelo, se já houver)"""
+    return prompt_builder.count(text, model)
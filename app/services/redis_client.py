@@ -0,0 +1,46 @@
+"""
+Cliente Redis partilhado (opcional)
+Retorna None quando o pacote redis não está instalado ou REDIS_URL não foi definido
+"""
+import os
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+try:
+    import redis
+    from redis.exceptions import WatchError
+    REDIS_AVAILABLE = True
+except ImportError:
+    redis = None
+    REDIS_AVAILABLE = False
+
+    class WatchError(Exception):
+        """Substituto para que `except WatchError` funcione sem o pacote redis"""
+
+REDIS_URL = os.environ.get("REDIS_URL")
+
+_client = None
+_lock = threading.Lock()
+
+
+def get_redis_client():
+    """Retorna o cliente Redis do processo (ou None se não configurado)"""
+    global _client
+    if _client is not None:
+        return _client
+    if not REDIS_AVAILABLE or not REDIS_URL:
+        return None
+
+    with _lock:
+        if _client is None:
+            _client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+        return _client
+
+
+def set_redis_client(client):
+    """Substitui o cliente do processo (ex: fakeredis em testes)"""
+    global _client
+    with _lock:
+        _client = client
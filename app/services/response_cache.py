@@ -0,0 +1,218 @@
+"""
+Cache de respostas do chatbot para perguntas repetidas
+Opcional (RESPONSE_CACHE_ENABLED), com TTL, limite de memória e despejo LRU
+"""
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+from dotenv import load_dotenv
+
+from app.services.redis_client import get_redis_client
+
+load_dotenv()
+
+RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE_ENABLED", "False").lower() == "true"
+RESPONSE_CACHE_BACKEND = os.environ.get("RESPONSE_CACHE_BACKEND", "memory")
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+RESPONSE_CACHE_EXCLUDE_MODELS = [
+    m.strip() for m in os.environ.get("RESPONSE_CACHE_EXCLUDE_MODELS", "").split(",") if m.strip()
+]
+
+
+def normalize_message(message: str) -> str:
+    """Normaliza a pergunta (unicode, caixa, espaços e pontuação final)"""
+    text = unicodedata.normalize("NFC", message).lower()
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.rstrip("?!. ")
+
+
+class MemoryCacheBackend:
+    """Backend em memória do processo com TTL e despejo LRU por entradas e bytes"""
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES, max_bytes: int = RESPONSE_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value, size = item
+            if expires_at <= time.time():
+                self._remove(key)
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Dict[str, Any], ttl: int):
+        size = len(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (time.time() + ttl, value, size)
+            self._bytes += size
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def delete(self, key: str):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "backend": "memory",
+            "entries": len(self._data),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions
+        }
+
+    def _remove(self, key: str):
+        _, _, size = self._data.pop(key)
+        self._bytes -= size
+
+
+class RedisCacheBackend:
+    """Backend partilhado entre processos; TTL e LRU ficam a cargo do Redis (maxmemory-policy)"""
+
+    def __init__(self, client, prefix: str = "chatbot:response:"):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        raw = self.client.get(self.prefix + key)
+        return json.loads(raw) if raw else None
+
+    def set(self, key: str, value: Dict[str, Any], ttl: int):
+        self.client.set(self.prefix + key, json.dumps(value, ensure_ascii=False), ex=ttl)
+
+    def delete(self, key: str):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self.prefix + "*"):
+            self.client.delete(key)
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "backend": "redis",
+            "prefix": self.prefix
+        }
+
+
+class ResponseCache:
+    """
+    Cache de respostas chaveado por pergunta normalizada + modelo + contexto
+
+    Apenas respostas bem-sucedidas são guardadas. Erros do backend de cache
+    nunca derrubam a geração: são contados e tratados como miss.
+    """
+
+    def __init__(self, backend=None, enabled: bool = RESPONSE_CACHE_ENABLED, ttl: int = RESPONSE_CACHE_TTL,
+                 excluded_models: list = None):
+        self.backend = backend or MemoryCacheBackend()
+        self.enabled = enabled
+        self.ttl = ttl
+        self.excluded_models = set(excluded_models if excluded_models is not None else RESPONSE_CACHE_EXCLUDE_MODELS)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.errors = 0
+
+    def is_cacheable(self, model_type: str) -> bool:
+        return self.enabled and model_type not in self.excluded_models
+
+    @staticmethod
+    def make_key(message: str, model_type: str, model_name: str = None, ollama_url: str = None, context: str = "") -> str:
+        context_fingerprint = hashlib.sha256((context or "").encode("utf-8")).hexdigest()
+        raw = "\x1f".join([
+            normalize_message(message),
+            model_type or "",
+            model_name or "",
+            (ollama_url or "").rstrip('/'),
+            context_fingerprint
+        ])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            print(f"Erro ao ler cache de respostas: {e}")
+            value = None
+            self._count("errors")
+
+        self._count("hits" if value is not None else "misses")
+        return value
+
+    def set(self, key: str, result: Dict[str, Any]):
+        value = {
+            "response": result["response"],
+            "model": result["model"],
+            "type": result["type"]
+        }
+        try:
+            self.backend.set(key, value, self.ttl)
+            self._count("stores")
+        except Exception as e:
+            print(f"Erro ao gravar cache de respostas: {e}")
+            self._count("errors")
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "ttl": self.ttl,
+            "excluded_models": sorted(self.excluded_models),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "stores": self.stores,
+            "errors": self.errors,
+            **self.backend.info()
+        }
+
+    def _count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
+def _create_backend():
+    if RESPONSE_CACHE_BACKEND == "redis":
+        client = get_redis_client()
+        if client is not None:
+            return RedisCacheBackend(client)
+        print("⚠️ RESPONSE_CACHE_BACKEND=redis sem REDIS_URL/pacote redis; usando cache em memória")
+    return MemoryCacheBackend()
+
+
+response_cache = ResponseCache(backend=_create_backend())
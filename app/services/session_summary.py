@@ -0,0 +1,209 @@
+"""
+Resumo incremental por sessão de chat
+Quando os turnos ainda não resumidos de uma sessão passam do limite, os mais
+antigos são comprimidos (em background) num resumo guardado em session_summaries;
+o prompt passa a ser resumo + últimos turnos, com tamanho estável
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
+from dotenv import load_dotenv
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from app.models.tables import ChatHistory, SessionSummary
+from app.services.context_retrieval import turn_text
+from app.services.prompt_builder import count_tokens, render_context
+
+load_dotenv()
+
+SUMMARY_ENABLED = os.environ.get("SUMMARY_ENABLED", "False").lower() == "true"
+SUMMARY_MODEL = os.environ.get("SUMMARY_MODEL", os.environ.get("DEFAULT_MODEL", "gemini"))
+SUMMARY_TRIGGER_TOKENS = int(os.environ.get("SUMMARY_TRIGGER_TOKENS", "1500"))
+SUMMARY_KEEP_TURNS = int(os.environ.get("SUMMARY_KEEP_TURNS", "3"))
+SUMMARY_MAX_PENDING_TURNS = int(os.environ.get("SUMMARY_MAX_PENDING_TURNS", "12"))
+SUMMARY_MAX_WORDS = int(os.environ.get("SUMMARY_MAX_WORDS", "250"))
+SUMMARY_WORKERS = int(os.environ.get("SUMMARY_WORKERS", "2"))
+
+SUMMARY_PROMPT = """Atualize o resumo de uma sessão de estudo entre um estudante e o assistente.
+Mantenha os temas estudados, as dúvidas do estudante, as conclusões, as fórmulas e resultados importantes (em LaTeX curto) e o que ficou pendente.
+Escreva em português, em no máximo {max_words} palavras, sem saudações nem comentários sobre o resumo.
+
+Resumo atual:
+{summary}
+
+Novos turnos:
+{turns}
+
+Resumo atualizado:"""
+
+
+class ConversationHistory(list):
+    """
+    Turnos (mensagem, resposta) do mais antigo ao mais recente e o resumo
+    dos turnos anteriores a eles (None se a sessão ainda não tem resumo)
+    """
+
+    def __init__(self, turns=(), summary: str = None):
+        super().__init__(turns)
+        self.summary = summary
+
+
+class SessionSummarizer:
+    """
+    Resumos por session_id partilhados entre workers via base de dados
+
+    A requisição só lê o resumo e os turnos seguintes; a geração do novo
+    resumo corre num executor com uma tarefa por sessão de cada vez.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = SUMMARY_ENABLED,
+        model_type: str = SUMMARY_MODEL,
+        trigger_tokens: int = SUMMARY_TRIGGER_TOKENS,
+        keep_turns: int = SUMMARY_KEEP_TURNS,
+        max_pending_turns: int = SUMMARY_MAX_PENDING_TURNS,
+        max_words: int = SUMMARY_MAX_WORDS,
+        workers: int = SUMMARY_WORKERS
+    ):
+        self.enabled = enabled
+        self.model_type = model_type
+        self.trigger_tokens = trigger_tokens
+        self.keep_turns = keep_turns
+        self.max_pending_turns = max_pending_turns
+        self.max_words = max_words
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="session-summary")
+        self._running = set()
+        self._lock = threading.Lock()
+        self.scheduled = 0
+        self.completed = 0
+        self.failures = 0
+        self.conflicts = 0
+
+    def context_for(self, user_id: int, session_id: str) -> Tuple[Optional[str], List[ChatHistory]]:
+        """
+        Resumo da sessão e turnos ainda não resumidos (do mais antigo ao mais recente)
+
+        Se os turnos pendentes passam de SUMMARY_TRIGGER_TOKENS, agenda um novo
+        resumo; até ele ficar pronto, só os últimos SUMMARY_MAX_PENDING_TURNS entram.
+        """
+        row = SessionSummary.query.filter_by(session_id=session_id).first()
+        last_chat_id = row.last_chat_id if row else 0
+
+        pending = ChatHistory.query.filter(
+            ChatHistory.session_id == session_id,
+            ChatHistory.id > last_chat_id
+        ).order_by(ChatHistory.id.desc()).limit(self.max_pending_turns + 1).all()
+        pending.reverse()
+
+        if len(pending) > self.keep_turns:
+            tokens = sum(count_tokens(turn_text(chat.message, chat.response)) for chat in pending)
+            if tokens > self.trigger_tokens or len(pending) > self.max_pending_turns:
+                self.schedule(user_id, session_id)
+
+        return (row.summary if row else None), pending[-self.max_pending_turns:]
+
+    def schedule(self, user_id: int, session_id: str) -> bool:
+        """Agenda o resumo da sessão (ignorado se já há um em andamento neste processo)"""
+        with self._lock:
+            if session_id in self._running:
+                return False
+            self._running.add(session_id)
+            self.scheduled += 1
+        self._executor.submit(self._run, user_id, session_id)
+        return True
+
+    def forget(self, user_id: int) -> int:
+        """Apaga os resumos do utilizador (ex: histórico apagado); não faz commit"""
+        return SessionSummary.query.filter_by(user_id=user_id).delete()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            running = len(self._running)
+        return {
+            "enabled": self.enabled,
+            "model": self.model_type,
+            "trigger_tokens": self.trigger_tokens,
+            "keep_turns": self.keep_turns,
+            "running": running,
+            "scheduled": self.scheduled,
+            "completed": self.completed,
+            "failures": self.failures,
+            "conflicts": self.conflicts
+        }
+
+    def _run(self, user_id: int, session_id: str):
+        try:
+            with app.app_context():
+                self.summarize(user_id, session_id)
+        except Exception as e:
+            self.failures += 1
+            print(f"Erro ao resumir sessão {session_id}: {e}")
+        finally:
+            with self._lock:
+                self._running.discard(session_id)
+
+    def summarize(self, user_id: int, session_id: str) -> bool:
+        """
+        Comprime no resumo os turnos pendentes, menos os últimos SUMMARY_KEEP_TURNS
+
+        Returns:
+            True se o resumo foi atualizado
+        """
+        from app.services.unified_chatbot import generate_response
+
+        row = SessionSummary.query.filter_by(session_id=session_id).first()
+        last_chat_id = row.last_chat_id if row else 0
+
+        pending = ChatHistory.query.filter(
+            ChatHistory.session_id == session_id,
+            ChatHistory.id > last_chat_id
+        ).order_by(ChatHistory.id.asc()).all()
+        turns = pending[:-self.keep_turns] if self.keep_turns else pending
+        if not turns:
+            return False
+
+        prompt = SUMMARY_PROMPT.format(
+            max_words=self.max_words,
+            summary=row.summary if row else "(vazio)",
+            turns=render_context([(chat.message, chat.response) for chat in turns])
+        )
+        result = generate_response(message=prompt, model_type=self.model_type)
+        if not result["success"]:
+            raise RuntimeError(result.get("error"))
+
+        summary = result["response"].strip()
+        new_last_id = turns[-1].id
+        total_turns = (row.turns if row else 0) + len(turns)
+
+        try:
+            if row is None:
+                db.session.add(SessionSummary(session_id, user_id, summary, new_last_id, total_turns, self.model_type))
+                db.session.commit()
+            else:
+                # Outro worker pode ter avançado o resumo entretanto: só grava sobre o que foi lido
+                updated = SessionSummary.query.filter(
+                    SessionSummary.id == row.id,
+                    SessionSummary.last_chat_id == last_chat_id
+                ).update({
+                    "summary": summary,
+                    "last_chat_id": new_last_id,
+                    "turns": total_turns,
+                    "model_used": self.model_type
+                }, synchronize_session=False)
+                db.session.commit()
+                if not updated:
+                    self.conflicts += 1
+                    return False
+        except IntegrityError:
+            db.session.rollback()
+            self.conflicts += 1
+            return False
+
+        self.completed += 1
+        return True
+
+
+session_summarizer = SessionSummarizer()
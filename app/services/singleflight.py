@@ -0,0 +1,204 @@
+"""
+Coalescência de gerações idênticas em andamento (single-flight)
+Enquanto uma geração para uma chave está a correr, pedidos idênticos
+esperam por ela e recebem o mesmo resultado, em vez de chamar o backend de novo
+"""
+import os
+import threading
+from typing import Callable, Dict, Any, Iterator, Tuple
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SINGLEFLIGHT_ENABLED = os.environ.get("SINGLEFLIGHT_ENABLED", "True").lower() == "true"
+
+
+class _Call:
+    """Geração bloqueante em andamento"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _StreamFlight:
+    """
+    Geração em streaming partilhada
+
+    Os pedaços ficam num buffer para que consumidores que entram depois
+    recebam a resposta desde o início. Qualquer consumidor ativo pode puxar
+    o próximo pedaço do backend (um de cada vez); quando o último consumidor
+    desiste, o stream de origem é fechado e a geração é cancelada.
+    """
+
+    def __init__(self, key: str, factory: Callable[[], Iterator[str]]):
+        self.key = key
+        self.factory = factory
+        self.source = None
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.pulling = False
+        self.consumers = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+
+class SingleFlight:
+    """Agrupa chamadas idênticas concorrentes (bloqueantes e em streaming)"""
+
+    def __init__(self, enabled: bool = SINGLEFLIGHT_ENABLED):
+        self.enabled = enabled
+        self._calls: Dict[str, _Call] = {}
+        self._streams: Dict[str, _StreamFlight] = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+        self.stream_leaders = 0
+        self.stream_coalesced = 0
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        Executa fn uma única vez por chave entre chamadas concorrentes
+
+        Returns:
+            Tupla (resultado, partilhado) - partilhado é True quando o
+            resultado veio da geração de outro pedido
+        """
+        if not self.enabled:
+            return fn(), False
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+        return call.result, False
+
+    def stream(self, key: str, factory: Callable[[], Iterator[str]]) -> Iterator[str]:
+        """
+        Retorna um iterador dos pedaços da geração partilhada da chave
+
+        factory só é chamada pelo primeiro consumidor, na primeira leitura.
+        O iterador deve ser fechado (close) se o consumo for interrompido.
+        """
+        if not self.enabled:
+            return factory()
+        return self._consume(key, factory)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "stream_leaders": self.stream_leaders,
+            "stream_coalesced": self.stream_coalesced,
+            "in_flight": len(self._calls) + len(self._streams)
+        }
+
+    def _consume(self, key: str, factory: Callable[[], Iterator[str]]) -> Iterator[str]:
+        flight = self._join(key, factory)
+        index = 0
+        try:
+            while True:
+                with flight.cond:
+                    while index >= len(flight.chunks) and not flight.done and flight.pulling:
+                        flight.cond.wait()
+
+                    if index < len(flight.chunks):
+                        chunk = flight.chunks[index]
+                        index += 1
+                        pull = False
+                    elif flight.done:
+                        if flight.error is not None:
+                            raise flight.error
+                        return
+                    else:
+                        flight.pulling = True
+                        pull = True
+
+                if pull:
+                    self._pull(flight)
+                else:
+                    yield chunk
+        finally:
+            self._detach(flight)
+
+    def _join(self, key: str, factory: Callable[[], Iterator[str]]) -> _StreamFlight:
+        with self._lock:
+            flight = self._streams.get(key)
+            if flight is None or flight.closed:
+                flight = _StreamFlight(key, factory)
+                self._streams[key] = flight
+                self.stream_leaders += 1
+            else:
+                self.stream_coalesced += 1
+            flight.consumers += 1
+            return flight
+
+    def _pull(self, flight: _StreamFlight):
+        """Lê o próximo pedaço do backend (apenas o consumidor com pulling=True)"""
+        chunk = None
+        finished = False
+        error = None
+        try:
+            if flight.source is None:
+                flight.source = flight.factory()
+            chunk = next(flight.source)
+        except StopIteration:
+            finished = True
+        except Exception as e:
+            finished = True
+            error = e
+
+        if finished:
+            with self._lock:
+                if self._streams.get(flight.key) is flight:
+                    del self._streams[flight.key]
+
+        with flight.cond:
+            if finished:
+                flight.done = True
+                flight.error = error
+            else:
+                flight.chunks.append(chunk)
+            flight.pulling = False
+            flight.cond.notify_all()
+
+    def _detach(self, flight: _StreamFlight):
+        close_source = False
+        with self._lock:
+            flight.consumers -= 1
+            if flight.consumers == 0 and not flight.done:
+                flight.closed = True
+                close_source = True
+                if self._streams.get(flight.key) is flight:
+                    del self._streams[flight.key]
+
+        if close_source and flight.source is not None:
+            flight.source.close()
+
+
+request_coalescer = SingleFlight()
@@ -3,20 +3,121 @@ Serviço unificado de chatbot que suporta múltiplos modelos
 (Gemini online, Ollama local configurável pelo utilizador)
 """
 import os
+import json
+import fnmatch
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from dotenv import load_dotenv
 import google.generativeai as genai
-from typing import Dict, Any
+from typing import Dict, Any, Iterator, List, Tuple
+
+from app.services.model_catalog import model_catalog
+from app.services.ollama_http import ollama_http
+from app.services.ollama_pool import ollama_pool, OllamaLease, is_node_failure
+from app.services.ollama_sessions import ollama_sessions, OLLAMA_KEEP_ALIVE
+from app.services.backend_registry import BackendRegistry
+from app.services.response_cache import response_cache
+from app.services.singleflight import request_coalescer
+from app.services.admission import admission, AdmissionRejected, rejection_result
+from app.services.circuit_breaker import circuit_breakers, CircuitOpen, circuit_open_result
+from app.services.metrics import stage, timed, count_timeout, is_timeout
+from app.services.prompt_builder import prompt_builder, system_with_summary, Prompt
 
 load_dotenv()
 
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 DEFAULT_MODEL = os.environ.get("DEFAULT_MODEL", "gemini")
-OLLAMA_TIMEOUT = int(os.environ.get("OLLAMA_TIMEOUT", "60"))
+BATCH_MAX_PARALLEL = int(os.environ.get("BATCH_MAX_PARALLEL", "4"))
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "100"))
+# Ex: "ollama_*=gemini;gemini=ollama_llama3_2,ollama_mistral"
+MODEL_FALLBACKS = os.environ.get("MODEL_FALLBACKS", "")
 
 if GEMINI_API_KEY:
     genai.configure(api_key=GEMINI_API_KEY)
 
+_gemini_model = None
+_gemini_stubbed = False
+_gemini_lock = threading.Lock()
+
+
+def _get_gemini_model():
+    """Instância única do GenerativeModel partilhada pelo processo"""
+    global _gemini_model
+    with _gemini_lock:
+        if _gemini_model is None:
+            _gemini_model = genai.GenerativeModel("gemini-2.0-flash")
+        return _gemini_model
+
+
+def _gemini_enabled() -> bool:
+    return bool(GEMINI_API_KEY) or _gemini_stubbed
+
+
+def set_gemini_model(model):
+    """
+    Substitui o GenerativeModel partilhado por um objeto com a mesma interface
+    (generate_content / generate_content_async), ex: o stub de tools/mock_llm.py
+    
+    Com um stub o Gemini fica disponível mesmo sem GEMINI_API_KEY; None restaura o cliente real.
+    """
+    global _gemini_model, _gemini_stubbed
+    with _gemini_lock:
+        _gemini_model = model
+        _gemini_stubbed = model is not None
+    chatbot_registry.invalidate(provider="gemini")
+
+
+def _parse_fallbacks(spec: str) -> List[Tuple[str, List[str]]]:
+    """Regras "modelo=fallback1,fallback2" separadas por ";" (o modelo aceita curingas)"""
+    rules = []
+    for rule in spec.split(";"):
+        if "=" not in rule:
+            continue
+        pattern, targets = rule.split("=", 1)
+        targets = [target.strip() for target in targets.split(",") if target.strip()]
+        if pattern.strip() and targets:
+            rules.append((pattern.strip(), targets))
+    return rules
+
+
+_fallback_rules = _parse_fallbacks(MODEL_FALLBACKS)
+
+
+def fallback_chain(model_type: str) -> List[str]:
+    """Modelos a tentar, por ordem, quando o backend de model_type falha"""
+    for pattern, targets in _fallback_rules:
+        if fnmatch.fnmatchcase(model_type, pattern):
+            return [target for target in targets if target != model_type]
+    return []
+
+
+def _replay_stream(text: str) -> Iterator[str]:
+    """Stream de um único pedaço (resposta vinda do cache)"""
+    yield text
+
+
+def reset_backends(ollama_url: str = None) -> int:
+    """
+    Descarta instâncias em cache após mudança de configuração
+    
+    Args:
+        ollama_url: Limita a invalidação a uma URL Ollama (None = todas)
+    
+    Returns:
+        Número de instâncias removidas
+    """
+    global _gemini_model
+    if ollama_url is None:
+        with _gemini_lock:
+            if not _gemini_stubbed:
+                _gemini_model = None
+    ollama_sessions.invalidate(ollama_url)
+    circuit_breakers.reset(f"ollama:{ollama_url.rstrip('/')}" if ollama_url else None)
+    return chatbot_registry.invalidate(ollama_url=ollama_url)
+
+
 class UnifiedChatbot:
     """Classe para gerenciar múltiplos modelos de chatbot"""
     
@@ -26,27 +127,27 @@ class UnifiedChatbot:
         
         Args:
             model_type: Tipo do modelo (gemini ou ollama_{model_name})
-            ollama_url: URL do servidor Ollama (se None, não usa modelos locais)
+            ollama_url: URL do servidor Ollama (se None, usa o pool OLLAMA_POOL_URLS, se configurado)
         """
         self.model_type = model_type or DEFAULT_MODEL
         self.ollama_url = ollama_url
         self.gemini_model = None
         
-        if self.model_type == "gemini" and GEMINI_API_KEY:
-            self.gemini_model = genai.GenerativeModel("gemini-2.0-flash")
+        if self.model_type == "gemini" and _gemini_enabled():
+            self.gemini_model = _get_gemini_model()
     
     def get_available_models(self) -> Dict[str, Any]:
         """Retorna modelos disponíveis dinamicamente"""
         models = {}
         
-        if GEMINI_API_KEY:
+        if _gemini_enabled():
             models["gemini"] = {
                 "name": "Gemini 2.0 Flash",
                 "type": "online",
                 "description": "Modelo online do Google AI"
             }
         
-        if self.ollama_url and self._check_ollama_status():
+        if self.ollama_url or ollama_pool.configured:
             ollama_models = self._list_ollama_models()
             
             for ollama_model in ollama_models:
@@ -75,216 +176,645 @@ class UnifiedChatbot:
         return models
     
     def _check_ollama_status(self) -> bool:
-        """Verifica se Ollama está rodando na URL configurada"""
+        """Verifica se Ollama está rodando na URL configurada (último estado do catálogo)"""
         if not self.ollama_url:
-            return False
-        try:
-            response = requests.get(f"{self.ollama_url}/api/tags", timeout=5)
-            return response.status_code == 200
-        except:
-            return False
+            return bool(ollama_pool.models())
+        return model_catalog.is_healthy(self.ollama_url)
     
     def _list_ollama_models(self) -> list:
-        """Lista modelos Ollama disponíveis"""
+        """
+        Lista modelos Ollama disponíveis (catálogo em memória, atualizado em background)
+        Sem URL do utilizador, usa os modelos do pool do servidor (OLLAMA_POOL_URLS)
+        """
         if not self.ollama_url:
-            return []
-        try:
-            response = requests.get(f"{self.ollama_url}/api/tags", timeout=5)
-            if response.status_code == 200:
-                return response.json().get('models', [])
-        except:
-            pass
-        return []
+            return ollama_pool.models()
+        return model_catalog.get_models(self.ollama_url)
+    
+    @contextmanager
+    def _ollama_lease(self, model_name: str, session_id: str = None):
+        """Servidor Ollama da requisição: a URL do utilizador ou um nó do pool (com afinidade de sessão)"""
+        if self.ollama_url:
+            yield OllamaLease(self.ollama_url)
+        else:
+            prefer_url = ollama_sessions.node_for(session_id, model_name)
+            with ollama_pool.acquire(model_name, prefer_url=prefer_url) as lease:
+                yield lease
+    
+    @timed("prompt")
+    def _build_gemini_prompt(self, message: str, context: str = "") -> Tuple[str, Prompt]:
+        """
+        Monta o prompt completo enviado ao Gemini (dentro da janela do modelo)
+        
+        Returns:
+            Tupla (texto do prompt, Prompt com a contagem de tokens)
+        """
+        prompt = prompt_builder.build(self.model_type, message, context)
+        full_prompt = f"{prompt.system}\n\n"
+        if prompt.context:
+            full_prompt += f"Contexto: {prompt.context}\n\n"
+        full_prompt += f"Pergunta do estudante: {prompt.message}"
+        return full_prompt, prompt
+    
+    @timed("prompt")
+    def _build_ollama_request(
+        self,
+        message: str,
+        model_name: str,
+        context: str = "",
+        history: List[Tuple[str, str]] = None,
+        session_id: str = None,
+        stream: bool = False
+    ) -> Tuple[str, Dict[str, Any], Prompt]:
+        """
+        Monta a requisição ao Ollama conforme OLLAMA_SESSION_MODE
+        
+        - chat: /api/chat com [sistema, turnos anteriores, pergunta]; o prefixo
+          fica igual entre turnos e o Ollama só avalia o que é novo (o resumo
+          da sessão, se houver, vai na mensagem de sistema e só muda quando é refeito)
+        - context: /api/generate continuando os tokens guardados da sessão
+        - sem histórico estruturado ou sem tokens válidos: /api/generate com o
+          contexto em texto
+        
+        Em todos os modos o prompt é limitado à janela do modelo (num_ctx),
+        sem os turnos mais antigos que não couberem.
+        
+        Returns:
+            Tupla (caminho da API, corpo JSON, Prompt com a contagem de tokens)
+        """
+        payload = {
+            "model": model_name,
+            "stream": stream,
+            "options": {
+                "temperature": 0.7,
+                "top_p": 0.9,
+                "top_k": 40,
+                **prompt_builder.ollama_options(self.model_type)
+            }
+        }
+        if OLLAMA_KEEP_ALIVE:
+            payload["keep_alive"] = OLLAMA_KEEP_ALIVE
+        
+        if ollama_sessions.mode == "chat" and history is not None:
+            prompt = prompt_builder.build(self.model_type, message, context, history)
+            messages = [{"role": "system", "content": system_with_summary(prompt.summary)}]
+            for user_message, bot_response in prompt.turns:
+                messages.append({"role": "user", "content": user_message})
+                messages.append({"role": "assistant", "content": bot_response})
+            messages.append({"role": "user", "content": prompt.message})
+            payload["messages"] = messages
+            return "/api/chat", payload, prompt
+        
+        if ollama_sessions.mode == "context":
+            tokens = ollama_sessions.get_context(session_id, model_name, history)
+            # Sessão que já não cabe na janela recomeça pelo contexto em texto (cortado)
+            if tokens and len(tokens) + prompt_builder.count(message, self.model_type) < prompt_builder.budget(self.model_type):
+                prompt = prompt_builder.build(self.model_type, message, prefix_tokens=len(tokens))
+                # O prompt de sistema e o histórico já estão nos tokens guardados
+                payload["prompt"] = prompt.message
+                payload["context"] = tokens
+                return "/api/generate", payload, prompt
+        
+        prompt = prompt_builder.build(self.model_type, message, context, history)
+        payload["prompt"] = prompt.message
+        if prompt.context:
+            payload["prompt"] = f"Contexto: {prompt.context}\n\nPergunta: {prompt.message}"
+        payload["system"] = prompt.system
+        return "/api/generate", payload, prompt
+    
+    @staticmethod
+    def _ollama_text(data: Dict[str, Any]) -> str:
+        """Texto de uma resposta (ou linha de stream) de /api/generate ou /api/chat"""
+        if "message" in data:
+            return (data.get("message") or {}).get("content", "")
+        return data.get("response", "")
+    
+    @staticmethod
+    def _observe_ollama_usage(prompt: Prompt, payload: Dict[str, Any], data: Dict[str, Any]):
+        """Calibra a contagem de tokens com prompt_eval_count (exceto continuando tokens da sessão)"""
+        prompt_builder.observe(prompt, data.get("prompt_eval_count"), cached_prefix="context" in payload)
+    
+    @staticmethod
+    def _observe_gemini_usage(prompt: Prompt, usage):
+        """Calibra a contagem de tokens com o usage_metadata do Gemini"""
+        prompt_builder.observe(prompt, getattr(usage, "prompt_token_count", 0))
     
     def _generate_with_gemini(self, message: str, context: str = "") -> str:
-        """Gera resposta com Gemini"""
+        """Gera resposta com Gemini (erros da API, ex: 429, seguem para o circuit breaker)"""
+        full_prompt, prompt = self._build_gemini_prompt(message, context)
         try:
-            system_prompt = """Você é StudentHub, um assistente educacional inteligente.
-            Suas características:
-            - Responde sempre em português
-            - É claro, preciso e educativo
-            - Usa exemplos práticos
-            - Formata respostas matemáticas em LaTeX quando apropriado
-            
-            REGRAS DE FORMATAÇÃO LATEX (IMPORTANTE):
-            - Para expressões matemáticas INLINE use: \\(expressão\\) ou $expressão$
-            - Para equações EM BLOCO use: \\[equação\\] ou $$equação$$
-            - Exemplo inline: A solução é \\(x = 1\\)
-            - Exemplo bloco: 
-              \\[
-              2x - 2 = 0
-              \\]
-            
-            Você pode usar qualquer um desses formatos, ambos funcionam perfeitamente!
-            """
-            
-            full_prompt = f"{system_prompt}\n\n"
-            if context:
-                full_prompt += f"Contexto: {context}\n\n"
-            full_prompt += f"Pergunta do estudante: {message}"
-            
-            chat = self.gemini_model.start_chat(history=[])
-            response = chat.send_message(full_prompt)
-            
-            return response.text if response else "Desculpe, não consegui processar sua solicitação."
-            
+            response = self.gemini_model.generate_content(full_prompt)
         except Exception as e:
+            if is_timeout(e):
+                count_timeout("online")
             print(f"Erro ao gerar resposta com Gemini: {e}")
-            return "Desculpe, ocorreu um erro ao processar sua solicitação."
+            raise
+        
+        self._observe_gemini_usage(prompt, getattr(response, "usage_metadata", None))
+        try:
+            return response.text if response else None
+        except ValueError:
+            # Resposta bloqueada pelos filtros de segurança: não é falha do backend
+            return None
     
-    def _generate_with_ollama(self, message: str, model_name: str, context: str = "") -> str:
-        """Gera resposta com Ollama"""
-        if not self.ollama_url:
+    def _generate_with_ollama(
+        self,
+        message: str,
+        model_name: str,
+        context: str = "",
+        history: List[Tuple[str, str]] = None,
+        session_id: str = None
+    ) -> str:
+        """Gera resposta com Ollama (erros e timeouts seguem para o circuit breaker)"""
+        if not self.ollama_url and not ollama_pool.configured:
             return None
             
         try:
-            system_message = """Você é StudentHub, um assistente educacional inteligente.
-            Suas características:
-            - Responde sempre em português
-            - É claro, preciso e educativo
-            - Usa exemplos práticos
-            - Formata respostas matemáticas em LaTeX quando apropriado
-            
-            REGRAS DE FORMATAÇÃO LATEX (IMPORTANTE):
-            - Para expressões matemáticas INLINE use: \\(expressão\\) ou $expressão$
-            - Para equações EM BLOCO use: \\[equação\\] ou $$equação$$
-            - Exemplo inline: A solução é \\(x = 1\\)
-            - Exemplo bloco: 
-              \\[
-              2x - 2 = 0
-              \\]
-            
-            Você pode usar qualquer um desses formatos, ambos funcionam perfeitamente!
-            """
-            
-            prompt = message
-            if context:
-                prompt = f"Contexto: {context}\n\nPergunta: {message}"
-            
-            data = {
-                "model": model_name,
-                "prompt": prompt,
-                "system": system_message,
-                "stream": False,
-                "options": {
-                    "temperature": 0.7,
-                    "top_p": 0.9,
-                    "top_k": 40
-                }
-            }
-            
-            response = requests.post(
-                f"{self.ollama_url}/api/generate",
-                json=data,
-                timeout=OLLAMA_TIMEOUT
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                return result.get('response', '').strip()
-            else:
-                print(f"Erro na API Ollama: {response.status_code}")
-                return None
+            with self._ollama_lease(model_name, session_id) as lease:
+                path, payload, prompt = self._build_ollama_request(message, model_name, context, history, session_id)
+                response = ollama_http.post(lease.url, path, json=payload)
+                
+                if response.status_code == 200:
+                    result = response.json()
+                    self._observe_ollama_usage(prompt, payload, result)
+                    text = self._ollama_text(result).strip()
+                    if text:
+                        ollama_sessions.remember(session_id, model_name, lease.url, text, result.get("context"))
+                    return text
+                else:
+                    if is_node_failure(status_code=response.status_code):
+                        lease.fail(f"HTTP {response.status_code}")
+                    raise RuntimeError(f"Erro na API Ollama: {response.status_code}")
                 
         except requests.exceptions.Timeout:
+            count_timeout("local")
             print("Timeout na requisição Ollama")
-            return None
+            raise
         except Exception as e:
             print(f"Erro ao gerar resposta com Ollama: {e}")
-            return None
+            raise
+    
+    def _stream_with_gemini(self, message: str, context: str = "") -> Iterator[str]:
+        """Gera resposta com Gemini, devolvendo os pedaços de texto à medida que chegam"""
+        full_prompt, prompt = self._build_gemini_prompt(message, context)
+        response = self.gemini_model.generate_content(full_prompt, stream=True)
+        
+        usage = None
+        for chunk in response:
+            usage = getattr(chunk, "usage_metadata", None) or usage
+            try:
+                text = chunk.text
+            except ValueError:
+                continue
+            if text:
+                yield text
+        self._observe_gemini_usage(prompt, usage)
     
-    def generate_response(self, message: str, context: str = "") -> Dict[str, Any]:
+    def _stream_with_ollama(
+        self,
+        message: str,
+        model_name: str,
+        context: str = "",
+        history: List[Tuple[str, str]] = None,
+        session_id: str = None
+    ) -> Iterator[str]:
         """
-        Gera resposta usando o modelo configurado (busca dinâmica)
+        Gera resposta com Ollama em streaming (NDJSON)
         
-        Args:
-            message: Mensagem do usuário
-            context: Contexto adicional
+        Fechar o gerador fecha a conexão HTTP, o que faz o Ollama
+        interromper a geração (ex: quando o cliente desconecta).
+        """
+        with self._ollama_lease(model_name, session_id) as lease:
+            path, payload, prompt = self._build_ollama_request(message, model_name, context, history, session_id, stream=True)
+            response = ollama_http.post(lease.url, path, json=payload, stream=True)
+            chunks = []
+            
+            try:
+                if response.status_code != 200:
+                    if is_node_failure(status_code=response.status_code):
+                        lease.fail(f"HTTP {response.status_code}")
+                    raise RuntimeError(f"Erro na API Ollama: {response.status_code}")
+                
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    data = json.loads(line)
+                    if data.get("error"):
+                        raise RuntimeError(data["error"])
+                    token = self._ollama_text(data)
+                    if token:
+                        chunks.append(token)
+                        yield token
+                    if data.get("done"):
+                        self._observe_ollama_usage(prompt, payload, data)
+                        # Só um stream completo atualiza o estado da sessão
+                        ollama_sessions.remember(session_id, model_name, lease.url, "".join(chunks).strip(), data.get("context"))
+                        break
+            finally:
+                response.close()
+    
+    def _resolve_model(self, message: str):
+        """
+        Valida a mensagem e encontra a configuração do modelo
         
         Returns:
-            Dict com response e metadata
+            Tupla (model_config, erro) - apenas um dos dois é preenchido
         """
         if not message.strip():
-            return {
+            return None, {
                 "success": False,
                 "error": "Mensagem vazia",
                 "response": None
             }
         
-        available = self.get_available_models()
+        local_backend = None
+        if self.model_type != "gemini":
+            local_backend = self._local_backend()
+            try:
+                # Servidor já dado como em baixo: nem chega a esperar pelo probe do catálogo
+                circuit_breakers.check(local_backend)
+            except CircuitOpen as e:
+                return None, circuit_open_result(e)
+        
+        with stage("catalog"):
+            available = self.get_available_models()
         model_config = available.get(self.model_type)
         
         if not model_config:
-            return {
+            if local_backend and not self._check_ollama_status():
+                circuit_breakers.record_failure(local_backend, "servidor Ollama inacessível")
+                return None, {
+                    "success": False,
+                    "error": "Servidor Ollama indisponível",
+                    "response": None,
+                    "status": 503,
+                    "backend": local_backend
+                }
+            return None, {
                 "success": False,
                 "error": f"Modelo '{self.model_type}' não encontrado ou indisponível",
                 "response": None
             }
         
-        try:
-            if self.model_type == "gemini":
-                response = self._generate_with_gemini(message, context)
+        if model_config["type"] == "local" and not model_config.get("ollama_name"):
+            return None, {
+                "success": False,
+                "error": "Nome do modelo Ollama não especificado",
+                "response": None
+            }
+        
+        return model_config, None
+    
+    def stream_response(
+        self,
+        message: str,
+        context: str = "",
+        history: List[Tuple[str, str]] = None,
+        session_id: str = None,
+        allow_fallback: bool = True
+    ) -> Dict[str, Any]:
+        """
+        Gera resposta em streaming usando o modelo configurado
+        
+        Args:
+            message: Mensagem do usuário
+            context: Contexto adicional
+            history: Turnos anteriores (mensagem, resposta), do mais antigo ao mais recente
+            session_id: Sessão da conversa (reaproveitamento do KV cache no Ollama)
+            allow_fallback: Usar MODEL_FALLBACKS se o backend estiver indisponível
+        
+        Returns:
+            Dict com metadata e "stream": iterador de pedaços de texto.
+            O iterador deve ser fechado (close) se o consumo for interrompido.
+            O fallback só acontece antes do stream começar (circuito aberto,
+            servidor inacessível ou fila cheia).
+        """
+        result = self._stream_response(message, context, history, session_id)
+        for model_type in self._fallback_models(result) if allow_fallback else []:
+            fallback = get_chatbot(model_type, self.ollama_url).stream_response(
+                message, context, history, session_id, allow_fallback=False
+            )
+            if fallback["success"]:
+                return self._fallback_result(fallback, result)
+        return result
+    
+    def _stream_response(
+        self,
+        message: str,
+        context: str = "",
+        history: List[Tuple[str, str]] = None,
+        session_id: str = None
+    ) -> Dict[str, Any]:
+        model_config, error = self._resolve_model(message)
+        if error:
+            return error
+        
+        request_key = self._request_key(message, model_config, context)
+        cacheable = response_cache.is_cacheable(self.model_type)
+        if cacheable:
+            cached = response_cache.get(request_key)
+            if cached:
                 return {
                     "success": True,
-                    "response": response,
-                    "model": model_config["name"],
-                    "type": "online"
-                }
-            
-            elif model_config["type"] == "local":
-                ollama_name = model_config.get("ollama_name")
-                
-                if not ollama_name:
-                    return {
-                        "success": False,
-                        "error": "Nome do modelo Ollama não especificado",
-                        "response": None
-                    }
-                
-                response = self._generate_with_ollama(
-                    message, 
-                    ollama_name, 
-                    context
-                )
-                
-                if response:
-                    return {
-                        "success": True,
-                        "response": response,
-                        "model": model_config["name"],
-                        "type": "local"
-                    }
-                else:
-                    return {
-                        "success": False,
-                        "error": f"Falha ao gerar resposta com modelo {ollama_name}",
-                        "response": None
-                    }
-            else:
-                return {
-                    "success": False,
-                    "error": f"Tipo de modelo desconhecido: {model_config.get('type')}",
-                    "response": None
+                    "stream": _replay_stream(cached["response"]),
+                    "model": cached["model"],
+                    "type": cached["type"],
+                    "backend": cached.get("backend"),
+                    "cached": True
                 }
         
-        except Exception as e:
+        if self.model_type == "gemini":
+            factory = lambda: self._stream_with_gemini(message, context)
+        elif model_config["type"] == "local":
+            factory = lambda: self._stream_with_ollama(message, model_config["ollama_name"], context, history, session_id)
+        else:
             return {
                 "success": False,
-                "error": str(e),
+                "error": f"Tipo de modelo desconhecido: {model_config.get('type')}",
                 "response": None
             }
+        
+        # Falha rápida se o circuito está aberto ou a fila já está cheia; a vaga é obtida na primeira leitura
+        backend, nodes = self._admission_backend(model_config)
+        try:
+            circuit_breakers.check(backend)
+            admission.check(backend, nodes)
+        except CircuitOpen as e:
+            return circuit_open_result(e)
+        except AdmissionRejected as e:
+            return {**rejection_result(e), "backend": backend}
+        
+        # Pedidos idênticos em andamento partilham a mesma geração no backend
+        stream = request_coalescer.stream(
+            request_key,
+            lambda: self._admitted_stream(backend, nodes, factory)
+        )
+        
+        result = {
+            "success": True,
+            "stream": stream,
+            "model": model_config["name"],
+            "type": model_config["type"],
+            "backend": backend
+        }
+        if cacheable:
+            result["stream"] = self._cache_stream(request_key, stream, result)
+        return result
+    
+    def _cache_stream(self, cache_key: str, stream: Iterator[str], result: Dict[str, Any]) -> Iterator[str]:
+        """Repassa o stream e guarda a resposta no cache se ele terminar por completo"""
+        chunks = []
+        try:
+            for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            stream.close()
+        
+        if chunks:
+            response_cache.set(cache_key, {**result, "response": "".join(chunks)})
+    
+    def _request_key(self, message: str, model_config: Dict[str, Any], context: str = "") -> str:
+        """Chave da requisição, usada pelo cache de respostas e pela coalescência"""
+        return response_cache.make_key(
+            message,
+            self.model_type,
+            model_config.get("ollama_name"),
+            self.ollama_url if model_config["type"] == "local" else None,
+            context
+        )
+    
+    def generate_response(
+        self,
+        message: str,
+        context: str = "",
+        history: List[Tuple[str, str]] = None,
+        session_id: str = None,
+        allow_fallback: bool = True
+    ) -> Dict[str, Any]:
+        """
+        Gera resposta usando o modelo configurado (busca dinâmica)
+        
+        Args:
+            message: Mensagem do usuário
+            context: Contexto adicional
+            history: Turnos anteriores (mensagem, resposta), do mais antigo ao mais recente
+            session_id: Sessão da conversa (reaproveitamento do KV cache no Ollama)
+            allow_fallback: Tentar os modelos de MODEL_FALLBACKS se o backend falhar
+        
+        Returns:
+            Dict com response e metadata ("backend" indica quem respondeu e
+            "fallback_from" o modelo pedido, quando a resposta veio do fallback)
+        """
+        result = self._generate_response(message, context, history, session_id)
+        for model_type in self._fallback_models(result) if allow_fallback else []:
+            fallback = get_chatbot(model_type, self.ollama_url).generate_response(
+                message, context, history, session_id, allow_fallback=False
+            )
+            if fallback["success"]:
+                return self._fallback_result(fallback, result)
+        return result
+    
+    def _generate_response(
+        self,
+        message: str,
+        context: str = "",
+        history: List[Tuple[str, str]] = None,
+        session_id: str = None
+    ) -> Dict[str, Any]:
+        model_config, error = self._resolve_model(message)
+        if error:
+            return error
+        
+        request_key = self._request_key(message, model_config, context)
+        cacheable = response_cache.is_cacheable(self.model_type)
+        if cacheable:
+            cached = response_cache.get(request_key)
+            if cached:
+                return {"success": True, **cached, "cached": True}
+        
+        # Pedidos idênticos em andamento esperam pela mesma geração
+        result, shared = request_coalescer.do(
+            request_key,
+            lambda: self._admitted_generate(message, model_config, context, history, session_id)
+        )
+        if shared:
+            return {**result, "coalesced": True}
+        
+        if cacheable and result["success"]:
+            response_cache.set(request_key, result)
+        
+        return result
+    
+    def generate_batch(self, messages: List[str], context: str = "", max_parallel: int = None) -> List[Dict[str, Any]]:
+        """
+        Gera respostas para vários prompts independentes
+        
+        Args:
+            messages: Lista de mensagens
+            context: Contexto adicional comum a todas
+            max_parallel: Máximo de gerações simultâneas (padrão BATCH_MAX_PARALLEL)
+        
+        Returns:
+            Lista de resultados (formato de generate_response) na ordem das mensagens
+        """
+        results = [None] * len(messages)
+        for index, result in self.iter_batch(messages, context, max_parallel):
+            results[index] = result
+        return results
+    
+    def iter_batch(self, messages: List[str], context: str = "", max_parallel: int = None) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """
+        Versão incremental de generate_batch
+        
+        Cada item passa pelo cache, coalescência e controlo de admissão como um
+        pedido normal; a falha de um item vira um resultado com success False
+        sem interromper os outros.
+        
+        Yields:
+            Tuplas (índice da mensagem, resultado) pela ordem de conclusão
+        """
+        if not messages:
+            return
+        
+        workers = max(1, min(max_parallel or BATCH_MAX_PARALLEL, len(messages)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chat-batch") as executor:
+            futures = {
+                executor.submit(self.generate_response, message, context): index
+                for index, message in enumerate(messages)
+            }
+            try:
+                for future in as_completed(futures):
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = {
+                            "success": False,
+                            "error": str(e),
+                            "response": None
+                        }
+                    yield futures[future], result
+            finally:
+                # Consumidor desistiu: itens ainda não iniciados não chegam ao backend
+                for future in futures:
+                    future.cancel()
+    
+    def _fallback_models(self, result: Dict[str, Any]) -> List[str]:
+        """
+        Modelos de fallback para um resultado: só falhas do backend (erro, timeout,
+        circuito aberto, fila cheia) mudam de modelo; erros de validação não
+        """
+        if result["success"] or not result.get("backend"):
+            return []
+        return fallback_chain(self.model_type)
+    
+    def _fallback_result(self, fallback: Dict[str, Any], failed: Dict[str, Any]) -> Dict[str, Any]:
+        print(f"⚠️ {self.model_type} falhou ({failed.get('error')}); resposta de {fallback.get('backend')}")
+        return {**fallback, "fallback_from": self.model_type}
+    
+    def _local_backend(self) -> str:
+        """Chave do backend Ollama deste bot (URL do utilizador ou pool)"""
+        if self.ollama_url:
+            return f"ollama:{self.ollama_url.rstrip('/')}"
+        return "ollama:pool"
+    
+    def _admission_backend(self, model_config: Dict[str, Any]):
+        """Chave do backend (admissão e circuit breaker) e número de nós que o servem"""
+        if model_config["type"] != "local":
+            return "gemini", 1
+        return self._local_backend(), 1 if self.ollama_url else ollama_pool.size
+    
+    def _admitted_generate(
+        self,
+        message: str,
+        model_config: Dict[str, Any],
+        context: str = "",
+        history: List[Tuple[str, str]] = None,
+        session_id: str = None
+    ) -> Dict[str, Any]:
+        """
+        Chama o backend depois de passar pelo circuit breaker e obter vaga no
+        controlo de admissão; o resultado (sucesso ou falha) traz a chave do backend
+        """
+        backend, nodes = self._admission_backend(model_config)
+        try:
+            circuit_breakers.check(backend)
+            with admission.slot(backend, nodes):
+                with stage("llm"), circuit_breakers.call(backend):
+                    response = self._generate(message, model_config, context, history, session_id)
+        except CircuitOpen as e:
+            return circuit_open_result(e)
+        except AdmissionRejected as e:
+            return {**rejection_result(e), "backend": backend}
+        except Exception:
+            response = None
+        
+        if not response:
+            name = "Gemini" if self.model_type == "gemini" else f"modelo {model_config.get('ollama_name')}"
+            return {
+                "success": False,
+                "error": f"Falha ao gerar resposta com {name}",
+                "response": None,
+                "backend": backend
+            }
+        
+        return {
+            "success": True,
+            "response": response,
+            "model": model_config["name"],
+            "type": model_config["type"],
+            "backend": backend
+        }
+    
+    def _admitted_stream(self, backend: str, nodes: int, factory) -> Iterator[str]:
+        """Mantém a vaga do backend enquanto o stream estiver aberto"""
+        with admission.slot(backend, nodes):
+            with stage("llm"), circuit_breakers.call(backend):
+                yield from factory()
+    
+    def _generate(
+        self,
+        message: str,
+        model_config: Dict[str, Any],
+        context: str = "",
+        history: List[Tuple[str, str]] = None,
+        session_id: str = None
+    ) -> str:
+        """Chama o backend do modelo (sem cache); falhas do backend propagam como exceções"""
+        if self.model_type == "gemini":
+            return self._generate_with_gemini(message, context)
+        
+        if model_config["type"] == "local":
+            return self._generate_with_ollama(
+                message,
+                model_config.get("ollama_name"),
+                context,
+                history,
+                session_id
+            )
+        
+        raise ValueError(f"Tipo de modelo desconhecido: {model_config.get('type')}")
+
+
+chatbot_registry = BackendRegistry(UnifiedChatbot)
 
 
 def get_chatbot(model_type: str = None, ollama_url: str = None) -> UnifiedChatbot:
-    """Retorna instância do chatbot"""
-    return UnifiedChatbot(model_type, ollama_url)
+    """Retorna a instância partilhada do chatbot para (modelo, url)"""
+    return chatbot_registry.get(model_type or DEFAULT_MODEL, ollama_url)
 
 def get_available_models(ollama_url: str = None) -> Dict[str, Any]:
     """Retorna modelos disponíveis"""
-    bot = UnifiedChatbot(ollama_url=ollama_url)
+    bot = get_chatbot(ollama_url=ollama_url)
     return bot.get_available_models()
 
-def generate_response(message: str, model_type: str = None, ollama_url: str = None, context: str = "") -> Dict[str, Any]:
+def generate_response(
+    message: str,
+    model_type: str = None,
+    ollama_url: str = None,
+    context: str = "",
+    history: List[Tuple[str, str]] = None,
+    session_id: str = None
+) -> Dict[str, Any]:
     """
     Gera resposta de forma simplificada
     
@@ -293,13 +823,15 @@ def generate_response(message: str, model_type: str = None, ollama_url: str = No
         model_type: Tipo do modelo a usar
         ollama_url: URL do servidor Ollama (para modelos locais)
         context: Contexto adicional
+        history: Turnos anteriores (mensagem, resposta), do mais antigo ao mais recente
+        session_id: Sessão da conversa
     
     Returns:
         Dict com response e metadata
     """
     try:
-        bot = UnifiedChatbot(model_type, ollama_url)
-        result = bot.generate_response(message, context)
+        bot = get_chatbot(model_type, ollama_url)
+        result = bot.generate_response(message, context, history, session_id)
         return result
     except Exception as e:
         return {
@@ -309,3 +841,72 @@ def generate_response(message: str, model_type: str = None, ollama_url: str = No
             "model": model_type or "unknown",
             "type": "error"
         }
+
+def generate_batch(
+    messages: List[str],
+    model_type: str = None,
+    ollama_url: str = None,
+    context: str = "",
+    max_parallel: int = None
+) -> List[Dict[str, Any]]:
+    """
+    Gera respostas para vários prompts de forma simplificada
+    
+    Args:
+        messages: Lista de mensagens
+        model_type: Tipo do modelo a usar
+        ollama_url: URL do servidor Ollama (para modelos locais)
+        context: Contexto adicional comum a todas
+        max_parallel: Máximo de gerações simultâneas
+    
+    Returns:
+        Lista de resultados na ordem das mensagens
+    """
+    try:
+        bot = get_chatbot(model_type, ollama_url)
+        return bot.generate_batch(messages, context, max_parallel)
+    except Exception as e:
+        return [
+            {
+                "success": False,
+                "error": f"Erro ao processar: {str(e)}",
+                "response": None,
+                "model": model_type or "unknown",
+                "type": "error"
+            }
+            for _ in messages
+        ]
+
+def stream_response(
+    message: str,
+    model_type: str = None,
+    ollama_url: str = None,
+    context: str = "",
+    history: List[Tuple[str, str]] = None,
+    session_id: str = None
+) -> Dict[str, Any]:
+    """
+    Gera resposta em streaming de forma simplificada
+    
+    Args:
+        message: Mensagem do usuário
+        model_type: Tipo do modelo a usar
+        ollama_url: URL do servidor Ollama (para modelos locais)
+        context: Contexto adicional
+        history: Turnos anteriores (mensagem, resposta), do mais antigo ao mais recente
+        session_id: Sessão da conversa
+    
+    Returns:
+        Dict com metadata e "stream" (iterador de pedaços de texto)
+    """
+    try:
+        bot = get_chatbot(model_type, ollama_url)
+        return bot.stream_response(message, context, history, session_id)
+    except Exception as e:
+        return {
+            "success": False,
+            "error": f"Erro ao processar: {str(e)}",
+            "response": None,
+            "model": model_type or "unknown",
+            "type": "error"
+        }
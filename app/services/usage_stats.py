@@ -0,0 +1,232 @@
+"""
+Estatísticas de uso por utilizador mantidas de forma incremental
+Cada gravação do histórico soma às linhas de usage_counters (total e dia) na
+mesma transação do INSERT, e cada remoção subtrai; as estatísticas leem só
+essas linhas (uma por modelo × serviço) em vez de agregar o histórico inteiro
+"""
+import os
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+from dotenv import load_dotenv
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from app.models.base import utcnow
+from app.models.tables import ChatHistory, UsageCounter, User
+from app.services.history_archive import history_archive
+
+load_dotenv()
+
+USAGE_DAILY_COUNTERS = os.environ.get("USAGE_DAILY_COUNTERS", "True").lower() == "true"
+
+TOTAL = "total"
+
+# (user_id, period, model_used, service_type)
+CounterKey = Tuple[int, str, str, str]
+
+
+class UsageCounters:
+    """
+    Contadores por (utilizador, período, modelo, serviço)
+
+    record/subtract não fazem commit: entram na transação de quem grava ou
+    apaga o histórico. Um utilizador sem contadores (ex: histórico anterior à
+    tabela) é reconstruído a partir do histórico na primeira leitura. Turnos
+    movidos para o arquivo continuam a contar até serem apagados de lá.
+    """
+
+    def __init__(self, daily: bool = USAGE_DAILY_COUNTERS):
+        self.daily = daily
+        self.rebuilds = 0
+
+    def record(self, chats: Iterable[ChatHistory]):
+        """Soma as mensagens acabadas de gravar (antes do commit)"""
+        for key, count in self._count(
+            (chat.user_id, chat.model_used, chat.service_type, chat.created_at) for chat in chats
+        ).items():
+            self._increment(key, count)
+
+    def subtract(self, rows: Iterable[Tuple[int, Optional[str], Optional[str], Optional[datetime]]]):
+        """Desconta linhas apagadas do histórico: tuplas (user_id, model_used, service_type, created_at)"""
+        self._decrement(self._count(rows))
+
+    def subtract_usage(self, user_id: int, usage: Iterable[Tuple[str, str, str, int]]):
+        """Desconta turnos agregados (modelo, serviço, dia, mensagens), ex: segmentos do arquivo apagados"""
+        self._decrement(self._count_usage(user_id, usage))
+
+    def forget(self, user_id: int):
+        """Apaga os contadores do utilizador (histórico apagado; não faz commit)"""
+        db.session.execute(delete(UsageCounter.__table__).where(UsageCounter.__table__.c.user_id == user_id))
+
+    def _decrement(self, counts: Counter):
+        table = UsageCounter.__table__
+        touched = set()
+        for key, count in counts.items():
+            db.session.execute(update(table).where(*self._match(key)).values(messages=table.c.messages - count))
+            touched.add(key[0])
+        if touched:
+            db.session.execute(delete(table).where(table.c.user_id.in_(touched), table.c.messages <= 0))
+
+    def user_stats(self, user_id: int, days: int = None) -> Dict[str, Any]:
+        """
+        Totais do utilizador por modelo e por serviço
+
+        Args:
+            days: Inclui as mensagens por dia dos últimos N dias (requer USAGE_DAILY_COUNTERS)
+        """
+        table = UsageCounter.__table__
+        rows = db.session.execute(
+            select(table.c.model_used, table.c.service_type, table.c.messages)
+            .where(table.c.user_id == user_id, table.c.period == TOTAL)
+        ).all()
+        if not rows and self._has_history(user_id):
+            self.rebuild(user_id)
+            db.session.commit()
+            return self.user_stats(user_id, days)
+
+        models, services = Counter(), Counter()
+        for model_used, service_type, messages in rows:
+            models[model_used or None] += messages
+            services[service_type or None] += messages
+        stats = {
+            'total_messages': sum(models.values()),
+            'models': dict(models),
+            'services': dict(services)
+        }
+        if days:
+            stats['daily'] = self.daily_totals(user_id, days)
+        return stats
+
+    def daily_totals(self, user_id: int = None, days: int = 30) -> Dict[str, int]:
+        """Mensagens por dia (AAAA-MM-DD) dos últimos `days` dias, de um utilizador ou de todos"""
+        table = UsageCounter.__table__
+        since = (utcnow() - timedelta(days=days - 1)).date().isoformat()
+        query = select(table.c.period, func.sum(table.c.messages)).where(
+            table.c.period >= since, table.c.period != TOTAL
+        ).group_by(table.c.period).order_by(table.c.period)
+        if user_id is not None:
+            query = query.where(table.c.user_id == user_id)
+        return {period: int(messages) for period, messages in db.session.execute(query)}
+
+    def totals(self) -> List[Dict[str, Any]]:
+        """Totais de todos os utilizadores por modelo e serviço (visão de administração)"""
+        table = UsageCounter.__table__
+        rows = db.session.execute(
+            select(table.c.model_used, table.c.service_type,
+                   func.sum(table.c.messages), func.count(func.distinct(table.c.user_id)))
+            .where(table.c.period == TOTAL)
+            .group_by(table.c.model_used, table.c.service_type)
+            .order_by(func.sum(table.c.messages).desc())
+        ).all()
+        return [
+            {"model_used": model_used or None, "service_type": service_type or None,
+             "messages": int(messages), "users": users}
+            for model_used, service_type, messages, users in rows
+        ]
+
+    def rebuild(self, user_id: int) -> bool:
+        """
+        Recalcula os contadores do utilizador a partir do histórico (não faz commit)
+
+        Returns:
+            True se os contadores guardados estavam diferentes
+        """
+        table = UsageCounter.__table__
+        history = db.session.execute(
+            select(ChatHistory.user_id, ChatHistory.model_used, ChatHistory.service_type, ChatHistory.created_at)
+            .where(ChatHistory.user_id == user_id)
+            .execution_options(yield_per=5000)
+        )
+        expected = self._count(history) + self._count_usage(user_id, history_archive.usage(user_id))
+        stored = {
+            (user_id, period, model_used, service_type): messages
+            for period, model_used, service_type, messages in db.session.execute(
+                select(table.c.period, table.c.model_used, table.c.service_type, table.c.messages)
+                .where(table.c.user_id == user_id)
+            )
+        }
+        if stored == dict(expected):
+            return False
+
+        db.session.execute(delete(table).where(table.c.user_id == user_id))
+        if expected:
+            db.session.execute(insert(table), [
+                {"user_id": key[0], "period": key[1], "model_used": key[2], "service_type": key[3], "messages": count}
+                for key, count in expected.items()
+            ])
+        self.rebuilds += 1
+        return True
+
+    def reconcile(self, user_id: int = None, dry_run: bool = False) -> Dict[str, int]:
+        """
+        Compara os contadores com o histórico e corrige os que divergem
+        (um commit por utilizador)
+
+        Returns:
+            {"users": verificados, "fixed": corrigidos}
+        """
+        user_ids = [user_id] if user_id is not None else db.session.execute(select(User.id).order_by(User.id)).scalars().all()
+        fixed = 0
+        for uid in user_ids:
+            if self.rebuild(uid):
+                fixed += 1
+            if dry_run:
+                db.session.rollback()
+            else:
+                db.session.commit()
+        return {"users": len(user_ids), "fixed": fixed}
+
+    def stats(self) -> Dict[str, Any]:
+        return {"daily": self.daily, "rebuilds": self.rebuilds}
+
+    def _count(self, rows) -> Counter:
+        counts = Counter()
+        today = utcnow().date().isoformat()
+        for user_id, model_used, service_type, created_at in rows:
+            model_used, service_type = model_used or '', service_type or ''
+            counts[(user_id, TOTAL, model_used, service_type)] += 1
+            if self.daily:
+                day = created_at.date().isoformat() if created_at else today
+                counts[(user_id, day, model_used, service_type)] += 1
+        return counts
+
+    def _count_usage(self, user_id: int, usage) -> Counter:
+        counts = Counter()
+        for model_used, service_type, day, messages in usage:
+            model_used, service_type = model_used or '', service_type or ''
+            counts[(user_id, TOTAL, model_used, service_type)] += messages
+            if self.daily and day:
+                counts[(user_id, day, model_used, service_type)] += messages
+        return counts
+
+    @staticmethod
+    def _match(key: CounterKey):
+        table = UsageCounter.__table__
+        user_id, period, model_used, service_type = key
+        return (table.c.user_id == user_id, table.c.period == period,
+                table.c.model_used == model_used, table.c.service_type == service_type)
+
+    def _increment(self, key: CounterKey, count: int):
+        table = UsageCounter.__table__
+        increment = update(table).where(*self._match(key)).values(messages=table.c.messages + count)
+        if db.session.execute(increment).rowcount:
+            return
+        try:
+            # Savepoint: se outra transação criou a linha entretanto, só o INSERT é desfeito
+            with db.session.begin_nested():
+                db.session.execute(insert(table).values(
+                    user_id=key[0], period=key[1], model_used=key[2], service_type=key[3], messages=count
+                ))
+        except IntegrityError:
+            db.session.execute(increment)
+
+    @staticmethod
+    def _has_history(user_id: int) -> bool:
+        return db.session.execute(
+            select(ChatHistory.id).where(ChatHistory.user_id == user_id).limit(1)
+        ).first() is not None or history_archive.has_rows(user_id)
+
+
+usage_counters = UsageCounters()
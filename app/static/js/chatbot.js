@@ -17,6 +17,12 @@ let croppedImageBlob = null;
 let originalFileName = '';
 let currentOllamaUrl = null;
 
+// Histórico paginado (cursor da página seguinte, mais antiga)
+const HISTORY_PAGE_SIZE = 20;
+let historyCursor = null;
+let historyHasMore = true;
+let historyLoading = false;
+
 if (!window.APP_URLS) {
     console.error('ERRO: window.APP_URLS não foi definido! Verifique se o template HTML está correto.');
 }
@@ -29,6 +35,15 @@ setupServiceSelector();
 
 checkModelSelectorScroll();
 
+loadChatHistory();
+
+chatMessages.addEventListener('scroll', () => {
+    // Perto do topo: carrega os turnos anteriores
+    if (chatMessages.scrollTop < 200) {
+        loadChatHistory();
+    }
+});
+
 async function loadUserProfile() {
     try {
         const response = await fetch(window.APP_URLS.userProfile);
@@ -239,11 +254,7 @@ chatForm.addEventListener('submit', async (e) => {
     
     if (!message && !hasFile) return;
 
-    if (firstMessage) {
-        chatMessagesContainer.style.display = 'block';
-        document.querySelector('.chat-main').classList.add('has-messages');
-        firstMessage = false;
-    }
+    showChatMessages();
 
     if (message) {
         addMessage(message, 'user');
@@ -285,7 +296,7 @@ chatForm.addEventListener('submit', async (e) => {
             formData.append('ollama_url', currentOllamaUrl);
         }
         
-        const response = await fetch(window.APP_URLS.chatbot, {
+        const response = await fetch(window.APP_URLS.chatbotStream, {
             method: 'POST',
             headers: {
                 'X-CSRFToken': window.CSRF_TOKEN
@@ -293,6 +304,13 @@ chatForm.addEventListener('submit', async (e) => {
             body: formData
         });
         
+        // Resposta em streaming (SSE): renderiza os tokens à medida que chegam
+        const streamContentType = response.headers.get('content-type') || '';
+        if (response.ok && streamContentType.includes('text/event-stream')) {
+            await handleStreamingResponse(response, typingId);
+            return;
+        }
+        
         removeTypingIndicator(typingId);
         
         // Verificar se a resposta é JSON válido
@@ -343,7 +361,162 @@ chatForm.addEventListener('submit', async (e) => {
     }
 });
 
+function showChatMessages() {
+    if (firstMessage) {
+        chatMessagesContainer.style.display = 'block';
+        document.querySelector('.chat-main').classList.add('has-messages');
+        firstMessage = false;
+    }
+}
+
+async function loadChatHistory() {
+    if (historyLoading || !historyHasMore || !window.APP_URLS.chatHistory) return;
+    historyLoading = true;
+    
+    try {
+        const params = new URLSearchParams({ limit: HISTORY_PAGE_SIZE });
+        if (historyCursor) {
+            params.set('cursor', historyCursor);
+        }
+        
+        const response = await fetch(`${window.APP_URLS.chatHistory}?${params}`);
+        if (!response.ok) {
+            console.error('Erro ao carregar histórico:', response.status);
+            historyHasMore = false;
+            return;
+        }
+        
+        const data = await response.json();
+        historyCursor = data.next_cursor;
+        historyHasMore = Boolean(data.has_more);
+        
+        if (data.history.length) {
+            prependHistory(data.history);
+        }
+    } catch (error) {
+        console.error('Erro ao carregar histórico:', error);
+        historyHasMore = false;
+    } finally {
+        historyLoading = false;
+    }
+    
+    // Página que não enche a área de mensagens não gera scroll: carrega a seguinte
+    if (historyHasMore && chatMessages.scrollHeight <= chatMessages.clientHeight) {
+        loadChatHistory();
+    }
+}
+
+function prependHistory(turns) {
+    showChatMessages();
+    
+    // A página vem do mais recente para o mais antigo; no ecrã fica por ordem cronológica
+    const fragment = document.createDocumentFragment();
+    turns.slice().reverse().forEach((turn) => {
+        fragment.appendChild(renderMessage(turn.message, 'user'));
+        if (turn.response) {
+            fragment.appendChild(renderMessage(turn.response, 'bot', {
+                model: turn.model_used,
+                type: turn.service_type
+            }));
+        }
+    });
+    
+    // Mantém a posição de leitura: a altura acrescentada em cima é compensada no scroll
+    const previousHeight = chatMessages.scrollHeight;
+    chatMessages.insertBefore(fragment, chatMessages.firstChild);
+    chatMessages.scrollTop += chatMessages.scrollHeight - previousHeight;
+}
+
+async function handleStreamingResponse(response, typingId) {
+    let streamingDiv = null;
+    let fullText = '';
+    let finished = false;
+    
+    await readEventStream(response, (event, data) => {
+        if (event === 'token') {
+            if (!streamingDiv) {
+                removeTypingIndicator(typingId);
+                streamingDiv = createStreamingMessage();
+            }
+            fullText += data.token;
+            streamingDiv.querySelector('.message-content').textContent = fullText;
+            chatMessages.scrollTop = chatMessages.scrollHeight;
+        } else if (event === 'done') {
+            finished = true;
+            currentSessionId = data.session_id;
+            if (streamingDiv) streamingDiv.remove();
+            // Renderização final com Markdown e LaTeX
+            addMessage(fullText, 'bot', {
+                model: data.model,
+                type: data.type
+            });
+        } else if (event === 'error') {
+            finished = true;
+            console.error('Erro no streaming:', data.error);
+            addMessage('❌ ' + (data.error || 'Erro ao gerar resposta'), 'bot error');
+        }
+    });
+    
+    removeTypingIndicator(typingId);
+    
+    if (!finished) {
+        addMessage('❌ Erro: A conexão foi interrompida antes do fim da resposta', 'bot error');
+    }
+}
+
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        
+        buffer += decoder.decode(value, { stream: true });
+        
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            
+            let event = 'message';
+            const dataLines = [];
+            rawEvent.split('\n').forEach((line) => {
+                if (line.startsWith('event:')) {
+                    event = line.slice(6).trim();
+                } else if (line.startsWith('data:')) {
+                    dataLines.push(line.slice(5).trim());
+                }
+            });
+            
+            if (dataLines.length) {
+                onEvent(event, JSON.parse(dataLines.join('\n')));
+            }
+        }
+    }
+}
+
+function createStreamingMessage() {
+    const messageDiv = document.createElement('div');
+    messageDiv.className = 'message bot streaming';
+    
+    const contentDiv = document.createElement('div');
+    contentDiv.className = 'message-content';
+    
+    messageDiv.appendChild(contentDiv);
+    chatMessages.appendChild(messageDiv);
+    chatMessages.scrollTop = chatMessages.scrollHeight;
+    
+    return messageDiv;
+}
+
 function addMessage(text, type, metadata = {}) {
+    chatMessages.appendChild(renderMessage(text, type, metadata));
+    chatMessages.scrollTop = chatMessages.scrollHeight;
+}
+
+function renderMessage(text, type, metadata = {}) {
     const messageDiv = document.createElement('div');
     messageDiv.className = `message ${type}`;
     
@@ -420,9 +593,7 @@ function addMessage(text, type, metadata = {}) {
     }
     
     messageDiv.appendChild(contentDiv);
-    chatMessages.appendChild(messageDiv);
-    
-    chatMessages.scrollTop = chatMessages.scrollHeight;
+    return messageDiv;
 }
 
 let typingCounter = 0;
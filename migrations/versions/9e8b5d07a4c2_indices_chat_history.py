@@ -0,0 +1,36 @@
+"""índices (user_id, created_at) e (session_id, created_at) em chat_history
+
+O histórico é lido por utilizador ou sessão, do mais recente para o mais
+antigo: com estes índices a consulta é uma busca no índice (seek) sem
+ordenação nem leitura da tabela inteira. O id (chave primária/clustered)
+já vai no fim de cada entrada do índice, o que cobre o desempate por id.
+
+Revision ID: 9e8b5d07a4c2
+Revises: 7c4e2a61d5f3
+Create Date: 2026-10-17 12:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e8b5d07a4c2'
+down_revision = '7c4e2a61d5f3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Linhas com created_at nulo ficariam fora da ordem por data
+    op.execute("UPDATE chat_history SET created_at = updated_at WHERE created_at IS NULL AND updated_at IS NOT NULL")
+
+    with op.batch_alter_table('chat_history', schema=None) as batch_op:
+        batch_op.create_index('ix_chat_history_user_created', ['user_id', 'created_at'], unique=False)
+        batch_op.create_index('ix_chat_history_session_created', ['session_id', 'created_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('chat_history', schema=None) as batch_op:
+        batch_op.drop_index('ix_chat_history_session_created')
+        batch_op.drop_index('ix_chat_history_user_created')
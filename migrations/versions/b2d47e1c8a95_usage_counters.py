@@ -0,0 +1,75 @@
+"""usage_counters (estatísticas de uso mantidas de forma incremental)
+
+Preenche os contadores a partir do histórico existente (uma leitura de
+chat_history). Para conferir depois: `flask history reconcile-stats`.
+
+Revision ID: b2d47e1c8a95
+Revises: 9e8b5d07a4c2
+Create Date: 2026-10-18 09:00:00.000000
+
+"""
+import os
+from collections import Counter
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b2d47e1c8a95'
+down_revision = '9e8b5d07a4c2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    usage_counters = op.create_table('usage_counters',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('period', sa.String(length=10), nullable=False),
+    sa.Column('model_used', sa.String(length=50), nullable=False),
+    sa.Column('service_type', sa.String(length=20), nullable=False),
+    sa.Column('messages', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.Column('deleted_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('user_id', 'period', 'model_used', 'service_type', name='uq_usage_counters_key')
+    )
+
+    # Mesmas regras de app.services.usage_stats (sem importar a aplicação)
+    daily = os.environ.get("USAGE_DAILY_COUNTERS", "True").lower() == "true"
+    chat_history = sa.table(
+        'chat_history',
+        sa.column('user_id', sa.Integer), sa.column('model_used', sa.String),
+        sa.column('service_type', sa.String), sa.column('created_at', sa.DateTime)
+    )
+    bind = op.get_bind()
+    rows = bind.execute(
+        sa.select(chat_history.c.user_id, chat_history.c.model_used,
+                  chat_history.c.service_type, chat_history.c.created_at)
+        .execution_options(stream_results=True, yield_per=5000)
+    )
+    counts = Counter()
+    today = datetime.utcnow().date().isoformat()
+    for user_id, model_used, service_type, created_at in rows:
+        model_used, service_type = model_used or '', service_type or ''
+        counts[(user_id, 'total', model_used, service_type)] += 1
+        if daily:
+            day = created_at.date().isoformat() if created_at else today
+            counts[(user_id, day, model_used, service_type)] += 1
+
+    now = datetime.utcnow()
+    records = [
+        {"user_id": key[0], "period": key[1], "model_used": key[2], "service_type": key[3],
+         "messages": count, "created_at": now}
+        for key, count in counts.items()
+    ]
+    for start in range(0, len(records), 1000):
+        op.bulk_insert(usage_counters, records[start:start + 1000])
+
+
+def downgrade():
+    op.drop_table('usage_counters')
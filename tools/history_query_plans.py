@@ -0,0 +1,225 @@
+"""
+Planos de execução das consultas do histórico de chat (SQLite e SQL Server)
+
+Compila as consultas de ChatHistoryService (últimos turnos do utilizador e da
+sessão, janela das últimas horas, página seguinte por cursor, sessão inteira e
+limpeza por data) e mostra,
+para cada uma, o plano do banco e o tempo médio. Cada consulta por
+utilizador/sessão deve ser uma busca no índice (SEARCH ... USING INDEX no
+SQLite, Index Seek no SQL Server) sem ordenação extra; o processo termina com
+código 1 se alguma não for.
+
+Sem --url, cria uma base SQLite temporária com --rows linhas e compara o plano
+e o tempo com e sem os índices. Com --url (ex: a base SQL Server configurada),
+só lê: planos e tempos sobre os dados que lá estão.
+
+Uso:
+    USE_SQLITE=True python -m tools.history_query_plans --rows 200000
+    python -m tools.history_query_plans --url "mssql+pyodbc://servidor/base?driver=ODBC+Driver+17+for+SQL+Server"
+"""
+import os
+import re
+import sys
+import time
+import random
+import argparse
+import tempfile
+from datetime import timedelta
+from typing import Dict, Any, List, Tuple
+
+from sqlalchemy import and_, or_, create_engine, func, insert, select
+
+from app import app, db
+from app.models.base import utcnow
+from app.models.tables import ChatHistory, User
+
+# (nome, índice esperado ou None para consultas sem filtro por utilizador/sessão)
+QUERIES = (
+    ("user_latest", "ix_chat_history_user_created"),
+    ("user_recent", "ix_chat_history_user_created"),
+    ("user_page", "ix_chat_history_user_created"),
+    ("session_latest", "ix_chat_history_session_created"),
+    ("session_full", "ix_chat_history_session_created"),
+    ("retention", None)
+)
+
+SHOWPLAN_OPERATORS = re.compile(r'PhysicalOp="([^"]+)"[^>]*?>\s*(?:<[^>]*>\s*)*?<Object [^>]*Index="\[([^\]]+)\]"')
+
+
+def history_queries(user_id: int, session_id: str, limit: int = 20, hours: int = 24, days: int = 30) -> Dict[str, Any]:
+    """As consultas de ChatHistoryService, com os mesmos filtros e ordenação"""
+    table = ChatHistory.__table__
+    newest = (table.c.created_at.desc(), table.c.id.desc())
+    # Sem microssegundos: o DATETIME do SQL Server não aceita o literal com 6 casas
+    now = utcnow().replace(microsecond=0)
+    cursor_at = now - timedelta(days=days)
+    return {
+        "user_latest": select(table).where(table.c.user_id == user_id).order_by(*newest).limit(limit),
+        "user_recent": select(table).where(
+            table.c.user_id == user_id,
+            table.c.created_at >= now - timedelta(hours=hours)
+        ).order_by(*newest).limit(limit),
+        # get_history_page a partir de um cursor (projeção sem a resposta)
+        "user_page": select(table.c.id, table.c.message, table.c.created_at).where(
+            table.c.user_id == user_id,
+            table.c.created_at <= cursor_at,
+            or_(table.c.created_at < cursor_at, and_(table.c.created_at == cursor_at, table.c.id < 2 ** 31 - 1))
+        ).order_by(*newest).limit(limit + 1),
+        "session_latest": select(table).where(table.c.session_id == session_id).order_by(*newest).limit(limit),
+        "session_full": select(table).where(table.c.session_id == session_id).order_by(*newest),
+        "retention": select(func.count()).select_from(table).where(table.c.created_at < now - timedelta(days=days))
+    }
+
+
+def populate(engine, rows: int, users: int, sessions_per_user: int, days: int = 90, seed: int = 1):
+    """Preenche uma base vazia com histórico sintético distribuído pelos últimos `days` dias"""
+    rng = random.Random(seed)
+    now = utcnow()
+    with engine.begin() as conn:
+        conn.execute(insert(User.__table__), [
+            {"id": user_id, "name": f"user{user_id}", "password": "x", "email": f"user{user_id}@example.com"}
+            for user_id in range(1, users + 1)
+        ])
+        batch = []
+        for _ in range(rows):
+            user_id = rng.randint(1, users)
+            created_at = now - timedelta(seconds=rng.uniform(0, days * 86400))
+            batch.append({
+                "user_id": user_id,
+                "message": "pergunta " * 8,
+                "response": "resposta " * 40,
+                "model_used": "gemini",
+                "service_type": "text",
+                "session_id": f"s-{user_id}-{rng.randint(1, sessions_per_user)}",
+                "created_at": created_at
+            })
+            if len(batch) == 5000:
+                conn.execute(insert(ChatHistory.__table__), batch)
+                batch = []
+        if batch:
+            conn.execute(insert(ChatHistory.__table__), batch)
+
+
+def sample_keys(engine) -> Tuple[int, str]:
+    """Utilizador e sessão com mais linhas (o pior caso para as consultas)"""
+    table = ChatHistory.__table__
+    with engine.connect() as conn:
+        user_id = conn.execute(
+            select(table.c.user_id).group_by(table.c.user_id).order_by(func.count().desc()).limit(1)
+        ).scalar()
+        session_id = conn.execute(
+            select(table.c.session_id).where(table.c.session_id.isnot(None))
+            .group_by(table.c.session_id).order_by(func.count().desc()).limit(1)
+        ).scalar()
+    if user_id is None:
+        raise SystemExit("chat_history vazia: use sem --url para gerar dados ou aponte para uma base com histórico")
+    return user_id, session_id
+
+
+def sql_of(engine, query) -> str:
+    return str(query.compile(dialect=engine.dialect, compile_kwargs={"literal_binds": True}))
+
+
+def explain_sqlite(conn, sql: str) -> Tuple[List[str], Dict[str, Any]]:
+    rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+    plan = [row[-1] for row in rows]
+    joined = " | ".join(plan)
+    index = re.search(r"USING (?:COVERING )?INDEX (\w+)", joined)
+    return plan, {
+        "seek": joined.startswith("SEARCH") and index is not None,
+        "index": index.group(1) if index else None,
+        "sort": "TEMP B-TREE" in joined
+    }
+
+
+def explain_mssql(conn, sql: str) -> Tuple[List[str], Dict[str, Any]]:
+    cursor = conn.connection.cursor()
+    cursor.execute("SET SHOWPLAN_XML ON")
+    try:
+        cursor.execute(sql)
+        xml = cursor.fetchone()[0]
+    finally:
+        cursor.execute("SET SHOWPLAN_XML OFF")
+        cursor.close()
+
+    operators = re.findall(r'PhysicalOp="([^"]+)"', xml)
+    seeks = [index for op, index in SHOWPLAN_OPERATORS.findall(xml) if op == "Index Seek"]
+    plan = [f"{op} {index}" for op, index in SHOWPLAN_OPERATORS.findall(xml)] or operators
+    return plan, {
+        "seek": bool(seeks),
+        "index": seeks[0] if seeks else None,
+        "sort": "Sort" in operators
+    }
+
+
+def measure(engine, queries: Dict[str, Any], repeat: int) -> List[Dict[str, Any]]:
+    explain = explain_mssql if engine.dialect.name == "mssql" else explain_sqlite
+    results = []
+    with engine.connect() as conn:
+        for name, expected in QUERIES:
+            sql = sql_of(engine, queries[name])
+            plan, info = explain(conn, sql)
+
+            conn.exec_driver_sql(sql).fetchall()
+            start = time.perf_counter()
+            for _ in range(repeat):
+                conn.exec_driver_sql(sql).fetchall()
+            elapsed_ms = (time.perf_counter() - start) * 1000 / max(1, repeat)
+
+            ok = expected is None or (info["seek"] and info["index"] == expected and not info["sort"])
+            results.append({"name": name, "expected": expected, "plan": plan, "ms": elapsed_ms, "ok": ok, **info})
+    return results
+
+
+def report(title: str, results: List[Dict[str, Any]]):
+    print(f"\n{title}")
+    for result in results:
+        status = "ok" if result["ok"] else "SEM SEEK"
+        if result["expected"] is None:
+            status = "-"
+        print(f"  {result['name']:<15} {result['ms']:>9.3f} ms  {status:<9} {' | '.join(result['plan'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Planos de execução das consultas do histórico de chat")
+    parser.add_argument("--url", help="Base existente (só leitura); sem ela é criada uma base SQLite temporária")
+    parser.add_argument("--rows", type=int, default=100000, help="Linhas geradas na base temporária")
+    parser.add_argument("--users", type=int, default=200, help="Utilizadores na base temporária")
+    parser.add_argument("--sessions", type=int, default=20, help="Sessões por utilizador na base temporária")
+    parser.add_argument("--repeat", type=int, default=50, help="Execuções de cada consulta na medição do tempo")
+    args = parser.parse_args()
+
+    if args.url:
+        engine = create_engine(args.url)
+        user_id, session_id = sample_keys(engine)
+        results = measure(engine, history_queries(user_id, session_id), args.repeat)
+        report(f"{engine.dialect.name}: utilizador {user_id}, sessão {session_id}", results)
+        sys.exit(0 if all(result["ok"] for result in results) else 1)
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{os.path.join(directory, 'history.db')}")
+        with app.app_context():
+            db.metadata.create_all(engine, tables=[User.__table__, ChatHistory.__table__])
+
+        print(f"A gerar {args.rows} linhas ({args.users} utilizadores, {args.sessions} sessões cada)...")
+        populate(engine, args.rows, args.users, args.sessions)
+        with engine.begin() as conn:
+            conn.exec_driver_sql("ANALYZE")
+        user_id, session_id = sample_keys(engine)
+        queries = history_queries(user_id, session_id)
+
+        indexed = measure(engine, queries, args.repeat)
+        report(f"sqlite com índices: utilizador {user_id}, sessão {session_id}", indexed)
+
+        for index in ChatHistory.__table__.indexes:
+            index.drop(engine)
+        with engine.begin() as conn:
+            conn.exec_driver_sql("ANALYZE")
+        report("sqlite sem índices", measure(engine, queries, args.repeat))
+        engine.dispose()
+
+    sys.exit(0 if all(result["ok"] for result in indexed) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,444 @@
+"""
+Teste de carga ponta a ponta do chatbot (em processo, via test_client do Flask)
+
+Reproduz uma mistura de conversas (texto, streaming, imagem/OCR, WhatsApp)
+contra a aplicação e reporta vazão e p50/p95/p99 por cenário e por etapa
+(total, primeiro token e as etapas do cabeçalho Server-Timing, quando presente).
+
+Por padrão sobe o servidor simulado (tools.mock_llm) e o stub do Gemini,
+sem rede. Use uma base de dados descartável (ex: USE_SQLITE=True).
+
+Uso:
+    USE_SQLITE=True python -m tools.loadtest --mix text=60,stream=20,image=10,whatsapp=10 --users 8 --duration 30
+    python -m tools.loadtest ... --json atual.json --baseline anterior.json --max-regression 0.2
+"""
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from typing import Dict, Any, List, Optional
+
+from tools.mock_llm import MockLLMConfig, LatencyDistribution, GeminiStub, start_mock_server, add_config_arguments, config_from_args
+
+# O webhook do WhatsApp importa o cliente Twilio (que exige estas variáveis) mas não envia mensagens
+for _name, _value in (
+    ("TWILIO_WHATSAPP_NUMBER", "+10000000000"),
+    ("MY_WHATSAPP_NUMBER", "+10000000001"),
+    ("TWILIO_ACCOUNT_SID", "ACloadtest"),
+    ("TWILIO_AUTH_TOKEN", "loadtest")
+):
+    os.environ.setdefault(_name, _value)
+
+SCENARIOS = ("text", "stream", "image", "whatsapp")
+
+QUESTIONS = [
+    "Como resolver x² - 5x + 6 = 0?",
+    "O que é a derivada de uma função?",
+    "Explique a diferença entre lista e tupla em Python",
+    "Traduza para inglês: o estudante resolveu o exercício",
+    "Qual é a fórmula da área do círculo?",
+    "Como funciona a busca binária?",
+    "O que é uma matriz inversa?",
+    "Dê um exemplo de recursão",
+    "Como calcular a média ponderada?",
+    "Qual a diferença entre velocidade e aceleração?"
+]
+FOLLOW_UPS = [
+    "Pode dar outro exemplo?",
+    "Explique de forma mais simples",
+    "E se o valor for negativo?",
+    "Pode resumir em três passos?"
+]
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Percentil pelo método nearest-rank"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, int(-(-p * len(ordered) // 100)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def parse_server_timing(header: Optional[str]) -> Dict[str, float]:
+    """Cabeçalho Server-Timing ("nome;dur=12.3, outro;dur=4") em {nome: segundos}"""
+    stages = {}
+    for metric in (header or "").split(","):
+        parts = [p.strip() for p in metric.split(";")]
+        if not parts[0]:
+            continue
+        for param in parts[1:]:
+            key, _, value = param.partition("=")
+            if key == "dur":
+                try:
+                    stages[parts[0]] = float(value) / 1000.0
+                except ValueError:
+                    pass
+    return stages
+
+
+class Recorder:
+    """Amostras de latência por cenário e etapa"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples: Dict[str, Dict[str, List[float]]] = {}
+        self.counts: Dict[str, Dict[str, int]] = {}
+        self.statuses: Dict[str, Dict[str, int]] = {}
+
+    def record(self, scenario: str, status: int, ok: bool, stages: Dict[str, float]):
+        with self._lock:
+            counts = self.counts.setdefault(scenario, {"requests": 0, "errors": 0})
+            counts["requests"] += 1
+            counts["errors"] += 0 if ok else 1
+            statuses = self.statuses.setdefault(scenario, {})
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            samples = self.samples.setdefault(scenario, {})
+            for stage, seconds in stages.items():
+                samples.setdefault(stage, []).append(seconds)
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        with self._lock:
+            total = sum(c["requests"] for c in self.counts.values())
+            scenarios = {}
+            for scenario, counts in self.counts.items():
+                scenarios[scenario] = {
+                    **counts,
+                    "throughput": round(counts["requests"] / elapsed, 3) if elapsed else 0.0,
+                    "status": dict(self.statuses.get(scenario, {})),
+                    "stages": {
+                        stage: {
+                            "count": len(values),
+                            "mean": round(sum(values) / len(values), 4),
+                            "p50": round(percentile(values, 50), 4),
+                            "p95": round(percentile(values, 95), 4),
+                            "p99": round(percentile(values, 99), 4),
+                            "max": round(max(values), 4)
+                        }
+                        for stage, values in self.samples.get(scenario, {}).items()
+                    }
+                }
+            return {
+                "elapsed": round(elapsed, 3),
+                "requests": total,
+                "throughput": round(total / elapsed, 3) if elapsed else 0.0,
+                "scenarios": scenarios
+            }
+
+
+class VirtualUser:
+    """Utilizador simulado: conversas de alguns turnos na mesma sessão"""
+
+    def __init__(self, app, user_id: int, index: int, args, mix: List[tuple], image_bytes: bytes, recorder: Recorder):
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session["_user_id"] = str(user_id)
+            session["_fresh"] = True
+        self.index = index
+        self.args = args
+        self.mix = mix
+        self.image_bytes = image_bytes
+        self.recorder = recorder
+        self.rng = random.Random((args.seed or 0) * 1000 + index)
+        self.session_id = None
+        self.turns_left = 0
+
+    def run(self, deadline: float, budget: "RequestBudget"):
+        while time.monotonic() < deadline and budget.take():
+            scenario = self._pick()
+            try:
+                getattr(self, f"_{scenario}")()
+            except Exception as e:
+                print(f"Erro no cenário {scenario}: {e}")
+                self.recorder.record(scenario, 0, False, {})
+            if self.args.think_time:
+                time.sleep(self.rng.uniform(0, self.args.think_time))
+
+    def _pick(self) -> str:
+        roll = self.rng.uniform(0, sum(weight for _, weight in self.mix))
+        for scenario, weight in self.mix:
+            roll -= weight
+            if roll <= 0:
+                return scenario
+        return self.mix[-1][0]
+
+    def _next_message(self) -> str:
+        if self.turns_left <= 0:
+            self.session_id = str(uuid.uuid4())
+            self.turns_left = self.rng.randint(2, 5)
+            message = self.rng.choice(QUESTIONS)
+        else:
+            message = self.rng.choice(FOLLOW_UPS)
+        self.turns_left -= 1
+        return message
+
+    def _chat_form(self) -> Dict[str, Any]:
+        message = self._next_message()
+        form = {"message": message, "model": self.args.model, "session_id": self.session_id}
+        if self.args.ollama_url:
+            form["ollama_url"] = self.args.ollama_url
+        return form
+
+    def _text(self):
+        start = time.perf_counter()
+        response = self.client.post("/chatbot", data=self._chat_form())
+        total = time.perf_counter() - start
+        self._finish("text", response, total)
+
+    def _image(self):
+        form = {
+            "model": self.args.model,
+            "session_id": self.session_id or str(uuid.uuid4()),
+            "mode": "text",
+            "image": (io.BytesIO(self.image_bytes), "exercicio.png", "image/png")
+        }
+        if self.args.ollama_url:
+            form["ollama_url"] = self.args.ollama_url
+        start = time.perf_counter()
+        response = self.client.post("/chatbot", data=form, content_type="multipart/form-data")
+        total = time.perf_counter() - start
+        self._finish("image", response, total)
+
+    def _whatsapp(self):
+        form = {"Body": self._next_message(), "From": f"whatsapp:+2588400{self.index:05d}"}
+        start = time.perf_counter()
+        response = self.client.post("/whatsapp", data=form)
+        total = time.perf_counter() - start
+        # O webhook responde sempre 200 com TwiML; falhas aparecem no texto da mensagem
+        ok = response.status_code == 200 and "Desculpe" not in response.get_data(as_text=True)
+        self.recorder.record("whatsapp", response.status_code, ok, self._stages(response, total))
+
+    def _stream(self):
+        start = time.perf_counter()
+        response = self.client.post("/chatbot/stream", data=self._chat_form(), buffered=False)
+        first_token = None
+        ok = response.status_code == 200
+        try:
+            for chunk in response.response:
+                if first_token is None and b"event: token" in chunk:
+                    first_token = time.perf_counter() - start
+                if b"event: error" in chunk:
+                    ok = False
+        finally:
+            response.close()
+        total = time.perf_counter() - start
+
+        stages = self._stages(response, total)
+        if first_token is not None:
+            stages["first_token"] = first_token
+        self.recorder.record("stream", response.status_code, ok and first_token is not None, stages)
+
+    def _finish(self, scenario: str, response, total: float):
+        self.recorder.record(scenario, response.status_code, response.status_code < 400, self._stages(response, total))
+
+    @staticmethod
+    def _stages(response, total: float) -> Dict[str, float]:
+        stages = parse_server_timing(response.headers.get("Server-Timing"))
+        # "total" do servidor (até os cabeçalhos) não substitui o tempo medido no cliente
+        if "total" in stages:
+            stages["server"] = stages.pop("total")
+        stages["total"] = total
+        return stages
+
+
+class RequestBudget:
+    """Limite opcional do número total de requisições"""
+
+    def __init__(self, limit: int = None):
+        self.remaining = limit
+        self._lock = threading.Lock()
+
+    def take(self) -> bool:
+        if self.remaining is None:
+            return True
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+def parse_mix(value: str) -> List[tuple]:
+    mix = []
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"Cenário desconhecido: {name} (opções: {', '.join(SCENARIOS)})")
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+def make_image() -> bytes:
+    """PNG com o enunciado de um exercício (entrada do cenário de OCR)"""
+    from PIL import Image, ImageDraw
+
+    image = Image.new("RGB", (480, 120), "white")
+    ImageDraw.Draw(image).text((10, 40), "Resolva: 2x - 2 = 0", fill="black")
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def install_ocr_stub(routes, latency: LatencyDistribution, seed: int = None):
+    """Substitui a extração por OCR (sem tesseract/pix2tex no ambiente) por uma etapa com latência simulada"""
+    rng = random.Random(seed)
+    lock = threading.Lock()
+
+    def process_image(uploaded_file, mode: str = "text", crop_box=None) -> dict:
+        uploaded_file.read()
+        with lock:
+            delay = latency.sample(rng)
+        time.sleep(delay)
+        return {"success": True, "type": "text", "content": "Resolva: 2x - 2 = 0"}
+
+    routes.process_image = process_image
+
+
+def prepare_users(app, db, count: int) -> List[int]:
+    """Cria (se necessário) os utilizadores do teste de carga"""
+    from werkzeug.security import generate_password_hash
+    from app.models.tables import User
+
+    ids = []
+    with app.app_context():
+        db.create_all()
+        for i in range(count):
+            email = f"loadtest{i}@loadtest.local"
+            user = User.query.filter_by(email=email).first()
+            if user is None:
+                user = User(f"Load Test {i}", email, generate_password_hash(uuid.uuid4().hex), "0")
+                db.session.add(user)
+                db.session.commit()
+            ids.append(user.id)
+    return ids
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], max_regression: float) -> List[str]:
+    """Etapas cujo p95 piorou mais que max_regression (fração) em relação à linha de base"""
+    regressions = []
+    for scenario, data in report["scenarios"].items():
+        base_stages = baseline.get("scenarios", {}).get(scenario, {}).get("stages", {})
+        for stage, stats in data["stages"].items():
+            base = base_stages.get(stage)
+            if not base or not base.get("p95"):
+                continue
+            change = stats["p95"] / base["p95"] - 1
+            if change > max_regression:
+                regressions.append(
+                    f"{scenario}/{stage}: p95 {base['p95'] * 1000:.1f}ms -> {stats['p95'] * 1000:.1f}ms (+{change:.0%})"
+                )
+    return regressions
+
+
+def print_report(report: Dict[str, Any]):
+    print(f"\n📊 {report['requests']} requisições em {report['elapsed']}s ({report['throughput']} req/s)")
+    for scenario, data in sorted(report["scenarios"].items()):
+        print(f"\n[{scenario}] {data['requests']} req, {data['errors']} erros, {data['throughput']} req/s, status {data['status']}")
+        print(f"  {'etapa':<24}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for stage, stats in sorted(data["stages"].items(), key=lambda item: item[0] != "total"):
+            print(
+                f"  {stage:<24}{stats['count']:>6}"
+                f"{stats['p50'] * 1000:>10.1f}{stats['p95'] * 1000:>10.1f}"
+                f"{stats['p99'] * 1000:>10.1f}{stats['max'] * 1000:>10.1f}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Teste de carga ponta a ponta do chatbot")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("text=60,stream=20,image=10,whatsapp=10"),
+                        help="Pesos dos cenários, ex: text=60,stream=20,image=10,whatsapp=10")
+    parser.add_argument("--users", type=int, default=8, help="Utilizadores simultâneos")
+    parser.add_argument("--duration", type=float, default=30.0, help="Duração em segundos")
+    parser.add_argument("--requests", type=int, default=None, help="Parar após N requisições")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Pausa máxima (s) entre mensagens de um utilizador")
+    parser.add_argument("--model", default="ollama_mock_llm", help="Modelo usado nos cenários web (ex: gemini)")
+    parser.add_argument("--ollama-url", default=None, help="Servidor Ollama real (sem ele, sobe o mock)")
+    parser.add_argument("--real-gemini", action="store_true", help="Usar o Gemini real em vez do stub")
+    parser.add_argument("--ocr-latency", default="lognormal:0.3,0.4", help="Latência da etapa de OCR simulada")
+    parser.add_argument("--keep-history", action="store_true", help="Não apagar o histórico gerado")
+    parser.add_argument("--json", dest="json_path", default=None, help="Salvar o relatório em JSON")
+    parser.add_argument("--baseline", default=None, help="Relatório JSON anterior para comparação")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="Piora máxima aceitável do p95 (fração)")
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    mock_config = config_from_args(args)
+    if not args.ollama_url:
+        _, args.ollama_url = start_mock_server(mock_config)
+        print(f"🧪 Mock LLM em {args.ollama_url}")
+
+    from app import app, db
+    from app.controllers import routes
+    from app.services.unified_chatbot import set_gemini_model
+    from app.services.pix2latex_service import get_service_status
+    from app.services.chat_history_service import chat_history_service
+
+    if not args.real_gemini:
+        set_gemini_model(GeminiStub(mock_config))
+
+    scenarios = dict(args.mix)
+    if "image" in scenarios and not get_service_status()["text_extraction"]:
+        print("⚠️ Sem tesseract: cenário de imagem usa OCR simulado (--ocr-latency)")
+        install_ocr_stub(routes, LatencyDistribution(args.ocr_latency), args.seed)
+    if "whatsapp" in scenarios and not routes.TWILIO_AVAILABLE:
+        print("⚠️ Twilio não instalado: cenário whatsapp ignorado")
+        scenarios.pop("whatsapp")
+    if not scenarios:
+        parser.error("Nenhum cenário disponível")
+    mix = list(scenarios.items())
+
+    user_ids = prepare_users(app, db, args.users)
+    image_bytes = make_image() if "image" in scenarios else b""
+    recorder = Recorder()
+    budget = RequestBudget(args.requests)
+    users = [VirtualUser(app, uid, i, args, mix, image_bytes, recorder) for i, uid in enumerate(user_ids)]
+
+    print(f"🚀 {args.users} utilizadores, mistura {mix}, modelo {args.model}")
+    start = time.monotonic()
+    deadline = start + args.duration
+    threads = [threading.Thread(target=user.run, args=(deadline, budget), daemon=True) for user in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report = recorder.report(time.monotonic() - start)
+    report["config"] = {
+        "mix": dict(mix),
+        "users": args.users,
+        "model": args.model,
+        "latency": args.latency,
+        "tokens_per_second": args.tokens_per_second,
+        "error_rate": args.error_rate
+    }
+    report["mock"] = dict(mock_config.stats)
+
+    if not args.keep_history:
+        with app.app_context():
+            for uid in user_ids:
+                chat_history_service.delete_user_history(uid)
+
+    print_report(report)
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.max_regression)
+        if regressions:
+            print("\n❌ Regressões de latência:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("\n✅ Sem regressões em relação à linha de base")
+
+
+if __name__ == "__main__":
+    main()
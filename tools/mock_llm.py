@@ -0,0 +1,410 @@
+"""
+Servidor LLM simulado para medir o chatbot sem Gemini nem Ollama reais
+
+Implementa /api/tags, /api/generate, /api/chat (com e sem streaming) e
+/api/embed do Ollama, com distribuição de latência, taxa de tokens e
+injeção de erros configuráveis; GeminiStub substitui o cliente do Gemini.
+
+Uso:
+    python -m tools.mock_llm --port 11435 --latency lognormal:0.4,0.5 --tokens-per-second 20 --error-rate 0.02
+    (no chatbot, use http://127.0.0.1:11435 como URL Ollama)
+
+Estatísticas do servidor em GET /mock/stats.
+"""
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, List, Tuple
+
+VOCABULARY = (
+    "a derivada de uma função mede a taxa de variação instantânea "
+    "para resolver a equação isolamos o termo desconhecido e aplicamos "
+    "a propriedade distributiva em seguida verificamos o resultado "
+    "um algoritmo é uma sequência finita de passos bem definidos "
+    "por exemplo \\(x = 2\\) satisfaz a condição pedida no enunciado"
+).split()
+
+
+class LatencyDistribution:
+    """
+    Distribuição de latência em segundos a partir de uma especificação textual
+
+    fixed:S | uniform:MIN,MAX | normal:MEDIA,DESVIO | lognormal:MEDIANA,SIGMA | exp:MEDIA
+    """
+
+    def __init__(self, spec: str = "fixed:0"):
+        self.spec = spec
+        kind, _, args = spec.partition(":")
+        self.kind = kind.strip().lower()
+        self.args = [float(a) for a in args.split(",") if a.strip()]
+
+        expected = {"fixed": 1, "uniform": 2, "normal": 2, "lognormal": 2, "exp": 1}
+        if self.kind not in expected or len(self.args) != expected[self.kind]:
+            raise ValueError(f"Distribuição de latência inválida: {spec}")
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "fixed":
+            value = self.args[0]
+        elif self.kind == "uniform":
+            value = rng.uniform(*self.args)
+        elif self.kind == "normal":
+            value = rng.gauss(*self.args)
+        elif self.kind == "lognormal":
+            value = rng.lognormvariate(math.log(self.args[0]), self.args[1])
+        else:
+            value = rng.expovariate(1.0 / self.args[0]) if self.args[0] > 0 else 0.0
+        return max(0.0, value)
+
+
+class MockLLMConfig:
+    """Comportamento do servidor simulado (partilhado pelo mock Ollama e pelo GeminiStub)"""
+
+    def __init__(
+        self,
+        models: List[str] = None,
+        latency: str = "fixed:0.05",
+        tokens_per_second: float = 50.0,
+        response_tokens: Tuple[int, int] = (20, 80),
+        prompt_eval_rate: float = 0.0,
+        error_rate: float = 0.0,
+        error_status: int = 500,
+        stream_error_rate: float = 0.0,
+        seed: int = None
+    ):
+        """
+        Args:
+            models: Modelos anunciados em /api/tags
+            latency: Distribuição do tempo até o primeiro token (ver LatencyDistribution)
+            tokens_per_second: Ritmo de geração (0 = instantâneo)
+            response_tokens: Intervalo (mín, máx) de tokens por resposta
+            prompt_eval_rate: Tokens de prompt avaliados por segundo (0 = custo ignorado);
+                o prefixo repetido do pedido anterior do mesmo modelo não é cobrado, como no KV cache do Ollama
+            error_rate: Probabilidade de responder com error_status
+            stream_error_rate: Probabilidade de interromper um stream a meio com uma linha de erro
+        """
+        self.models = models or ["mock-llm:latest", "nomic-embed-text:latest"]
+        self.latency = LatencyDistribution(latency)
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = response_tokens
+        self.prompt_eval_rate = prompt_eval_rate
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.stream_error_rate = stream_error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._last_prompt: Dict[str, str] = {}
+        self.stats = {"requests": 0, "errors": 0, "stream_errors": 0, "tokens": 0, "prompt_tokens_evaluated": 0}
+
+    def roll(self, probability: float) -> bool:
+        with self._lock:
+            return self._rng.random() < probability
+
+    def first_token_delay(self, model: str, prompt: str) -> Tuple[float, int]:
+        """Latência até o primeiro token e número de tokens de prompt avaliados"""
+        with self._lock:
+            delay = self.latency.sample(self._rng)
+            previous = self._last_prompt.get(model, "")
+            self._last_prompt[model] = prompt
+
+        shared = 0
+        for a, b in zip(previous, prompt):
+            if a != b:
+                break
+            shared += 1
+        evaluated = estimate_tokens(prompt[shared:])
+        if self.prompt_eval_rate > 0:
+            delay += evaluated / self.prompt_eval_rate
+        self.count("prompt_tokens_evaluated", evaluated)
+        return delay, evaluated
+
+    def response_words(self, prompt: str) -> List[str]:
+        with self._lock:
+            count = self._rng.randint(*self.response_tokens)
+            start = self._rng.randrange(len(VOCABULARY))
+        words = [VOCABULARY[(start + i) % len(VOCABULARY)] for i in range(count)]
+        return [word if i == 0 else f" {word}" for i, word in enumerate(words)]
+
+    def token_delay(self) -> float:
+        return 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+    def count(self, stat: str, amount: int = 1):
+        with self._lock:
+            self.stats[stat] += amount
+
+
+def estimate_tokens(text: str) -> int:
+    """Aproximação de ~4 caracteres por token"""
+    return max(1, len(text) // 4) if text else 0
+
+
+def fake_embedding(text: str, dimensions: int = 64) -> List[float]:
+    """Vetor determinístico (hash das palavras) normalizado"""
+    vector = [0.0] * dimensions
+    for word in text.lower().split():
+        digest = hashlib.md5(word.encode("utf-8")).digest()
+        vector[digest[0] % dimensions] += 1.0 if digest[1] % 2 else -1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+class MockOllamaHandler(BaseHTTPRequestHandler):
+    """Endpoints do Ollama usados pelo chatbot"""
+
+    protocol_version = "HTTP/1.1"
+    config: MockLLMConfig = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._send_json({"models": [
+                {"name": name, "model": name, "size": 0, "details": {"family": name.split(":")[0]}}
+                for name in self.config.models
+            ]})
+        elif self.path == "/api/version":
+            self._send_json({"version": "0.0.0-mock"})
+        elif self.path == "/mock/stats":
+            self._send_json(dict(self.config.stats))
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return self._send_json({"error": "invalid JSON"}, 400)
+
+        self.config.count("requests")
+
+        if self.path == "/api/embed":
+            return self._embed(body)
+        if self.path not in ("/api/generate", "/api/chat"):
+            return self._send_json({"error": "not found"}, 404)
+
+        model = body.get("model", "")
+        if model not in self.config.models:
+            return self._send_json({"error": f"model '{model}' not found"}, 404)
+
+        if self.config.roll(self.config.error_rate):
+            self.config.count("errors")
+            return self._send_json({"error": "mock: erro injetado"}, self.config.error_status)
+
+        chat = self.path == "/api/chat"
+        prompt = self._prompt_text(body, chat)
+        delay, prompt_tokens = self.config.first_token_delay(model, prompt)
+        words = self.config.response_words(prompt)
+        time.sleep(delay)
+
+        if body.get("stream", True):
+            self._stream(body, chat, words, prompt_tokens)
+        else:
+            time.sleep(self.config.token_delay() * len(words))
+            self.config.count("tokens", len(words))
+            self._send_json(self._final(body, chat, "".join(words), prompt_tokens, len(words)))
+
+    def _prompt_text(self, body: Dict[str, Any], chat: bool) -> str:
+        if chat:
+            return "\n".join(f"{m.get('role')}: {m.get('content')}" for m in body.get("messages", []))
+        # Com `context` (continuação de sessão) só o prompt novo é avaliado
+        prefix = "" if body.get("context") else f"{body.get('system', '')}\n"
+        return prefix + body.get("prompt", "")
+
+    def _final(self, body: Dict[str, Any], chat: bool, text: str, prompt_tokens: int, eval_tokens: int) -> Dict[str, Any]:
+        result = {
+            "model": body.get("model"),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "done": True,
+            "done_reason": "stop",
+            "prompt_eval_count": prompt_tokens,
+            "eval_count": eval_tokens
+        }
+        if chat:
+            result["message"] = {"role": "assistant", "content": text}
+        else:
+            result["response"] = text
+            result["context"] = list(body.get("context") or []) + list(range(prompt_tokens + eval_tokens))[:4096]
+        return result
+
+    def _stream(self, body: Dict[str, Any], chat: bool, words: List[str], prompt_tokens: int):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        fail_at = len(words) // 2 if self.config.roll(self.config.stream_error_rate) else None
+        try:
+            for i, word in enumerate(words):
+                if i == fail_at:
+                    self.config.count("stream_errors")
+                    self._write_chunk({"error": "mock: falha injetada no stream"})
+                    break
+                part = {"role": "assistant", "content": word} if chat else word
+                self._write_chunk({"model": body.get("model"), "message" if chat else "response": part, "done": False})
+                self.config.count("tokens")
+                time.sleep(self.config.token_delay())
+            else:
+                final = self._final(body, chat, "", prompt_tokens, len(words))
+                self._write_chunk(final)
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # Cliente desistiu (ex: stream cancelado pelo chatbot)
+            self.close_connection = True
+
+    def _embed(self, body: Dict[str, Any]):
+        inputs = body.get("input", "")
+        inputs = inputs if isinstance(inputs, list) else [inputs]
+        self._send_json({"model": body.get("model"), "embeddings": [fake_embedding(text) for text in inputs]})
+
+    def _write_chunk(self, obj: Dict[str, Any]):
+        line = (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+        self.wfile.flush()
+
+    def _send_json(self, obj: Dict[str, Any], status: int = 200):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clientes que fecham conexões keep-alive ou cancelam streams não são erros do mock
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+
+def start_mock_server(config: MockLLMConfig = None, host: str = "127.0.0.1", port: int = 0):
+    """
+    Inicia o mock Ollama numa thread em background
+
+    Returns:
+        Tupla (servidor, url) - chame servidor.shutdown() para parar
+    """
+    handler = type("ConfiguredMockOllamaHandler", (MockOllamaHandler,), {"config": config or MockLLMConfig()})
+    server = _MockServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name="mock-llm", daemon=True).start()
+    return server, f"http://{host}:{server.server_port}"
+
+
+class _StubChunk:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class GeminiStub:
+    """
+    Substituto do GenerativeModel com a latência/erros do MockLLMConfig
+
+    Instale com app.services.unified_chatbot.set_gemini_model(GeminiStub(config)).
+    """
+
+    def __init__(self, config: MockLLMConfig = None):
+        self.config = config or MockLLMConfig()
+
+    def generate_content(self, prompt: str, stream: bool = False):
+        words, delay = self._start(prompt)
+        time.sleep(delay)
+        if stream:
+            return self._iter_chunks(words)
+        time.sleep(self.config.token_delay() * len(words))
+        self.config.count("tokens", len(words))
+        return _StubChunk("".join(words))
+
+    async def generate_content_async(self, prompt: str, stream: bool = False):
+        words, delay = self._start(prompt)
+        await asyncio.sleep(delay)
+        if stream:
+            return self._aiter_chunks(words)
+        await asyncio.sleep(self.config.token_delay() * len(words))
+        self.config.count("tokens", len(words))
+        return _StubChunk("".join(words))
+
+    def _start(self, prompt: str) -> Tuple[List[str], float]:
+        self.config.count("requests")
+        if self.config.roll(self.config.error_rate):
+            self.config.count("errors")
+            raise RuntimeError("mock: erro injetado no Gemini")
+        delay, _ = self.config.first_token_delay("gemini", prompt)
+        return self.config.response_words(prompt), delay
+
+    def _iter_chunks(self, words: List[str]):
+        # O Gemini entrega o texto em blocos de várias palavras
+        for i in range(0, len(words), 8):
+            block = words[i:i + 8]
+            time.sleep(self.config.token_delay() * len(block))
+            self.config.count("tokens", len(block))
+            yield _StubChunk("".join(block))
+
+    async def _aiter_chunks(self, words: List[str]):
+        for i in range(0, len(words), 8):
+            block = words[i:i + 8]
+            await asyncio.sleep(self.config.token_delay() * len(block))
+            self.config.count("tokens", len(block))
+            yield _StubChunk("".join(block))
+
+
+def _parse_range(value: str) -> Tuple[int, int]:
+    low, _, high = value.partition(",")
+    return int(low), int(high or low)
+
+
+def config_from_args(args) -> MockLLMConfig:
+    return MockLLMConfig(
+        models=[m.strip() for m in args.models.split(",") if m.strip()],
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        response_tokens=_parse_range(args.response_tokens),
+        prompt_eval_rate=args.prompt_eval_rate,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        stream_error_rate=args.stream_error_rate,
+        seed=args.seed
+    )
+
+
+def add_config_arguments(parser: argparse.ArgumentParser):
+    """Opções do comportamento simulado (partilhadas com tools.loadtest)"""
+    parser.add_argument("--models", default="mock-llm:latest,nomic-embed-text:latest", help="Modelos anunciados (vírgulas)")
+    parser.add_argument("--latency", default="fixed:0.05", help="Tempo até o primeiro token, ex: lognormal:0.4,0.5")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--response-tokens", default="20,80", help="Tokens por resposta: MIN,MAX")
+    parser.add_argument("--prompt-eval-rate", type=float, default=0.0, help="Tokens de prompt por segundo (0 = ignorar)")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--stream-error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor Ollama simulado para testes de carga")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    server, url = start_mock_server(config_from_args(args), args.host, args.port)
+    print(f"🧪 Mock LLM em {url} (Ctrl+C para sair)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()